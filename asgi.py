@@ -0,0 +1,407 @@
+import asyncio
+import json
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from googleapiclient.errors import HttpError
+from werkzeug.http import parse_cookie, parse_etags, quote_etag
+
+import main
+from metrics import REQUEST_SECONDS
+from quota import QuotaExceeded
+from response_cache import etag_for
+from spotify_client import AsyncSpotifyClient, SpotifyError
+from youtube_client import AsyncYouTubeClient, get_service
+
+# ASGI entry point, run with `uvicorn asgi:app`.
+# The listing pages are served on the event loop and make their Spotify and
+# YouTube calls concurrently, so a request waiting on upstream I/O does not hold
+# a thread. Track listings are sent a page at a time as in main.py. Job progress
+# streams wait on the loop as well. Every other route, and the ?page_token= JSON
+# pages, go to the Flask app on a thread pool.
+
+#ASYNC MODE
+WSGI_THREADS = int(os.getenv('TUNEVERT_ASGI_WSGI_THREADS', '32'))
+ASYNC_MAX_CONNECTIONS = int(os.getenv('TUNEVERT_ASYNC_MAX_CONNECTIONS', '100'))
+
+spotify = AsyncSpotifyClient(
+    base_url=main.SPOTIFY_API_URL,
+    max_connections=ASYNC_MAX_CONNECTIONS,
+    max_retries=int(os.getenv('TUNEVERT_SPOTIFY_MAX_RETRIES', '5')),
+    etag_cache=main.upstream_cache,
+    stats=main.spotify.stats
+)
+youtube = AsyncYouTubeClient(max_connections=ASYNC_MAX_CONNECTIONS)
+wsgi_slots = asyncio.Semaphore(WSGI_THREADS)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    # asgiref runs every WSGI call on one shared thread, which would serialize
+    # the whole Flask app. Inside a ThreadSensitiveContext a request gets a thread
+    # of its own instead, and at most WSGI_THREADS requests are in Flask at once.
+    async def __call__(self, scope, receive, send):
+        async with wsgi_slots, ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+
+wsgi_app = ThreadedWsgiToAsgi(main.app)
+
+
+def session_id(scope):
+    # Reads the Flask session cookie, the listing pages only need the session ID
+    cookie = headers_of(scope).get("cookie")
+    value = parse_cookie(cookie).get(main.app.config["SESSION_COOKIE_NAME"]) if cookie else None
+    if not value:
+        return None
+    serializer = main.app.session_interface.get_signing_serializer(main.app)
+    try:
+        data = serializer.loads(value, max_age=int(main.app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+    return data.get('sid')
+
+
+def headers_of(scope):
+    return {name.decode("latin1"): value.decode("latin1") for name, value in scope.get("headers", [])}
+
+
+# Listing pages. A handler returns (body, cacheable), or None to let the Flask
+# view answer, e.g. with a redirect to the login page. The body is a string or
+# an async generator of chunks that is streamed.
+async def playlists(session_id):
+    spotify_tokens, google_credentials = await asyncio.gather(
+        asyncio.to_thread(main.token_store.load, session_id, "spotify"),
+        asyncio.to_thread(main.google_credentials_for, session_id)
+    )
+    spotify_auth = main.spotify_auth_for(session_id, conditional=True) if spotify_tokens else None
+    service = await asyncio.to_thread(get_service, google_credentials) if google_credentials else None
+
+    profile, spotify_playlists, channel, youtube_playlists = await asyncio.gather(
+        spotify_profile(spotify_auth),
+        spotify_user_playlists(spotify_auth),
+        youtube_channel(service, session_id),
+        youtube_user_playlists(service, session_id)
+    )
+
+    spotify_listing = (profile, *spotify_playlists) if spotify_auth else None
+    youtube_listing = (channel, *youtube_playlists) if service else None
+    cacheable = not (spotify_listing and spotify_listing[2]) and not (youtube_listing and youtube_listing[2])
+    return main.playlists_page(spotify_listing, youtube_listing), cacheable
+
+
+async def spotify_profile(auth):
+    if auth is None:
+        return None
+    try:
+        return (await spotify.get_json("me", auth))['display_name']
+    except SpotifyError:
+        return None
+
+
+async def spotify_user_playlists(auth):
+    playlists = []
+    if auth is None:
+        return playlists, None
+    try:
+        async for element in spotify.iter_user_playlists(auth):
+            playlists.append((element['id'], element['name']))
+    except SpotifyError as e:
+        return playlists, e.message
+    return playlists, None
+
+
+async def youtube_channel(service, session_id):
+    if service is None:
+        return None
+    response = await youtube.execute(
+        service.channels().list(part="snippet", mine=True), main.upstream_cache, session_id
+    )
+    return main.youtube_channel_title(response)
+
+
+async def youtube_user_playlists(service, session_id):
+    if service is None:
+        return [], None
+    try:
+        response = await youtube.execute(
+            service.playlists().list(part="snippet", mine=True, maxResults=50), main.upstream_cache, session_id
+        )
+    except HttpError as e:
+        return [], str(e)
+    return main.youtube_playlists(response), None
+
+
+async def tracks(session_id, playlist_id, playlist_name):
+    if await asyncio.to_thread(main.token_store.load, session_id, "spotify") is None:
+        return None
+    auth = main.spotify_auth_for(session_id, conditional=True)
+    pages = spotify.playlist_track_pages(playlist_id, auth)
+    try:
+        first_page = await anext(pages)
+    except SpotifyError as e:
+        return f"Error: Unable to fetch tracks. Status code: {e.status_code}", False
+    return tracks_page(playlist_id, playlist_name, first_page, pages), True
+
+
+async def tracks_page(playlist_id, playlist_name, first_page, pages):
+    # main.tracks_page over the async client
+    yield main.tracks_header(playlist_name)
+    separator = ""
+    page = first_page
+    try:
+        while page is not None:
+            if page['items']:
+                yield separator + main.spotify_track_rows(element['track'] for element in page['items'])
+                separator = "<br>"
+            page = await anext(pages, None)
+    finally:
+        await pages.aclose()
+    yield main.track_listing_links("spotify", "download-playlist", playlist_id, playlist_name)
+
+
+async def youtube_tracks(session_id, playlist_id, playlist_name):
+    google_credentials = await asyncio.to_thread(main.google_credentials_for, session_id)
+    if not google_credentials:
+        return None
+    service = await asyncio.to_thread(get_service, google_credentials)
+    pages = youtube_playlist_pages(service, session_id, playlist_id)
+    try:
+        first_page = await anext(pages)
+    except HttpError as e:
+        return f"Error: Unable to fetch tracks. Status code: {e.resp.status}", False
+    return youtube_tracks_page(playlist_id, playlist_name, first_page, pages), True
+
+
+async def youtube_playlist_pages(service, session_id, playlist_id):
+    # Yields (playlistItems response, videos) like main.youtube_playlist_pages. Page
+    # tokens make the listing sequential, the video lookups for a page run while
+    # the next page is fetched.
+    def fetch(page_token):
+        return asyncio.ensure_future(youtube.execute(service.playlistItems().list(
+            part="snippet",
+            playlistId=playlist_id,
+            maxResults=50,
+            pageToken=page_token
+        ), main.upstream_cache, session_id))
+
+    pending = fetch(None)
+    try:
+        while pending is not None:
+            response = await pending
+            video_ids = [item['snippet']['resourceId']['videoId'] for item in response['items']]
+            lookup = youtube.get_videos(service, video_ids)
+            pending = fetch(response['nextPageToken']) if response.get('nextPageToken') else None
+            yield response, await lookup
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def youtube_tracks_page(playlist_id, playlist_name, first_page, pages):
+    yield main.youtube_tracks_header(playlist_name)
+    page = first_page
+    try:
+        while page is not None:
+            response, videos = page
+            yield main.youtube_track_rows(response['items'], videos)
+            page = await anext(pages, None)
+    finally:
+        await pages.aclose()
+    yield main.track_listing_links("youtube", "download-youtube-playlist", playlist_id, playlist_name)
+
+
+async def progress(scope, receive, send, job_id):
+    # /progress/<job_id> as in main.py. The event bus wakes the loop when the job
+    # publishes, so an open stream costs no thread while it waits.
+    if await asyncio.to_thread(main.owned_job, job_id, session_id(scope)) is None:
+        await send_response(send, 404, json.dumps({"error": "Job not found"}), content_type="application/json")
+        return
+    try:
+        after = int(headers_of(scope).get("last-event-id", 0))
+    except ValueError:
+        after = 0
+    stream = main.progress_stream(job_id, after)
+
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+
+    def wake():
+        loop.call_soon_threadsafe(woken.set)
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    main.progress_events.add_waker(job_id, wake)
+    try:
+        headers = [(b"content-type", b"text/event-stream; charset=utf-8")]
+        headers.extend((name.lower().encode("latin1"), value.encode("latin1"))
+                       for name, value in main.SSE_HEADERS.items())
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        while not disconnected.done():
+            woken.clear()
+            events, closed = main.progress_events.read(job_id, stream.after)
+            # step() reads the job store now and then
+            messages, done = await asyncio.to_thread(stream.step, events, closed)
+            if messages:
+                await send({"type": "http.response.body", "body": "".join(messages).encode(), "more_body": True})
+            if done:
+                break
+            if not events:
+                waiter = asyncio.ensure_future(woken.wait())
+                await asyncio.wait([waiter, disconnected], timeout=stream.poll_interval,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+        if not disconnected.done():
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        main.progress_events.remove_waker(job_id, wake)
+        disconnected.cancel()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+PROGRESS_ROUTE = re.compile(r"/progress/([^/]+)")
+ROUTES = [
+    (re.compile(r"/playlists"), "/playlists", playlists),
+    (re.compile(r"/tracks/([^/]+)/([^/]+)"), "/tracks/<playlist_id>/<playlist_name>", tracks),
+    (re.compile(r"/youtube-tracks/([^/]+)/([^/]+)"), "/youtube-tracks/<playlist_id>/<playlist_name>", youtube_tracks),
+]
+
+
+def native_route(scope):
+    if scope["method"] != "GET":
+        return None
+    # JSON pages are one upstream call each, the Flask views answer them
+    if "page_token" in parse_qs(scope.get("query_string", b"").decode("latin1"), keep_blank_values=True):
+        return None
+    # Profiled requests go through Flask, which owns the profiler hook
+    if main.PROFILE_TOKEN and headers_of(scope).get("x-tunevert-profile") == main.PROFILE_TOKEN:
+        return None
+    for pattern, rule, handler in ROUTES:
+        match = pattern.fullmatch(scope["path"])
+        if match:
+            return rule, handler, match.groups()
+    return None
+
+
+async def serve_page(scope, receive, send, session_id, handler, args):
+    # The same page cache and conditional responses as cached_page in main.py
+    key = scope["path"]
+    refresh = parse_qs(scope.get("query_string", b"").decode("latin1")).get("refresh")
+    page = None if refresh else main.page_cache.get(session_id, key)
+    if page is None:
+        result = await handler(session_id, *args)
+        if result is None:
+            return None
+        body, cacheable = result
+        if not isinstance(body, str):
+            await stream_page(receive, send, session_id, key, body)
+            return 200
+        if not cacheable:
+            await send_response(send, 200, body)
+            return 200
+        page = (body, etag_for(body))
+        main.page_cache.set(session_id, key, page)
+
+    headers = [
+        ("etag", quote_etag(page[1])),
+        ("cache-control", f"private, max-age={main.PAGE_CACHE_TTL}")
+    ]
+    if parse_etags(headers_of(scope).get("if-none-match")).contains(page[1]):
+        await send_response(send, 304, "", headers, content_type=None)
+        return 304
+    await send_response(send, 200, page[0], headers)
+    return 200
+
+
+async def stream_page(receive, send, session_id, key, chunks):
+    # main.stream_page on the loop. Stops fetching when the client goes away.
+    headers = [
+        (b"content-type", b"text/html; charset=utf-8"),
+        (b"cache-control", b"private"),
+        (b"x-accel-buffering", b"no")
+    ]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    kept = []
+    size = 0
+    try:
+        async for chunk in chunks:
+            if disconnected.done():
+                return
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+            if kept is not None:
+                kept.append(chunk)
+                size += len(chunk)
+                if size > main.STREAMED_PAGE_CACHE_BYTES:
+                    kept = None
+    except Exception as e:
+        kept = None
+        await send({"type": "http.response.body", "body": main.streamed_page_error(e).encode("utf-8"), "more_body": True})
+    finally:
+        disconnected.cancel()
+        await chunks.aclose()
+    await send({"type": "http.response.body", "body": b""})
+    if kept is not None:
+        body = "".join(kept)
+        main.page_cache.set(session_id, key, (body, etag_for(body)))
+
+
+async def send_response(send, status, body, headers=(), content_type="text/html; charset=utf-8"):
+    body = body.encode("utf-8")
+    response_headers = [(name.encode("latin1"), value.encode("latin1")) for name, value in headers]
+    if content_type:
+        response_headers.append((b"content-type", content_type.encode("latin1")))
+    response_headers.append((b"content-length", str(len(body)).encode("latin1")))
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await spotify.aclose()
+            await youtube.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] == "http" and scope["method"] == "GET":
+        match = PROGRESS_ROUTE.fullmatch(scope["path"])
+        if match:
+            return await progress(scope, receive, send, match.group(1))
+
+    route = native_route(scope) if scope["type"] == "http" else None
+    sid = session_id(scope) if route else None
+    if sid is None:
+        return await wsgi_app(scope, receive, send)
+
+    rule, handler, args = route
+    start = time.perf_counter()
+    status = 500
+    try:
+        status = await serve_page(scope, receive, send, sid, handler, args)
+    except QuotaExceeded as e:
+        body, status, headers = main.quota_exceeded(e)
+        await send_response(send, status, body, headers.items())
+    except Exception as e:
+        print(f"Error serving {scope['path']}: {str(e)}")
+        await send_response(send, 500, "<h1>Internal Server Error</h1>")
+    finally:
+        if status is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route=rule, method="GET", status=status)
+
+    if status is None:
+        await wsgi_app(scope, receive, send)
@@ -0,0 +1,132 @@
+import errno
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+def link_or_copy(source_path, target_path):
+    # Hardlinks cost no space or I/O, a copy is only needed across filesystems
+    if os.path.exists(target_path):
+        return
+    try:
+        os.link(source_path, target_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        partial_path = target_path + ".part"
+        shutil.copyfile(source_path, partial_path)
+        os.replace(partial_path, target_path)
+
+
+class AudioStore:
+    # Finished tracks, shared by every user and playlist. A file is addressed by
+    # video ID, format and bitrate, so the same song is downloaded and transcoded
+    # once. The index lives in SQLite next to the files, and the least recently
+    # used files are removed once the store grows past max_bytes. A stored file
+    # keeps the extension it was added with, passthrough formats vary per video.
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS audio (
+                key TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                format TEXT NOT NULL,
+                bitrate TEXT NOT NULL,
+                title TEXT,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn().execute("CREATE INDEX IF NOT EXISTS audio_accessed ON audio (accessed_at)")
+        columns = [row[1] for row in self._conn().execute("PRAGMA table_info(audio)")]
+        if "extension" not in columns:
+            self._conn().execute("ALTER TABLE audio ADD COLUMN extension TEXT")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def key(self, video_id, format, bitrate):
+        return hashlib.sha1(f"{video_id}/{format}/{bitrate}".encode()).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.root, key[:2], f"{key}.{extension}")
+
+    def get(self, video_id, format, bitrate):
+        # Returns (path, title), or None when the track has to be fetched
+        key = self.key(video_id, format, bitrate)
+        conn = self._conn()
+        row = conn.execute("SELECT title, COALESCE(extension, format) FROM audio WHERE key = ?", (key,)).fetchone()
+        path = self.path(key, row[1]) if row is not None else None
+        if row is not None and not os.path.exists(path):
+            conn.execute("DELETE FROM audio WHERE key = ?", (key,))
+            row = None
+        with self._stats_lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None:
+            return None
+        conn.execute("UPDATE audio SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return path, row[0]
+
+    def add(self, video_id, format, bitrate, title, source_path):
+        # Links a finished file into the store, the caller keeps its own copy
+        key = self.key(video_id, format, bitrate)
+        extension = os.path.splitext(source_path)[1].lstrip(".") or format
+        path = self.path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_or_copy(source_path, path)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO audio (key, video_id, format, bitrate, title, size, accessed_at, extension) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, video_id, format, bitrate, title, os.path.getsize(path), time.time(), extension)
+        )
+        self.evict()
+        return path
+
+    def evict(self):
+        # Files linked into playlist folders stay there, only the store's link goes
+        conn = self._conn()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM audio").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, extension, size in conn.execute(
+            "SELECT key, COALESCE(extension, format), size FROM audio ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM audio WHERE key = ?", (key,))
+            try:
+                os.remove(self.path(key, extension))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio").fetchone()
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,275 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_upstream import add_arguments, from_arguments
+
+# Drives the app's routes through a real HTTP server against mock_upstream, and
+# reports throughput and latency percentiles per scenario and concurrency level.
+# --json saves a run, --baseline compares against a saved one and exits non-zero
+# when throughput or p50/p99 latency got worse than --tolerance.
+#
+# Page scenarios time one request. Job scenarios time from the POST or GET that
+# starts the job until /jobs/<id> says it finished.
+
+SCENARIOS = ["playlists", "tracks", "youtube-tracks", "copy", "download", "spotify-download", "stream"]
+JOB_SCENARIOS = {"copy", "download", "spotify-download"}
+DOWNLOAD_PLAYLIST = "dl"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind):
+    # The app under test, on a thread of this process so it shares the mock's catalog
+    port = free_port()
+    if kind == "asgi":
+        import uvicorn
+        import asgi
+        server = uvicorn.Server(uvicorn.Config(asgi.app, host="127.0.0.1", port=port, log_level="warning"))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+    else:
+        from werkzeug.serving import WSGIRequestHandler, make_server
+        import main
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        server = make_server("127.0.0.1", port, main.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+def seed_users(main, upstream, users):
+    # Logged-in sessions without the OAuth dance, returns a session cookie per user
+    serializer = main.app.session_interface.get_signing_serializer(main.app)
+    cookies = []
+    for i in range(users):
+        session_id = f"bench{i}-{uuid.uuid4().hex[:8]}"
+        main.token_store.save(session_id, "spotify", {
+            "access_token": f"spotify-{i}", "refresh_token": "refresh", "expires_at": time.time() + 86400
+        })
+        main.token_store.save(session_id, "google", {
+            "credentials": upstream.google_credentials(f"google-{i}"), "expires_at": time.time() + 86400
+        })
+        cookies.append(f"{main.app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'sid': session_id})}")
+    return cookies
+
+
+class Runner:
+    def __init__(self, base_url, cookies, args):
+        self.base_url = base_url
+        self.cookies = cookies
+        self.args = args
+        self._local = threading.local()
+
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def get(self, n, path, **kwargs):
+        headers = dict(kwargs.pop("headers", {}), Cookie=self.cookies[n % len(self.cookies)])
+        return self.session().get(self.base_url + path, headers=headers, allow_redirects=False, **kwargs)
+
+    def post(self, n, path, data):
+        headers = {"Cookie": self.cookies[n % len(self.cookies)], "Accept": "application/json"}
+        return self.session().post(self.base_url + path, data=data, headers=headers, allow_redirects=False)
+
+    def wait_for_job(self, n, response):
+        if response.status_code != 202:
+            return False
+        status_url = response.json()["status_url"]
+        while True:
+            status = self.get(n, status_url).json()["status"]
+            if status in ("finished", "failed"):
+                return status == "finished"
+            time.sleep(self.args.poll_interval)
+
+    def run_one(self, scenario, n):
+        # True when the request, or the job it started, succeeded
+        playlist = n % self.args.playlists
+        refresh = "" if self.args.cached else "?refresh=1"
+        name = f"bench-{uuid.uuid4().hex[:8]}"
+        if scenario == "playlists":
+            return self.get(n, f"/playlists{refresh}").status_code == 200
+        if scenario == "tracks":
+            return self.get(n, f"/tracks/sp{playlist}/Spotify Playlist {playlist}{refresh}").status_code == 200
+        if scenario == "youtube-tracks":
+            return self.get(n, f"/youtube-tracks/yt{playlist}/YouTube Playlist {playlist}{refresh}").status_code == 200
+        if scenario == "copy":
+            source, target, prefix = ("spotify", "youtube", "sp") if n % 2 == 0 else ("youtube", "spotify", "yt")
+            return self.wait_for_job(n, self.post(n, "/perform-copy", {
+                "source_platform": source, "target_platform": target, "playlist_id": f"{prefix}{playlist}",
+                "playlist_name": name, "mode": "copy"
+            }))
+        profile = f"?profile={self.args.profile}"
+        if scenario == "download":
+            path = f"/download-youtube-playlist/yt{DOWNLOAD_PLAYLIST}/{name}{profile}"
+            return self.wait_for_job(n, self.get(n, path, headers={"Accept": "application/json"}))
+        if scenario == "spotify-download":
+            path = f"/download-playlist/sp{DOWNLOAD_PLAYLIST}/{name}{profile}"
+            return self.wait_for_job(n, self.get(n, path, headers={"Accept": "application/json"}))
+        if scenario == "stream":
+            response = self.get(n, f"/download-youtube-playlist/yt{DOWNLOAD_PLAYLIST}/{name}{profile}&stream=1",
+                                stream=True)
+            size = sum(len(chunk) for chunk in response.iter_content(64 * 1024))
+            return response.status_code == 200 and size > 0
+        raise ValueError(f"Unknown scenario '{scenario}'")
+
+    def measure(self, scenario, concurrency, count):
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def timed(n):
+            nonlocal errors
+            start = time.perf_counter()
+            try:
+                ok = self.run_one(scenario, n)
+            except Exception as e:
+                print(f"Error in {scenario}: {str(e)}")
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += 0 if ok else 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, range(count)))
+        wall = time.perf_counter() - start
+        latencies.sort()
+        return {
+            "scenario": scenario,
+            "concurrency": concurrency,
+            "requests": count,
+            "errors": errors,
+            "throughput": count / wall,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+        }
+
+
+def percentile(values, p):
+    # Nearest rank on sorted values
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def compare(results, baseline, tolerance):
+    # Returns the rows that regressed against the baseline run
+    previous = {(row["scenario"], row["concurrency"]): row for row in baseline}
+    regressions = []
+    for row in results:
+        old = previous.get((row["scenario"], row["concurrency"]))
+        if old is None:
+            continue
+        # Throughput is worse when it drops, latency when it grows
+        changes = [
+            ("throughput", row["throughput"] / old["throughput"] - 1 if old["throughput"] else 0.0, -1),
+            ("p50", row["p50"] / old["p50"] - 1 if old["p50"] else 0.0, 1),
+            ("p99", row["p99"] / old["p99"] - 1 if old["p99"] else 0.0, 1),
+        ]
+        worse = [f"{name} {change:+.0%}" for name, change, sign in changes if change * sign > tolerance]
+        if worse:
+            regressions.append(f"{row['scenario']} @ {row['concurrency']}: {', '.join(worse)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and p50/p99 latency of the app against mock upstreams")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=["playlists", "tracks", "youtube-tracks"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per page scenario and concurrency")
+    parser.add_argument("--jobs", type=int, default=10, help="jobs per job scenario and concurrency")
+    parser.add_argument("--users", type=int, default=20, help="logged-in sessions the requests rotate through")
+    parser.add_argument("--server", choices=["wsgi", "asgi"], default="wsgi")
+    parser.add_argument("--cached", action="store_true", help="let the page cache answer repeat views")
+    parser.add_argument("--download-tracks", type=int, default=10, help="tracks in the playlist download scenarios use")
+    parser.add_argument("--profile", default="original", help="audio profile for the download scenarios")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown before a regression is reported")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    workspace = tempfile.mkdtemp(prefix="tunevert-bench-")
+    upstream = from_arguments(args).start()
+    tracks = range(10 ** 6, 10 ** 6 + args.download_tracks)
+    upstream.spotify_playlists[f"sp{DOWNLOAD_PLAYLIST}"] = ("Download", list(tracks))
+    upstream.youtube_playlists[f"yt{DOWNLOAD_PLAYLIST}"] = (
+        "Download", [(f"itdl-{k}", f"v{k:010d}") for k in tracks]
+    )
+
+    # Everything the app writes goes to the workspace, ~/Downloads included
+    os.environ.update(upstream.env())
+    os.environ["HOME"] = workspace
+    for name, filename in [("TUNEVERT_QUOTA_DB", "quota.db"), ("TUNEVERT_JOB_DB", "jobs.db"),
+                           ("TUNEVERT_SYNC_DB", "sync.db"), ("TUNEVERT_TOKEN_DB", "tokens.db"),
+                           ("TUNEVERT_MATCH_CACHE_DB", "matches.db")]:
+        os.environ.setdefault(name, os.path.join(workspace, filename))
+    os.environ.setdefault("TUNEVERT_YOUTUBE_DAILY_QUOTA", str(10 ** 9))
+    # Admission control would turn the load into 429s, the job limits still apply
+    for name in ["TUNEVERT_JOB_RATE_PER_USER", "TUNEVERT_JOB_RATE_GLOBAL", "TUNEVERT_MAX_ACTIVE_JOBS_PER_USER",
+                 "TUNEVERT_MAX_STREAMING_DOWNLOADS"]:
+        os.environ.setdefault(name, "0")
+
+    import main as app_main
+    runner = Runner(start_server(args.server), seed_users(app_main, upstream, args.users), args)
+    print(f"app: {args.server}, upstream latency {args.latency * 1000:.0f} ms")
+    print(f"{'scenario':<17} {'conc':>5} {'reqs':>6} {'errors':>6} {'req/s':>8} "
+          f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'calls/req':>10}")
+
+    results = []
+    for scenario in args.scenarios:
+        count = args.jobs if scenario in JOB_SCENARIOS | {"stream"} else args.requests
+        for concurrency in args.concurrency:
+            calls_before = sum(upstream.calls.values())
+            row = runner.measure(scenario, concurrency, count)
+            row["upstream_calls"] = (sum(upstream.calls.values()) - calls_before) / count
+            results.append(row)
+            print(f"{scenario:<17} {concurrency:>5} {count:>6} {row['errors']:>6} {row['throughput']:>8.1f} "
+                  f"{row['p50'] * 1000:>9.1f} {row['p90'] * 1000:>9.1f} {row['p99'] * 1000:>9.1f} "
+                  f"{row['upstream_calls']:>10.1f}")
+
+    upstream.stop()
+    shutil.rmtree(workspace, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
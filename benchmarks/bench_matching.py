@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import match_concurrently
+from ratelimit import TokenBucket
+
+
+class MockSearchHandler(BaseHTTPRequestHandler):
+    latency = 0.1
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        body = json.dumps({"tracks": {"items": [{"uri": f"spotify:track:{self.path[-8:]}"}]}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Track matching throughput against a local mock search API")
+    parser.add_argument("--tracks", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds of server latency per search")
+    parser.add_argument("--rate", type=float, default=0, help="search rate limit per second, 0 for none")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    MockSearchHandler.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockSearchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/search?q="
+
+    tracks = [f"{i:08d}" for i in range(args.tracks)]
+
+    limiter = TokenBucket(args.rate) if args.rate > 0 else None
+
+    def resolve(track):
+        if limiter is not None:
+            limiter.acquire()
+        response = requests.get(base_url + track)
+        return response.json()["tracks"]["items"][0]["uri"]
+
+    print(f"{'concurrency':>12} {'seconds':>9} {'tracks/s':>9}")
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        results = match_concurrently(tracks, resolve, concurrency)
+        elapsed = time.perf_counter() - start
+        assert results == [f"spotify:track:{track}" for track in tracks], "results out of order"
+        print(f"{concurrency:>12} {elapsed:>9.2f} {len(tracks) / elapsed:>9.1f}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
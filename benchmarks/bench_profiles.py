@@ -0,0 +1,71 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from downloader import AUDIO_PROFILES, FFMPEG, REMUX_TARGETS, transcode
+
+
+def make_source(folder, seconds, codec, extension):
+    # A synthetic track shaped like what YouTube serves for bestaudio
+    path = os.path.join(folder, f"source.{extension}")
+    subprocess.run(
+        [FFMPEG, "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-f", "lavfi", "-i", f"anoisesrc=duration={seconds}:amplitude=0.1", "-filter_complex", "amix=inputs=2",
+         "-codec:a", codec, "-b:a", "128k", path],
+        check=True,
+        stdin=subprocess.DEVNULL
+    )
+    return path
+
+
+def run_profile(name, profile, source_path, folder):
+    # Returns (wall seconds, CPU seconds, output bytes) for one track
+    extension = os.path.splitext(source_path)[1].lstrip(".")
+    start = time.perf_counter()
+    if profile["mode"] == "transcode":
+        target_path = os.path.join(folder, f"{name}.{profile['extension']}")
+        cpu_seconds = transcode(source_path, target_path, profile["codec"], profile["bitrate"], profile["format"])
+    elif profile["mode"] == "remux" and extension in REMUX_TARGETS:
+        format, target_extension = REMUX_TARGETS[extension]
+        target_path = os.path.join(folder, f"{name}.{target_extension}")
+        cpu_seconds = transcode(source_path, target_path, "copy", None, format)
+    else:
+        # Passthrough is a rename, a hardlink stands in for it so the source survives
+        target_path = os.path.join(folder, f"{name}.{extension}")
+        os.link(source_path, target_path)
+        cpu_seconds = 0.0
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(target_path)
+    os.remove(target_path)
+    return elapsed, cpu_seconds or 0.0, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wall and CPU time per track for every audio profile")
+    parser.add_argument("--seconds", type=int, default=210, help="length of the synthetic track")
+    parser.add_argument("--source", choices=["webm", "m4a"], default="webm",
+                        help="container of the downloaded track, webm holds opus and m4a holds aac")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        codec = "libopus" if args.source == "webm" else "aac"
+        source_path = make_source(folder, args.seconds, codec, args.source)
+        print(f"source: {args.seconds}s {codec} in {args.source}, {os.path.getsize(source_path):,} bytes")
+        print(f"{'profile':<10} {'wall s':>8} {'cpu s':>8} {'x realtime':>11} {'bytes':>12}")
+        for name, profile in AUDIO_PROFILES.items():
+            runs = [run_profile(name, profile, source_path, folder) for _ in range(args.repeat)]
+            wall = min(run[0] for run in runs)
+            cpu = min(run[1] for run in runs)
+            speed = f"{args.seconds / wall:,.0f}" if wall else "-"
+            print(f"{name:<10} {wall:>8.3f} {cpu:>8.3f} {speed:>11} {runs[0][2]:>12,}")
+
+
+if __name__ == "__main__":
+    main()
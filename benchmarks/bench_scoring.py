@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from matcher import best_match, spotify_track_key, youtube_video_key
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "match_corpus.json")
+
+
+def video_key(video):
+    return youtube_video_key(video["id"], video["title"], video["channel"], video["duration"])
+
+
+def load_cases(path):
+    # Keys are built once up front, the same way the copy jobs do per page
+    with open(path, encoding="utf-8") as f:
+        corpus = json.load(f)
+    cases = []
+    for case in corpus:
+        if case["direction"] == "spotify_to_youtube":
+            source = spotify_track_key(case["source"])
+            candidates = [video_key(video) for video in case["candidates"]]
+        else:
+            source = video_key(case["source"])
+            candidates = [spotify_track_key(track) for track in case["candidates"]]
+        cases.append((case, source, candidates))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match accuracy and scoring throughput on an offline corpus")
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--repeat", type=int, default=2000, help="passes over the corpus for the throughput run")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cases = load_cases(args.corpus)
+    key_seconds = time.perf_counter() - start
+    keys = sum(1 + len(candidates) for _, _, candidates in cases)
+
+    correct = 0
+    first_result = 0
+    for case, source, candidates in cases:
+        value, confidence = best_match(source, candidates)
+        correct += value == case["expected"]
+        first_result += candidates[0].value == case["expected"]
+        if args.verbose or value != case["expected"]:
+            mark = "ok  " if value == case["expected"] else "MISS"
+            print(f"{mark} {case['direction']:<19} {confidence:.2f} {value} (expected {case['expected']})")
+
+    print(f"cases:              {len(cases)}")
+    print(f"scored accuracy:    {correct / len(cases):.0%}")
+    print(f"first result wins:  {first_result / len(cases):.0%}")
+    print(f"key building:       {keys / key_seconds:,.0f} keys/s")
+
+    pairs = sum(len(candidates) for _, _, candidates in cases) * args.repeat
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for _, source, candidates in cases:
+            best_match(source, candidates)
+    elapsed = time.perf_counter() - start
+    print(f"scoring:            {pairs / elapsed:,.0f} pairs/s, {len(cases) * args.repeat / elapsed:,.0f} tracks/s")
+
+
+if __name__ == "__main__":
+    main()
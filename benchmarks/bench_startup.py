@@ -0,0 +1,70 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_REQUEST = """
+import time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+client = main.app.test_client()
+client.get("/")
+index = time.perf_counter()
+credentials = {"token": "t", "refresh_token": "r", "client_id": "c", "client_secret": "s",
+               "token_uri": "https://oauth2.googleapis.com/token"}
+main.get_service(credentials)
+first_service = time.perf_counter()
+main.get_service(dict(credentials, refresh_token="other"))
+second_service = time.perf_counter()
+from googleapiclient.discovery import build
+from google.oauth2.credentials import Credentials
+build("youtube", "v3", credentials=Credentials(**credentials), static_discovery=True)
+legacy_build = time.perf_counter()
+print(imported - start, index - imported, first_service - index, second_service - first_service,
+      legacy_build - second_service)
+"""
+
+
+def run(code):
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                          capture_output=True, text=True).stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import and first-request latency of main.py")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    interpreter = []
+    import_main = []
+    samples = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        run("pass")
+        interpreter.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        run("import main")
+        import_main.append(time.perf_counter() - start)
+
+        samples.append([float(value) for value in run(FIRST_REQUEST).split()])
+
+    def ms(values):
+        values = sorted(values)
+        return f"{values[len(values) // 2] * 1000:8.1f} ms"
+
+    print(f"interpreter start             {ms(interpreter)}")
+    print(f"cold import of main.py        {ms([a - b for a, b in zip(import_main, interpreter)])}")
+    print(f"import main (in process)      {ms([s[0] for s in samples])}")
+    print(f"first request to /            {ms([s[1] for s in samples])}")
+    print(f"first YouTube service         {ms([s[2] for s in samples])}")
+    print(f"next YouTube service          {ms([s[3] for s in samples])}")
+    print(f"build() per request (before)  {ms([s[4] for s in samples])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,462 @@
+import argparse
+import email.parser
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downloader import FFMPEG
+from quota import call_methods, cost
+
+# A stand-in for the Spotify Web API, the YouTube Data API and the YouTube media
+# host, serving the calls main.py makes with a deterministic catalog. Latency,
+# errors, rate limits and the YouTube quota are configurable, so runs against it
+# are repeatable. Point the app at it with the variables from env().
+#
+# Track k is "Song k" by "Artist k % 97". Its video is "Artist - Song k (Official
+# Audio)" with the same duration, so both match directions find it, and every
+# search also returns a live version that the matcher has to reject.
+
+ARTISTS = 97
+SONG = re.compile(r"\bSong (\d+)\b")
+
+
+def track_id(k):
+    return f"track{k:06d}"
+
+
+def video_id(k, live=False):
+    return f"{'w' if live else 'v'}{k:010d}"
+
+
+def duration_seconds(k):
+    return 150 + k * 7919 % 150
+
+
+def spotify_track(k):
+    return {
+        "id": track_id(k),
+        "uri": f"spotify:track:{track_id(k)}",
+        "name": f"Song {k}",
+        "duration_ms": duration_seconds(k) * 1000,
+        "artists": [{"name": f"Artist {k % ARTISTS}"}],
+        "external_ids": {"isrc": f"QZBENCH{k:05d}"}
+    }
+
+
+def video_title(k, live=False):
+    return f"Artist {k % ARTISTS} - Song {k} ({'Live' if live else 'Official Audio'})"
+
+
+def video_k(id):
+    # (k, live) for a video ID from video_id(), None for anything else
+    if len(id) == 11 and id[0] in "vw" and id[1:].isdigit():
+        return int(id[1:]), id[0] == "w"
+    return None
+
+
+def make_media(seconds):
+    # One opus track in webm, served for every video
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "media.webm")
+        subprocess.run(
+            [FFMPEG, "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+             "-codec:a", "libopus", "-b:a", "128k", path],
+            check=True,
+            stdin=subprocess.DEVNULL
+        )
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections is not worth a traceback
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class Upstream:
+    def __init__(self, playlists=5, tracks=200, latency=0.05, jitter=0.5, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, quota=None, media_seconds=30):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.quota = quota
+        self.quota_used = 0
+        self.media = make_media(media_seconds) if media_seconds else b""
+        self.calls = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # playlist ID -> (name, list of track numbers) on Spotify, (name, list of
+        # (item ID, video ID)) on YouTube. Created playlists start out empty.
+        self.spotify_playlists = {
+            f"sp{n}": (f"Spotify Playlist {n}", list(range(n * tracks, (n + 1) * tracks))) for n in range(playlists)
+        }
+        self.youtube_playlists = {
+            f"yt{n}": (f"YouTube Playlist {n}", [(f"it{n}-{i}", video_id(k))
+                                                  for i, k in enumerate(range(n * tracks, (n + 1) * tracks))])
+            for n in range(playlists)
+        }
+        self.server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        handler = type("Handler", (MockHandler,), {"upstream": self})
+        self.server = MockServer((host, port), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        return {
+            "TUNEVERT_SPOTIFY_API_URL": f"{self.url}/spotify/v1/",
+            "TUNEVERT_SPOTIFY_ACCOUNTS_URL": f"{self.url}/accounts",
+            "TUNEVERT_YOUTUBE_API_URL": f"{self.url}/",
+            "TUNEVERT_YOUTUBE_WATCH_URL": f"{self.url}/media/{{video_id}}.webm"
+        }
+
+    def google_credentials(self, token="bench"):
+        return {
+            "token": token,
+            "refresh_token": f"{token}-refresh",
+            "token_uri": f"{self.url}/oauth2/token",
+            "client_id": "bench",
+            "client_secret": "bench",
+            "scopes": ["https://www.googleapis.com/auth/youtube.force-ssl"]
+        }
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def next_id(self, prefix):
+        return f"{prefix}{next(self._ids)}"
+
+    def spend(self, methods):
+        # True when the call fits the remaining YouTube quota
+        if self.quota is None:
+            return True
+        units = sum(cost(method) for method in methods)
+        with self._lock:
+            if self.quota_used + units > self.quota:
+                return False
+            self.quota_used += units
+            return True
+
+
+def youtube_error(status, reason, message):
+    return status, {"error": {"code": status, "message": message, "errors": [{"reason": reason, "message": message}]}}
+
+
+def etag_of(body):
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    upstream = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_call("GET")
+
+    def do_POST(self):
+        self.handle_call("POST")
+
+    def do_DELETE(self):
+        self.handle_call("DELETE")
+
+    def do_HEAD(self):
+        self.handle_call("HEAD")
+
+    def handle_call(self, method):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        upstream = self.upstream
+
+        if url.path.startswith("/media/"):
+            upstream.count("media")
+            return self.send_media()
+
+        if upstream.latency:
+            time.sleep(upstream.latency * random.uniform(1 - upstream.jitter, 1 + upstream.jitter))
+
+        if url.path.startswith("/spotify/v1/"):
+            path = url.path[len("/spotify/v1/"):]
+            upstream.count(f"spotify {method} {SPOTIFY_ENDPOINT.sub('{id}', path)}")
+            fault = self.fault("spotify")
+            status, data = fault or spotify_call(upstream, method, path, query, body)
+            return self.send_json(status, data, etag=method == "GET" and status == 200)
+        if url.path == "/accounts/api/token" or url.path == "/oauth2/token":
+            upstream.count(f"token {url.path}")
+            return self.send_json(200, {
+                "access_token": upstream.next_id("token"), "token_type": "Bearer", "expires_in": 3600,
+                "refresh_token": "bench-refresh"
+            })
+        if url.path == "/batch":
+            upstream.count("youtube batch")
+            return self.send_batch(body)
+        if url.path.startswith("/youtube/v3/"):
+            methods = call_methods(method, self.path)
+            upstream.count(f"youtube {methods[0] if methods else url.path}")
+            status, data = self.fault("youtube") or self.youtube_quota(methods) or youtube_call(
+                upstream, method, url.path[len("/youtube/v3/"):], query, body
+            )
+            return self.send_json(status, data, etag=method == "GET" and status == 200)
+        self.send_json(404, {"error": {"status": 404, "message": "Not found"}})
+
+    def fault(self, service):
+        upstream = self.upstream
+        roll = random.random()
+        if roll < upstream.error_rate:
+            if service == "spotify":
+                return 503, {"error": {"status": 503, "message": "Service unavailable"}}
+            return youtube_error(503, "backendError", "Backend Error")
+        if roll < upstream.error_rate + upstream.throttle_rate:
+            if service == "spotify":
+                return 429, {"error": {"status": 429, "message": "API rate limit exceeded"}}
+            return youtube_error(403, "rateLimitExceeded", "Rate Limit Exceeded")
+        return None
+
+    def youtube_quota(self, methods):
+        if self.upstream.spend(methods):
+            return None
+        return youtube_error(403, "quotaExceeded", "The request cannot be completed because you have exceeded your quota.")
+
+    def send_json(self, status, data, etag=False):
+        headers = {"Content-Type": "application/json; charset=utf-8"}
+        if status == 429:
+            headers["Retry-After"] = str(self.upstream.retry_after)
+        if etag:
+            # YouTube puts the etag in the body as well, Spotify only sends the header
+            tag = etag_of(data)
+            if self.path.startswith("/youtube/"):
+                data = dict(data, etag=tag)
+            headers["ETag"] = f'"{tag}"'
+            if self.headers.get("If-None-Match") in (f'"{tag}"', tag):
+                status, data = 304, None
+        self.send(status, b"" if data is None else json.dumps(data).encode(), headers)
+
+    def send(self, status, content, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def send_media(self):
+        # A direct media link, yt-dlp's generic extractor downloads it like a video
+        content = self.upstream.media
+        self.send(200, content, {"Content-Type": "audio/webm", "Accept-Ranges": "none"})
+
+    def send_batch(self, body):
+        # multipart/mixed in, multipart/mixed out, one application/http part per call
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        boundary = "batch_" + self.upstream.next_id("")
+        parts = []
+        # Like Google, the calls of a batch run in no particular order
+        calls = list(message.get_payload())
+        random.shuffle(calls)
+        for part in calls:
+            request_line, _, rest = part.get_payload().partition("\n")
+            method, target = request_line.split()[:2]
+            _, _, call_body = rest.replace("\r\n", "\n").partition("\n\n")
+            url = urlparse(target)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            methods = call_methods(method, target)
+            self.upstream.count(f"youtube {methods[0] if methods else url.path}")
+            status, data = self.fault("youtube") or self.youtube_quota(methods) or youtube_call(
+                self.upstream, method, url.path[len("/youtube/v3/"):], query, call_body.encode()
+            )
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(data)}\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+        self.send(200, "".join(parts).encode(), {"Content-Type": f"multipart/mixed; boundary={boundary}"})
+
+
+SPOTIFY_ENDPOINT = re.compile(r"(?<=playlists/)[^/]+|(?<=users/)[^/]+")
+
+
+def spotify_page(upstream, path, items, query, default_limit):
+    offset = int(query.get("offset", 0))
+    limit = int(query.get("limit", default_limit))
+    page = {"items": items[offset:offset + limit], "total": len(items), "offset": offset, "limit": limit, "next": None}
+    if offset + limit < len(items):
+        page["next"] = f"{upstream.url}/spotify/v1/{path}?" + urlencode(dict(query, offset=offset + limit, limit=limit))
+    return page
+
+
+def spotify_call(upstream, method, path, query, body):
+    parts = path.split("/")
+    if method == "GET" and path == "me":
+        return 200, {"id": "bench-user", "display_name": "Bench User"}
+    if method == "GET" and path == "me/playlists":
+        items = [{"id": id, "name": name} for id, (name, _) in upstream.spotify_playlists.items()]
+        return 200, spotify_page(upstream, path, items, query, 20)
+    if method == "GET" and path == "search":
+        match = SONG.search(query.get("q", ""))
+        items = [spotify_track(int(match.group(1)))] if match else []
+        return 200, {"tracks": {"items": items, "total": len(items)}}
+    if len(parts) == 3 and parts[0] == "users" and parts[2] == "playlists" and method == "POST":
+        playlist_id = upstream.next_id("spnew")
+        upstream.spotify_playlists[playlist_id] = (json.loads(body or b"{}").get("name", playlist_id), [])
+        return 201, {"id": playlist_id}
+    if len(parts) == 3 and parts[0] == "playlists" and parts[2] == "tracks":
+        playlist = upstream.spotify_playlists.get(parts[1])
+        if playlist is None:
+            return 404, {"error": {"status": 404, "message": "Invalid playlist Id"}}
+        if method == "GET":
+            return 200, spotify_page(upstream, path, [{"track": spotify_track(k)} for k in playlist[1]], query, 100)
+        if method == "POST":
+            uris = json.loads(body or b"{}").get("uris", [])
+            with upstream._lock:
+                playlist[1].extend(int(uri.rsplit("track", 1)[1]) for uri in uris)
+            return 201, {"snapshot_id": upstream.next_id("snapshot")}
+    return 404, {"error": {"status": 404, "message": "Service not found"}}
+
+
+def youtube_call(upstream, method, resource, query, body):
+    if resource == "channels":
+        return 200, {"items": [{"id": "UCbench", "snippet": {"title": "Bench Channel"}}]}
+    if resource == "playlists" and method == "GET":
+        items = [{"id": id, "snippet": {"title": name}} for id, (name, _) in upstream.youtube_playlists.items()]
+        return 200, {"items": items[:int(query.get("maxResults", 5))], "pageInfo": {"totalResults": len(items)}}
+    if resource == "playlists" and method == "POST":
+        playlist_id = upstream.next_id("ytnew")
+        title = json.loads(body or b"{}").get("snippet", {}).get("title", playlist_id)
+        upstream.youtube_playlists[playlist_id] = (title, [])
+        return 200, {"id": playlist_id, "snippet": {"title": title}}
+    if resource == "playlistItems":
+        return playlist_items_call(upstream, method, query, body)
+    if resource == "search":
+        match = SONG.search(query.get("q", ""))
+        if not match:
+            return 200, {"items": []}
+        k = int(match.group(1))
+        items = [
+            {"id": {"videoId": video_id(k, live)},
+             "snippet": {"title": video_title(k, live), "channelTitle": f"Artist {k % ARTISTS} - Topic"}}
+            for live in (False, True)
+        ]
+        return 200, {"items": items[:int(query.get("maxResults", 5))]}
+    if resource == "videos":
+        items = []
+        for id in query.get("id", "").split(","):
+            parsed = video_k(id)
+            if parsed:
+                seconds = duration_seconds(parsed[0]) + (40 if parsed[1] else 0)
+                items.append({"id": id, "contentDetails": {"duration": f"PT{seconds // 60}M{seconds % 60}S"}})
+        return 200, {"items": items}
+    return youtube_error(404, "notFound", "Not Found")
+
+
+def playlist_item(item_id, id):
+    parsed = video_k(id)
+    title = video_title(*parsed) if parsed else id
+    channel = f"Artist {parsed[0] % ARTISTS} - Topic" if parsed else ""
+    return {"id": item_id, "snippet": {
+        "title": title, "videoOwnerChannelTitle": channel, "resourceId": {"kind": "youtube#video", "videoId": id}
+    }}
+
+
+def playlist_items_call(upstream, method, query, body):
+    if method == "DELETE":
+        with upstream._lock:
+            for _, items in upstream.youtube_playlists.values():
+                items[:] = [item for item in items if item[0] != query.get("id")]
+        return 204, None
+    if method == "POST":
+        snippet = json.loads(body or b"{}").get("snippet", {})
+        playlist = upstream.youtube_playlists.get(snippet.get("playlistId"))
+        if playlist is None:
+            return youtube_error(404, "playlistNotFound", "Playlist not found")
+        item = (upstream.next_id("item"), snippet.get("resourceId", {}).get("videoId"))
+        with upstream._lock:
+            playlist[1].append(item)
+        return 200, playlist_item(*item)
+
+    playlist = upstream.youtube_playlists.get(query.get("playlistId"))
+    if playlist is None:
+        return youtube_error(404, "playlistNotFound", "Playlist not found")
+    offset = int(query.get("pageToken") or 0)
+    limit = int(query.get("maxResults", 5))
+    items = playlist[1][offset:offset + limit]
+    page = {"items": [playlist_item(*item) for item in items], "pageInfo": {"totalResults": len(playlist[1])}}
+    if offset + limit < len(playlist[1]):
+        page["nextPageToken"] = str(offset + limit)
+    return 200, page
+
+
+def add_arguments(parser):
+    parser.add_argument("--playlists", type=int, default=5, help="playlists per platform")
+    parser.add_argument("--tracks", type=int, default=200, help="tracks per playlist")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per upstream call")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency varies by this fraction either way")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with a 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of calls answered with a Spotify 429 or a YouTube rateLimitExceeded")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After sent with a 429")
+    parser.add_argument("--quota", type=int, default=None, help="YouTube units before quotaExceeded, no limit by default")
+    parser.add_argument("--media-seconds", type=int, default=30, help="length of the served audio track")
+
+
+def from_arguments(args):
+    return Upstream(args.playlists, args.tracks, args.latency, args.jitter, args.error_rate, args.throttle_rate,
+                    args.retry_after, args.quota, args.media_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the Spotify and YouTube APIs the app calls")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    upstream = from_arguments(args).start(args.host, args.port)
+    print(f"Mock upstream on {upstream.url}, start the app with:")
+    for name, value in upstream.env().items():
+        print(f"  export {name}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        upstream.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert many playlists in one job. Uses the tokens of a logged-in web session, "
+                    "so log in on a server sharing its token database first. "
+                    "/api/session shows the session ID."
+    )
+    parser.add_argument("source_platform", choices=["spotify", "youtube"], help="platform to copy from")
+    parser.add_argument("playlist_ids", nargs="*", help="playlists to convert")
+    parser.add_argument("--all", action="store_true", help="convert all of your playlists")
+    parser.add_argument("--session-id", default=os.getenv("TUNEVERT_SESSION_ID"),
+                        help="web session to take tokens from (default: $TUNEVERT_SESSION_ID)")
+    parser.add_argument("--poll", type=float, default=2.0, help="seconds between progress updates")
+    args = parser.parse_args()
+
+    if not args.session_id:
+        parser.error("--session-id is required")
+    if not args.all and not args.playlist_ids:
+        parser.error("pass playlist IDs or --all")
+
+    # Imported late so --help works without the app's configuration
+    import main as tunevert
+
+    for provider in ("spotify", "google"):
+        if not tunevert.token_store.has(args.session_id, provider):
+            print(f"Session {args.session_id} is not logged in to {provider}. Log in through the web app first.")
+            return 1
+
+    job_id = tunevert.enqueue_bulk_copy(args.source_platform, None if args.all else args.playlist_ids, args.session_id)
+    print(f"Job {job_id} started")
+
+    last_progress = None
+    while True:
+        job = tunevert.job_queue.get(job_id)
+        progress = {key: value for key, value in job.progress.items() if key != "active"}
+        if progress != last_progress:
+            print(", ".join(f"{key}: {value}" for key, value in progress.items()))
+            last_progress = progress
+        if job.status == tunevert.JOB_FAILED:
+            print(f"Failed: {job.error}")
+            return 1
+        if job.status == tunevert.JOB_FINISHED:
+            print(json.dumps(job.result, indent=2))
+            return 0
+        time.sleep(args.poll)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
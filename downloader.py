@@ -0,0 +1,301 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yt_dlp
+from yt_dlp.utils import sanitize_filename
+
+from audio_store import link_or_copy
+from metrics import DOWNLOAD_SECONDS, TRANSCODE_CPU_SECONDS, TRANSCODE_SECONDS
+
+
+def find_ffmpeg():
+    path = shutil.which("ffmpeg")
+    if path:
+        return path
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return "ffmpeg"
+
+
+FFMPEG = find_ffmpeg()
+STAGING_FOLDER = ".staging"
+
+# What a finished track looks like. "original" keeps the file YouTube serves
+# (usually opus in webm or aac in m4a) and needs no ffmpeg at all, "remux" copies
+# the audio stream into a plain audio container, the rest re-encode.
+AUDIO_PROFILES = {
+    "original": {"mode": "passthrough"},
+    "remux": {"mode": "remux"},
+    "mp3": {"mode": "transcode", "codec": "libmp3lame", "bitrate": "192k", "format": "mp3", "extension": "mp3"},
+    "mp3-320": {"mode": "transcode", "codec": "libmp3lame", "bitrate": "320k", "format": "mp3", "extension": "mp3"},
+    "aac": {"mode": "transcode", "codec": "aac", "bitrate": "192k", "format": "ipod", "extension": "m4a"},
+    "opus": {"mode": "transcode", "codec": "libopus", "bitrate": "160k", "format": "opus", "extension": "opus"},
+}
+DEFAULT_AUDIO_PROFILE = "original"
+# Downloaded extension -> (ffmpeg format, extension) for the remux profile
+REMUX_TARGETS = {"webm": ("opus", "opus"), "m4a": ("ipod", "m4a"), "mp4": ("ipod", "m4a")}
+ORIGINAL_EXTENSIONS = ("m4a", "webm", "opus", "ogg", "mp3", "mp4")
+WATCH_URL = "https://www.youtube.com/watch?v={video_id}"
+
+
+def run_process(args):
+    # Returns the CPU seconds the process used. wait4 reports them for this child
+    # alone, other ffmpeg processes running at the same time don't count.
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL)
+    if not hasattr(os, "wait4"):
+        returncode = process.wait()
+        cpu_seconds = None
+    else:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        returncode = process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_seconds = usage.ru_utime + usage.ru_stime
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
+    return cpu_seconds
+
+
+def transcode(source_path, target_path, codec="libmp3lame", bitrate="192k", format="mp3"):
+    # Write next to the target and rename, so a half-written file never looks finished.
+    # codec "copy" without a bitrate remuxes. Returns ffmpeg's CPU seconds.
+    partial_path = target_path + ".part"
+    args = [FFMPEG, "-y", "-loglevel", "error", "-i", source_path, "-vn", "-codec:a", codec]
+    if bitrate:
+        args += ["-b:a", bitrate]
+    args += ["-f", format, partial_path]
+    try:
+        cpu_seconds = run_process(args)
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, target_path)
+    return cpu_seconds
+
+
+class DownloadEngine:
+    # Downloads run on a thread pool, each with its own YoutubeDL instance. The
+    # finished downloads are handed to a second pool sized to the core count,
+    # where every worker drives one ffmpeg process. Passthrough downloads skip
+    # that pool. With an AudioStore, tracks it already holds are linked into the
+    # output folder without either step.
+
+    def __init__(self, output_folder, fetch_workers=4, transcode_workers=None, on_event=None,
+                 progress_interval=0.5, store=None, profile=DEFAULT_AUDIO_PROFILE, watch_url=WATCH_URL):
+        self.output_folder = output_folder
+        self.watch_url = watch_url
+        self.store = store
+        self.profile_name = profile
+        self.profile = AUDIO_PROFILES[profile]
+        self.staging_folder = os.path.join(output_folder, STAGING_FOLDER)
+        self.on_event = on_event
+        self.progress_interval = progress_interval
+        self._fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix="fetch")
+        self._transcode_pool = ThreadPoolExecutor(
+            max_workers=transcode_workers or os.cpu_count() or 1, thread_name_prefix="transcode"
+        )
+        self._local = threading.local()
+        self._futures = []
+        self._submitted = set()
+        self._results = queue.Queue()
+        self._sealed = threading.Event()
+        self._last_progress = {}
+        os.makedirs(self.staging_folder, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _ydl(self):
+        ydl = getattr(self._local, "ydl", None)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL({
+                'format': 'bestaudio/best',
+                'outtmpl': os.path.join(self.staging_folder, '%(id)s.%(ext)s'),
+                'quiet': True,
+                'noprogress': True,
+                'progress_hooks': [self._progress_hook],
+            })
+            self._local.ydl = ydl
+        return ydl
+
+    def _done(self, result):
+        self._results.put(result)
+        return result
+
+    def _emit(self, event, video_id, label, **data):
+        if self.on_event is not None:
+            self.on_event(dict(event=event, video_id=video_id, label=label, **data))
+
+    def _progress_hook(self, d):
+        if d.get('status') != 'downloading':
+            return
+        video_id = d.get('info_dict', {}).get('id')
+        now = time.monotonic()
+        if now - self._last_progress.get(video_id, 0) < self.progress_interval:
+            return
+        self._last_progress[video_id] = now
+        self._emit(
+            "progress", video_id, d.get('info_dict', {}).get('title'),
+            downloaded_bytes=d.get('downloaded_bytes'),
+            total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+            speed=d.get('speed'),
+            eta=d.get('eta')
+        )
+
+    def target_path(self, title, video_id, extension):
+        # The video ID keeps two tracks with the same title apart, "Intro [abc123].mp3"
+        name = f"{sanitize_filename(title)} [{video_id}]" if title else video_id
+        return os.path.join(self.output_folder, f"{name}.{extension}")
+
+    def existing_target(self, title, video_id):
+        # Passthrough and remux output can have any of several extensions
+        if self.profile["mode"] == "transcode":
+            extensions = [self.profile["extension"]]
+        else:
+            extensions = ORIGINAL_EXTENSIONS
+        for extension in extensions:
+            path = self.target_path(title, video_id, extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def submit(self, video_id, title=None, label=None):
+        if video_id in self._submitted:
+            return None
+        self._submitted.add(video_id)
+        future = self._fetch_pool.submit(self._fetch, video_id, title, label or title or video_id)
+        self._futures.append(future)
+        return future
+
+    def _fetch(self, video_id, title, label):
+        try:
+            if title:
+                target_path = self.existing_target(title, video_id)
+                if target_path:
+                    self._emit("skipped", video_id, label, path=target_path)
+                    return self._done({"video_id": video_id, "status": "skipped", "path": target_path})
+
+            stored = self._from_store(video_id, title, label)
+            if stored is not None:
+                return stored
+
+            ydl = self._ydl()
+            info = ydl.extract_info(self.watch_url.format(video_id=video_id), download=False)
+            video_title = info.get('title')
+            target_path = self.existing_target(video_title, video_id)
+            if target_path:
+                self._emit("skipped", video_id, label, path=target_path)
+                return self._done({"video_id": video_id, "status": "skipped", "path": target_path})
+
+            self._emit("started", video_id, label)
+            with DOWNLOAD_SECONDS.time():
+                info = ydl.process_ie_result(info, download=True)
+            source_path = info['requested_downloads'][0]['filepath']
+            self._emit("downloaded", video_id, label, path=source_path)
+        except Exception as e:
+            self._emit("failed", video_id, label, error=str(e))
+            return self._done({"video_id": video_id, "status": "failed", "error": str(e)})
+
+        if self.profile["mode"] == "passthrough":
+            # Only a rename, not worth a trip through the transcode pool
+            return self._convert(video_id, label, source_path, video_title)
+        # Hand off to the transcode pool so this thread can start the next download
+        return self._transcode_pool.submit(self._convert, video_id, label, source_path, video_title)
+
+    def _from_store(self, video_id, title, label):
+        if self.store is None:
+            return None
+        stored = self.store.get(video_id, self.profile_name, self.profile.get("bitrate", ""))
+        if stored is None:
+            return None
+        store_path, stored_title = stored
+        extension = os.path.splitext(store_path)[1].lstrip(".")
+        target_path = self.target_path(title or stored_title, video_id, extension)
+        try:
+            link_or_copy(store_path, target_path)
+        except FileNotFoundError:
+            # Evicted since the lookup, download it again
+            return None
+        self._emit("finished", video_id, label, path=target_path, cached=True)
+        return self._done({"video_id": video_id, "status": "downloaded", "path": target_path, "cached": True})
+
+    def _convert(self, video_id, label, source_path, title):
+        try:
+            with TRANSCODE_SECONDS.time(profile=self.profile_name):
+                target_path, cpu_seconds = self._convert_file(source_path, title, video_id)
+            if cpu_seconds is not None:
+                TRANSCODE_CPU_SECONDS.observe(cpu_seconds, profile=self.profile_name)
+        except Exception as e:
+            self._emit("failed", video_id, label, error=str(e))
+            return self._done({"video_id": video_id, "status": "failed", "error": str(e)})
+        finally:
+            if os.path.exists(source_path):
+                os.remove(source_path)
+        if self.store is not None:
+            try:
+                self.store.add(video_id, self.profile_name, self.profile.get("bitrate", ""), title, target_path)
+            except Exception as e:
+                print(f"Error adding '{label}' to the audio store: {str(e)}")
+        self._emit("finished", video_id, label, path=target_path)
+        return self._done({"video_id": video_id, "status": "downloaded", "path": target_path})
+
+    def _convert_file(self, source_path, title, video_id):
+        # Returns (target_path, CPU seconds)
+        profile = self.profile
+        extension = os.path.splitext(source_path)[1].lstrip(".")
+        if profile["mode"] == "transcode":
+            target_path = self.target_path(title, video_id, profile["extension"])
+            return target_path, transcode(source_path, target_path, profile["codec"], profile["bitrate"],
+                                          profile["format"])
+        if profile["mode"] == "remux" and extension in REMUX_TARGETS:
+            format, extension = REMUX_TARGETS[extension]
+            target_path = self.target_path(title, video_id, extension)
+            return target_path, transcode(source_path, target_path, "copy", None, format)
+        # The download is the result, the staging folder is on the same filesystem
+        target_path = self.target_path(title, video_id, extension)
+        os.replace(source_path, target_path)
+        return target_path, 0.0
+
+    def wait(self):
+        # Results in submission order, once every download and transcode is done
+        results = []
+        for future in self._futures:
+            result = future.result()
+            if not isinstance(result, dict):
+                result = result.result()
+            results.append(result)
+        return results
+
+    def seal(self):
+        # No more submissions are coming, lets iter_results() finish
+        self._sealed.set()
+
+    def iter_results(self):
+        # Results in completion order, so callers can use each track as soon as it is ready
+        yielded = 0
+        while not (self._sealed.is_set() and yielded == len(self._futures)):
+            try:
+                result = self._results.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            yielded += 1
+            yield result
+
+    def close(self, cancel=False):
+        self._fetch_pool.shutdown(cancel_futures=cancel)
+        self._transcode_pool.shutdown(cancel_futures=cancel)
+        shutil.rmtree(self.staging_folder, ignore_errors=True)
@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from collections import deque
+
+from jobs import JOB_FAILED, JOB_FINISHED
+
+# In-process publish/subscribe for job progress. Every topic (a job ID) keeps its
+# last `history` events with increasing IDs, so a subscriber that connects late or
+# reconnects with Last-Event-ID gets what it missed instead of starting over.
+# Publishers never block on subscribers, a reader that falls more than `history`
+# events behind skips ahead.
+
+
+class Topic:
+    def __init__(self, lock, history):
+        self.events = deque(maxlen=history)
+        self.next_id = 1
+        self.closed = False
+        self.touched_at = time.monotonic()
+        self.changed = threading.Condition(lock)
+        self.wakers = set()
+
+
+class EventBus:
+    def __init__(self, history=1000, ttl=600):
+        self.history = history
+        # Topics nobody published to for this long are dropped
+        self.ttl = ttl
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+
+    def _topic(self, name):
+        topic = self._topics.get(name)
+        if topic is None:
+            self._sweep()
+            topic = self._topics[name] = Topic(self._lock, self.history)
+        return topic
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._swept_at < 60:
+            return
+        self._swept_at = now
+        for name, topic in list(self._topics.items()):
+            if now - topic.touched_at > self.ttl and not topic.wakers:
+                del self._topics[name]
+
+    def publish(self, name, event, **data):
+        # Returns the event ID, None when the topic is already closed
+        with self._lock:
+            topic = self._topic(name)
+            if topic.closed:
+                return None
+            event_id = topic.next_id
+            topic.next_id += 1
+            topic.events.append((event_id, event, data))
+            topic.touched_at = time.monotonic()
+            topic.changed.notify_all()
+            wakers = list(topic.wakers)
+        for wake in wakers:
+            wake()
+        return event_id
+
+    def close(self, name, event="end", **data):
+        # The last event of a topic, subscribers stop after it
+        event_id = self.publish(name, event, **data)
+        with self._lock:
+            self._topic(name).closed = True
+        return event_id
+
+    def _read(self, name, after):
+        topic = self._topics.get(name)
+        if topic is None:
+            return [], False
+        return [entry for entry in topic.events if entry[0] > after], topic.closed
+
+    def read(self, name, after=0):
+        # (events with an ID above `after`, whether the topic is closed)
+        with self._lock:
+            return self._read(name, after)
+
+    def wait(self, name, after=0, timeout=None):
+        # read(), blocking for up to timeout seconds until there is something new
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            topic = self._topic(name)
+            while True:
+                events, closed = self._read(name, after)
+                if events or closed:
+                    return events, closed
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return [], False
+                topic.changed.wait(remaining)
+
+    def add_waker(self, name, wake):
+        # wake() is called from the publishing thread after every new event, for
+        # subscribers that can't block a thread, e.g. on an event loop
+        with self._lock:
+            self._topic(name).wakers.add(wake)
+
+    def remove_waker(self, name, wake):
+        with self._lock:
+            topic = self._topics.get(name)
+            if topic is not None:
+                topic.wakers.discard(wake)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "topics": len(self._topics),
+                "subscribers": sum(len(topic.wakers) for topic in self._topics.values()),
+                "events": sum(len(topic.events) for topic in self._topics.values())
+            }
+
+
+# Sent before a stream is cut short by ProgressStream's max_duration
+RECONNECT_DELAY_MS = 500
+
+
+def sse_message(event, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+class ProgressStream:
+    # One server-sent event stream for a job: the job's events as they are
+    # published, a snapshot of its progress counters whenever they moved, and
+    # "end" once it is done. The counters are read from the job store, which also
+    # ends the stream for jobs run by another process, where no events arrive.
+    # The caller waits for events and hands each batch to step().
+    #
+    # With max_duration the stream ends after that many seconds even though the job
+    # goes on. EventSource reconnects by itself, with Last-Event-ID, so nothing is
+    # missed, and a server with a thread per stream gets the thread back meanwhile.
+
+    def __init__(self, bus, job_id, load_job, after=0, poll_interval=1.0, keepalive=15, max_duration=None):
+        self.bus = bus
+        self.job_id = job_id
+        self.load_job = load_job
+        self.after = after
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.max_duration = max_duration
+        self._started_at = time.monotonic()
+        self._progress = None
+        self._polled_at = None
+        self._sent_at = time.monotonic()
+
+    def step(self, events, closed):
+        # Returns (messages to send, whether the stream is finished)
+        messages = self._messages(events)
+        if closed:
+            return messages, True
+
+        now = time.monotonic()
+        if self._polled_at is None or now - self._polled_at >= self.poll_interval:
+            self._polled_at = now
+            job = self.load_job(self.job_id)
+            if job is None or job.status in (JOB_FINISHED, JOB_FAILED):
+                # Events published before the status changed still go out first
+                events, closed = self.bus.read(self.job_id, self.after)
+                messages += self._messages(events)
+                if not closed and job is not None:
+                    messages.append(sse_message("end", {
+                        "status": job.status, "error": job.error, "result": job.result
+                    }))
+                return messages, True
+            if job.progress != self._progress:
+                self._progress = job.progress
+                messages.append(sse_message("progress", dict(job.progress, status=job.status)))
+
+        if self.max_duration and now - self._started_at >= self.max_duration:
+            # How soon the browser should reconnect, in milliseconds
+            messages.append(f"retry: {RECONNECT_DELAY_MS}\n\n")
+            return messages, True
+        if messages:
+            self._sent_at = now
+        elif now - self._sent_at >= self.keepalive:
+            # A comment, keeps proxies from closing an idle connection
+            messages.append(": keepalive\n\n")
+            self._sent_at = now
+        return messages, False
+
+    def _messages(self, events):
+        messages = []
+        for event_id, event, data in events:
+            messages.append(sse_message(event, data, event_id))
+            self.after = event_id
+        return messages
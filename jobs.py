@@ -0,0 +1,547 @@
+import contextvars
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, deque
+
+from metrics import JOB_SECONDS
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_FINISHED = "finished"
+JOB_FAILED = "failed"
+JOB_PAUSED = "paused"
+ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING, JOB_PAUSED)
+
+# The JobContext of the job running in this thread, None inside requests
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class JobError(Exception):
+    pass
+
+
+class JobPaused(Exception):
+    # Raised inside a job that can't go on before `until`, e.g. when the YouTube quota
+    # is used up. The job goes back in the queue and keeps its checkpoints.
+    def __init__(self, until, reason):
+        super().__init__(reason)
+        self.until = until
+
+
+class Job:
+    def __init__(self, job_id, kind, params, status=JOB_QUEUED, progress=None,
+                 result=None, error=None, created_at=None, updated_at=None, owner=None, not_before=None):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        # Who the job runs for, the queue shares workers out fairly between owners
+        self.owner = owner
+        self.status = status
+        self.progress = progress or {}
+        self.result = result
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        # A paused job isn't claimed again before this time
+        self.not_before = not_before
+
+    def to_dict(self):
+        # params and owner are left out on purpose, they carry the session ID
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+
+def pick_fair(candidates, running, groups, limits):
+    # candidates are (job ID, kind, owner) oldest first, running is (kind, owner) of
+    # the jobs running now. A job whose group is at its limit waits. Of the rest the
+    # owner with the fewest jobs running goes first, the oldest job among equals,
+    # so one user with a long queue doesn't hold up everyone else. Paused jobs are
+    # in neither list, they hold no worker and are candidates again once due.
+    running_groups = Counter(groups.get(kind, kind) for kind, owner in running)
+    running_owners = Counter(owner for kind, owner in running)
+    best = None
+    for job_id, kind, owner in candidates:
+        group = groups.get(kind, kind)
+        if limits.get(group) and running_groups[group] >= limits[group]:
+            continue
+        if best is None or running_owners[owner] < running_owners[best[1]]:
+            best = (job_id, owner)
+    return best[0] if best else None
+
+
+class InMemoryJobStore:
+    def __init__(self):
+        self._jobs = {}
+        # Queued and paused jobs
+        self._pending = deque()
+        self._checkpoints = {}
+        self._cond = threading.Condition()
+
+    def add(self, job):
+        with self._cond:
+            self._jobs[job.id] = job
+            self._pending.append(job.id)
+            self._cond.notify()
+
+    def get(self, job_id):
+        # Copies, like claim(), the stored jobs are changed in place under the lock
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def find_active(self, kind, params):
+        with self._cond:
+            for job in self._jobs.values():
+                if job.kind == kind and job.params == params and job.status in ACTIVE_STATUSES:
+                    return copy.deepcopy(job)
+        return None
+
+    def count_active(self, owner):
+        with self._cond:
+            return sum(1 for job in self._jobs.values() if job.owner == owner and job.status in ACTIVE_STATUSES)
+
+    def update(self, job_id, **fields):
+        with self._cond:
+            job = self._jobs[job_id]
+            for key, value in fields.items():
+                setattr(job, key, copy.deepcopy(value))
+            job.updated_at = time.time()
+            if fields.get("status") == JOB_PAUSED and job_id not in self._pending:
+                self._pending.append(job_id)
+            if "status" in fields:
+                # A finished job can free a slot for a queued one held back by its limit
+                self._cond.notify_all()
+
+    def touch(self, job_ids):
+        pass
+
+    def save_checkpoint(self, job_id, key, value):
+        with self._cond:
+            self._checkpoints.setdefault(job_id, {})[key] = copy.deepcopy(value)
+
+    def load_checkpoints(self, job_id):
+        with self._cond:
+            return copy.deepcopy(self._checkpoints.get(job_id, {}))
+
+    def clear_checkpoints(self, job_id):
+        with self._cond:
+            self._checkpoints.pop(job_id, None)
+
+    def claim(self, timeout=1.0, groups=None, limits=None):
+        # groups maps a kind to its group, limits a group to how many of its jobs
+        # may run at once, see pick_fair()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job_id = self._pick(groups or {}, limits or {})
+                if job_id is not None:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self._pending.remove(job_id)
+            job = self._jobs[job_id]
+            job.status = JOB_RUNNING
+            job.updated_at = time.time()
+            return copy.deepcopy(job)
+
+    def _pick(self, groups, limits):
+        if not self._pending:
+            return None
+        now = time.time()
+        due = sorted(
+            (self._jobs[job_id] for job_id in self._pending),
+            key=lambda job: job.created_at
+        )
+        candidates = [(job.id, job.kind, job.owner) for job in due if not job.not_before or job.not_before <= now]
+        running = [(job.kind, job.owner) for job in self._jobs.values() if job.status == JOB_RUNNING]
+        return pick_fair(candidates, running, groups, limits)
+
+
+class SQLiteJobStore:
+    # Several processes can share one database. Workers keep touching the jobs they
+    # run, and a running job nobody touched for `lease` seconds belonged to a process
+    # that died, so it is claimed again and resumes from its checkpoints. Paused jobs
+    # wait in the table for their not_before time.
+    def __init__(self, path, lease=120):
+        self.path = path
+        self.lease = lease
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT,
+                not_before REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if "owner" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        if "not_before" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                job_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (job_id, key)
+            )
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _row_to_job(self, row):
+        return Job(
+            row[0], row[1], json.loads(row[2]),
+            status=row[3],
+            progress=json.loads(row[4]),
+            result=json.loads(row[5]) if row[5] is not None else None,
+            error=row[6],
+            created_at=row[7],
+            updated_at=row[8],
+            owner=row[9],
+            not_before=row[10]
+        )
+
+    def add(self, job):
+        self._conn().execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.id, job.kind, json.dumps(job.params), job.status, json.dumps(job.progress),
+             None, None, job.created_at, job.updated_at, job.owner, job.not_before)
+        )
+        self._wakeup.set()
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def find_active(self, kind, params):
+        row = self._conn().execute(
+            "SELECT * FROM jobs WHERE kind = ? AND params = ? AND status IN (?, ?, ?) ORDER BY created_at LIMIT 1",
+            (kind, json.dumps(params), *ACTIVE_STATUSES)
+        ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def count_active(self, owner):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE owner = ? AND status IN (?, ?, ?)", (owner, *ACTIVE_STATUSES)
+        ).fetchone()[0]
+
+    def update(self, job_id, **fields):
+        columns = []
+        values = []
+        for key, value in fields.items():
+            if key in ("progress", "result", "params"):
+                value = json.dumps(value)
+            columns.append(f"{key} = ?")
+            values.append(value)
+        columns.append("updated_at = ?")
+        values.append(time.time())
+        values.append(job_id)
+        self._conn().execute(f"UPDATE jobs SET {', '.join(columns)} WHERE id = ?", values)
+        if "status" in fields:
+            self._wakeup.set()
+
+    def touch(self, job_ids):
+        if job_ids:
+            self._conn().execute(
+                f"UPDATE jobs SET updated_at = ? WHERE id IN ({', '.join('?' * len(job_ids))})",
+                [time.time(), *job_ids]
+            )
+
+    def save_checkpoint(self, job_id, key, value):
+        self._conn().execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", (job_id, key, json.dumps(value)))
+
+    def load_checkpoints(self, job_id):
+        rows = self._conn().execute("SELECT key, value FROM checkpoints WHERE job_id = ?", (job_id,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def clear_checkpoints(self, job_id):
+        self._conn().execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+
+    def claim(self, timeout=1.0, groups=None, limits=None):
+        # The limits count the running jobs of every process sharing the database
+        conn = self._conn()
+        deadline = time.monotonic() + timeout
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                expired = now - self.lease
+                candidates = conn.execute(
+                    "SELECT id, kind, owner FROM jobs WHERE status = ? "
+                    "OR (status = ? AND COALESCE(not_before, 0) <= ?) OR (status = ? AND updated_at < ?) "
+                    "ORDER BY created_at",
+                    (JOB_QUEUED, JOB_PAUSED, now, JOB_RUNNING, expired)
+                ).fetchall()
+                running = conn.execute(
+                    "SELECT kind, owner FROM jobs WHERE status = ? AND updated_at >= ?",
+                    (JOB_RUNNING, expired)
+                ).fetchall() if candidates else []
+                job_id = pick_fair(candidates, running, groups or {}, limits or {})
+                row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone() if job_id else None
+                if row:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                        (JOB_RUNNING, time.time(), row[0])
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if row:
+                job = self._row_to_job(row)
+                job.status = JOB_RUNNING
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # Other processes may enqueue too, so poll instead of waiting forever
+            self._wakeup.wait(min(remaining, 0.5))
+            self._wakeup.clear()
+
+
+class JobContext:
+    def __init__(self, store, job, events=None):
+        self.store = store
+        self.job = job
+        self.events = events
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.job.id
+
+    def set_progress(self, **values):
+        with self._lock:
+            self.job.progress.update(values)
+            self.store.update(self.job.id, progress=self.job.progress)
+
+    def track_progress(self, key, data=None):
+        # Per-item progress for work in flight, dropped again once the item is done
+        with self._lock:
+            active = self.job.progress.setdefault("active", {})
+            if data is None:
+                active.pop(key, None)
+            else:
+                active[key] = data
+            self.store.update(self.job.id, progress=self.job.progress)
+
+    def increment(self, **counts):
+        with self._lock:
+            for key, amount in counts.items():
+                self.job.progress[key] = self.job.progress.get(key, 0) + amount
+            self.store.update(self.job.id, progress=self.job.progress)
+
+    def emit(self, event, **data):
+        # A per-track event for anyone following the job live, see events.EventBus
+        if self.events is not None:
+            self.events.publish(self.job.id, event, **data)
+
+    def checkpoint(self, key, value):
+        # Written as soon as a piece of work is done. A job that is run again after
+        # its worker died reads them back with checkpoints() and skips that work.
+        self.store.save_checkpoint(self.job.id, key, value)
+
+    def checkpoints(self):
+        return self.store.load_checkpoints(self.job.id)
+
+    def pause(self, until, reason):
+        # Called by JobQueue.run() for a JobPaused, the worker is free again after it
+        with self._lock:
+            self.job.progress.update(paused_until=until, paused_reason=reason)
+            self.store.update(self.job.id, status=JOB_PAUSED, not_before=until, progress=self.job.progress)
+        self.emit("status", status=JOB_PAUSED, until=until)
+
+    def resume(self):
+        with self._lock:
+            self.job.progress.pop("paused_until", None)
+            self.job.progress.pop("paused_reason", None)
+            self.store.update(self.job.id, progress=self.job.progress)
+
+
+class NullJobContext:
+    # Stands in for a JobContext when work runs inside a request instead of a job
+    id = None
+
+    def set_progress(self, **values):
+        pass
+
+    def track_progress(self, key, data=None):
+        pass
+
+    def increment(self, **counts):
+        pass
+
+    def emit(self, event, **data):
+        pass
+
+    def checkpoint(self, key, value):
+        pass
+
+    def checkpoints(self):
+        return {}
+
+
+class JobQueue:
+    def __init__(self, store, workers=2, heartbeat_interval=30, events=None, limits=None):
+        self.store = store
+        self.events = events
+        self.workers = workers
+        self.heartbeat_interval = heartbeat_interval
+        self.handlers = {}
+        # How many jobs of a group may run at once, 0 or missing for no limit
+        self.limits = limits or {}
+        self.groups = {}
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._threads = []
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._enqueue_lock = threading.Lock()
+
+    def handler(self, kind, group=None):
+        # Kinds in the same group share its limit, a kind is its own group by default
+        def decorator(func):
+            self.handlers[kind] = func
+            self.groups[kind] = group or kind
+            return func
+        return decorator
+
+    def enqueue(self, kind, params, unique=False, owner=None, admit=None):
+        # With unique, a job of the same kind and params that hasn't finished yet is
+        # returned instead of starting the same work twice, e.g. when a page is reloaded.
+        # admit(kind, owner) is called only when a new job would be added and can
+        # raise to refuse it.
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'")
+        with self._enqueue_lock:
+            existing = self.store.find_active(kind, params) if unique else None
+            if existing is not None:
+                return existing.id
+            if admit is not None:
+                admit(kind, owner)
+            job = Job(uuid.uuid4().hex, kind, params, owner=owner)
+            self.store.add(job)
+        self.start()
+        return job.id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def is_active(self, job_id):
+        job = self.store.get(job_id)
+        return job is not None and job.status in ACTIVE_STATUSES
+
+    def start(self):
+        # Threads don't survive a fork, so gunicorn workers start their own pool lazily
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _heartbeat(self):
+        # Tells other processes the running jobs are still alive, see SQLiteJobStore
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._running_lock:
+                job_ids = list(self._running)
+            try:
+                self.store.touch(job_ids)
+            except Exception as e:
+                print(f"Error updating job heartbeat: {str(e)}")
+
+    def _work(self):
+        while True:
+            job = self.store.claim(timeout=1.0, groups=self.groups, limits=self.limits)
+            if job is None:
+                continue
+            self.run(job)
+
+    def run(self, job):
+        handler = self.handlers.get(job.kind)
+        context = JobContext(self.store, job, self.events)
+        token = current_job.set(context)
+        with self._running_lock:
+            self._running.add(job.id)
+        start = time.perf_counter()
+        status = JOB_FAILED
+        result = error = None
+        context.emit("status", status=JOB_RUNNING)
+        if "paused_until" in job.progress:
+            context.resume()
+        try:
+            if handler is None:
+                raise JobError(f"No handler registered for job kind '{job.kind}'")
+            result = handler(job.params, context)
+            self.store.update(job.id, status=JOB_FINISHED, result=result)
+            status = JOB_FINISHED
+        except JobPaused as e:
+            # Claimed again once due, by this process or another, and carries on
+            # from its checkpoints
+            status = JOB_PAUSED
+            context.pause(e.until, str(e))
+        except JobError as e:
+            error = str(e)
+            self.store.update(job.id, status=JOB_FAILED, error=error)
+        except Exception as e:
+            traceback.print_exc()
+            error = f"Unexpected error: {e}"
+            self.store.update(job.id, status=JOB_FAILED, error=error)
+        finally:
+            # Finished or failed for good, only a dead worker leaves checkpoints behind
+            if status != JOB_PAUSED:
+                self.store.clear_checkpoints(job.id)
+                if self.events is not None:
+                    self.events.close(job.id, "end", status=status, error=error, result=result)
+            with self._running_lock:
+                self._running.discard(job.id)
+            current_job.reset(token)
+            JOB_SECONDS.observe(time.perf_counter() - start, kind=job.kind, status=status)
+
+
+def make_job_store(backend, path=None, lease=120):
+    if backend == "memory":
+        return InMemoryJobStore()
+    if backend == "sqlite":
+        return SQLiteJobStore(path or "tunevert_jobs.db", lease)
+    raise ValueError(f"Unknown job backend '{backend}'")
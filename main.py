@@ -1,27 +1,89 @@
+import cProfile
+import functools
+import io
+import itertools
+import math
+import mimetypes
 import os
-import requests
+import pstats
+import shutil
+import tempfile
+import threading
 import urllib.parse
 import time
+import types
+import uuid
 import zipfile
-import yt_dlp
-from datetime import datetime
-from flask import Flask, redirect, request, jsonify, session, url_for, send_from_directory
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timezone
+from audio_store import AudioStore
+from events import EventBus, ProgressStream
+from downloader import AUDIO_PROFILES, DEFAULT_AUDIO_PROFILE, WATCH_URL, DownloadEngine
+from flask import Flask, Response, abort, g, redirect, request, jsonify, session, url_for, send_from_directory
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 from urllib.parse import quote
 from googleapiclient.errors import HttpError
+from werkzeug.security import safe_join
+from yt_dlp.utils import sanitize_filename
+from jobs import JOB_FAILED, JOB_FINISHED, JobError, JobQueue, NullJobContext, make_job_store
+from match_cache import SPOTIFY_QUERY, SPOTIFY_TRACK, YOUTUBE_TITLE, YOUTUBE_VIDEO, MatchCache, normalize_key
+from metrics import (
+    ADMISSION_REFUSALS, BACKOFF_SECONDS, MATCH_SECONDS, REGISTRY, REQUEST_SECONDS, UPSTREAM_RETRIES, ZIP_SECONDS,
+    CallbackMetric
+)
+from matcher import best_match, clean_title, match_concurrently, spotify_track_key, youtube_video_key
+from quota import QuotaExceeded, QuotaLedger
+from ratelimit import ConcurrencyLimit, RateLimited, RateLimiter, TokenBucket
+from storage import StorageFull, StorageManager
+from response_cache import ResponseCache, etag_for
+from youtube_client import (
+    delete_playlist_items, execute_conditional, get_service, get_videos, insert_items, parse_duration,
+    playlist_item_insert, use_api_root, use_quota_ledger, youtube_error_reason
+)
+from youtube_client import is_retryable as is_youtube_retryable
+from zipstream import stream_zip
+from spotify_client import (
+    PLAYLIST_TRACKS_PER_PAGE, SPOTIFY_API_BASE_URL, BearerAuth, SpotifyClient, SpotifyError, backoff_delay, error_message
+)
+from sync import PlaylistLink, SyncStore, diff_items, items_version
+from token_store import TokenRevoked, TokenStore, make_token_backend
 
 app = Flask(__name__)
 app.secret_key = "dingtone"
 
+#INSTRUMENTATION
+# Requests sent with "X-Tunevert-Profile: <token>" come back as a cProfile report
+PROFILE_TOKEN = os.getenv('TUNEVERT_PROFILE_TOKEN')
+
+#RESPONSE CACHE
+PAGE_CACHE_TTL = int(os.getenv('TUNEVERT_PAGE_CACHE_TTL', '60'))
+page_cache = ResponseCache(PAGE_CACHE_TTL, int(os.getenv('TUNEVERT_PAGE_CACHE_ENTRIES', '2000')))
+# Track listings are streamed as they are fetched and only cached up to this size
+STREAMED_PAGE_CACHE_BYTES = int(os.getenv('TUNEVERT_STREAMED_PAGE_CACHE_BYTES', str(1024 * 1024)))
+# Upstream bodies are kept longer, they are only reused after the API confirms them with a 304
+upstream_cache = ResponseCache(
+    float(os.getenv('TUNEVERT_UPSTREAM_CACHE_TTL_HOURS', '24')) * 3600,
+    int(os.getenv('TUNEVERT_UPSTREAM_CACHE_ENTRIES', '5000'))
+)
+
 #SPOTIFY OAUTH CREDS
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = os.getenv('SPOTIFY_REDIRECT_URI')
-SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
-SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1/"
+# The API hosts can be pointed at a local stand-in, see benchmarks/mock_upstream.py
+SPOTIFY_API_URL = os.getenv('TUNEVERT_SPOTIFY_API_URL', SPOTIFY_API_BASE_URL)
+SPOTIFY_ACCOUNTS_URL = os.getenv('TUNEVERT_SPOTIFY_ACCOUNTS_URL', "https://accounts.spotify.com")
+SPOTIFY_AUTH_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
+SPOTIFY_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+spotify = SpotifyClient(
+    base_url=SPOTIFY_API_URL,
+    pool_size=int(os.getenv('TUNEVERT_SPOTIFY_POOL_SIZE', '32')),
+    max_retries=int(os.getenv('TUNEVERT_SPOTIFY_MAX_RETRIES', '5')),
+    etag_cache=upstream_cache
+)
 
 #GOOGLE OAUTH CREDS
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
@@ -33,6 +95,118 @@ SCOPES = [
     'https://www.googleapis.com/auth/youtube.readonly',
     'https://www.googleapis.com/auth/youtube.force-ssl'
 ]
+YOUTUBE_API_URL = os.getenv('TUNEVERT_YOUTUBE_API_URL')
+if YOUTUBE_API_URL:
+    use_api_root(YOUTUBE_API_URL)
+
+#YOUTUBE QUOTA
+quota_ledger = QuotaLedger(
+    os.getenv('TUNEVERT_QUOTA_DB', 'tunevert_quota.db'),
+    daily_budget=int(os.getenv('TUNEVERT_YOUTUBE_DAILY_QUOTA', '10000')),
+    reserve=int(os.getenv('TUNEVERT_YOUTUBE_QUOTA_RESERVE', '500')),
+    user_budget=int(os.getenv('TUNEVERT_YOUTUBE_USER_QUOTA', '0'))
+)
+use_quota_ledger(quota_ledger)
+
+#ADMISSION CONTROL
+# Copies and downloads started per minute, per user and in total, with the burst
+# allowed on top. 0 turns a limit off.
+job_start_limiter = RateLimiter(
+    float(os.getenv('TUNEVERT_JOB_RATE_PER_USER', '6')) / 60,
+    int(os.getenv('TUNEVERT_JOB_BURST_PER_USER', '3')),
+    float(os.getenv('TUNEVERT_JOB_RATE_GLOBAL', '60')) / 60,
+    int(os.getenv('TUNEVERT_JOB_BURST_GLOBAL', '20'))
+)
+# Jobs one user can have queued or running at once
+MAX_ACTIVE_JOBS_PER_USER = int(os.getenv('TUNEVERT_MAX_ACTIVE_JOBS_PER_USER', '5'))
+# Jobs of a group that run at once, across every process sharing the job database
+JOB_LIMITS = {
+    "copy": int(os.getenv('TUNEVERT_MAX_CONCURRENT_COPIES', '4')),
+    "download": int(os.getenv('TUNEVERT_MAX_CONCURRENT_DOWNLOADS', '2'))
+}
+# ?stream=1 downloads run inside the request, this process only
+streaming_downloads = ConcurrencyLimit(int(os.getenv('TUNEVERT_MAX_STREAMING_DOWNLOADS', '2')))
+# Retry-After for refusals that wait on other work finishing rather than on a rate
+ADMISSION_RETRY_AFTER = int(os.getenv('TUNEVERT_ADMISSION_RETRY_AFTER', '30'))
+
+#BACKGROUND JOBS
+# 'memory' keeps jobs in this process only, a job started on one gunicorn worker
+# could not be polled on another
+JOB_BACKEND = os.getenv('TUNEVERT_JOB_BACKEND', 'sqlite')
+JOB_DB_PATH = os.getenv('TUNEVERT_JOB_DB', 'tunevert_jobs.db')
+JOB_WORKERS = int(os.getenv('TUNEVERT_JOB_WORKERS', '2'))
+# A job whose worker stopped checking in for this long is picked up by another one
+JOB_LEASE = int(os.getenv('TUNEVERT_JOB_LEASE', '120'))
+# Per-track events behind /progress/<job_id>, kept for late and reconnecting viewers
+progress_events = EventBus(
+    history=int(os.getenv('TUNEVERT_PROGRESS_HISTORY', '1000')),
+    ttl=int(os.getenv('TUNEVERT_PROGRESS_TTL', '600'))
+)
+SSE_KEEPALIVE = int(os.getenv('TUNEVERT_SSE_KEEPALIVE', '15'))
+# A /progress stream served by a gunicorn thread ends after this many seconds and
+# the browser reconnects, so slow jobs don't tie up the worker's threads. 0 for no limit.
+SSE_MAX_DURATION = int(os.getenv('TUNEVERT_SSE_MAX_DURATION', '30'))
+job_queue = JobQueue(
+    make_job_store(JOB_BACKEND, JOB_DB_PATH, lease=JOB_LEASE), workers=JOB_WORKERS, heartbeat_interval=JOB_LEASE / 4,
+    events=progress_events, limits=JOB_LIMITS
+)
+
+#TRACK MATCHING
+MATCH_CONCURRENCY = int(os.getenv('TUNEVERT_MATCH_CONCURRENCY', '8'))
+MATCH_CANDIDATES = int(os.getenv('TUNEVERT_MATCH_CANDIDATES', '5'))
+MATCH_MIN_CONFIDENCE = float(os.getenv('TUNEVERT_MATCH_MIN_CONFIDENCE', '0.4'))
+MATCH_REVIEW_CONFIDENCE = float(os.getenv('TUNEVERT_MATCH_REVIEW_CONFIDENCE', '0.6'))
+spotify_search_limiter = TokenBucket(float(os.getenv('TUNEVERT_SPOTIFY_SEARCH_RATE', '20')))
+youtube_search_limiter = TokenBucket(float(os.getenv('TUNEVERT_YOUTUBE_SEARCH_RATE', '10')))
+#DOWNLOADS
+DOWNLOAD_WORKERS = int(os.getenv('TUNEVERT_DOWNLOAD_WORKERS', '4'))
+TRANSCODE_WORKERS = int(os.getenv('TUNEVERT_TRANSCODE_WORKERS', str(os.cpu_count() or 1)))
+# One of downloader.AUDIO_PROFILES, a download can pick another with ?profile=
+AUDIO_PROFILE = os.getenv('TUNEVERT_AUDIO_PROFILE', DEFAULT_AUDIO_PROFILE)
+if AUDIO_PROFILE not in AUDIO_PROFILES:
+    raise ValueError(f"Unknown audio profile '{AUDIO_PROFILE}'")
+# Where yt-dlp fetches a video from, {video_id} is filled in
+YOUTUBE_WATCH_URL = os.getenv('TUNEVERT_YOUTUBE_WATCH_URL', WATCH_URL)
+# Finished tracks are kept here and linked into playlist folders, keep it on the same filesystem
+audio_store = AudioStore(
+    os.getenv('TUNEVERT_AUDIO_STORE_DIR', os.path.expanduser("~/Downloads/.tunevert-audio")),
+    max_bytes=int(float(os.getenv('TUNEVERT_AUDIO_STORE_MAX_GB', '10')) * 1024 ** 3)
+)
+
+#DOWNLOAD STORAGE
+# Playlist folders and ZIPs left for users to fetch from /downloads/<job_id>/<filename>,
+# only by the session that started the download. They go TTL hours after they were last fetched, or earlier when the total is over the
+# quota. 0 turns either off.
+storage = StorageManager(
+    os.getenv('TUNEVERT_DOWNLOADS_DIR', os.path.expanduser("~/Downloads")),
+    max_bytes=int(float(os.getenv('TUNEVERT_DOWNLOADS_MAX_GB', '20')) * 1024 ** 3),
+    ttl=float(os.getenv('TUNEVERT_DOWNLOADS_TTL_HOURS', '24')) * 3600,
+    min_free_bytes=int(float(os.getenv('TUNEVERT_DOWNLOADS_MIN_FREE_GB', '1')) * 1024 ** 3),
+    is_active=job_queue.is_active,
+    sweep_interval=int(os.getenv('TUNEVERT_DOWNLOADS_SWEEP_INTERVAL', '300'))
+)
+# Used to size a download before it starts, a track is kept in the audio store and in the ZIP
+ESTIMATED_TRACK_SECONDS = int(os.getenv('TUNEVERT_ESTIMATED_TRACK_SECONDS', '240'))
+# With nginx in front, /downloads/ answers with an X-Accel-Redirect to this internal
+# location and nginx sends the file itself
+DOWNLOADS_ACCEL_REDIRECT = os.getenv('TUNEVERT_DOWNLOADS_ACCEL_REDIRECT')
+
+#PLAYLIST SYNC
+sync_store = SyncStore(os.getenv('TUNEVERT_SYNC_DB', 'tunevert_sync.db'))
+
+#TOKEN STORE
+# 'memory' keeps tokens in this process only, gunicorn workers would each see
+# different logins
+TOKEN_BACKEND = os.getenv('TUNEVERT_TOKEN_BACKEND', 'sqlite')
+TOKEN_DB_PATH = os.getenv('TUNEVERT_TOKEN_DB', 'tunevert_tokens.db')
+TOKEN_REFRESH_MARGIN = int(os.getenv('TUNEVERT_TOKEN_REFRESH_MARGIN', '300'))
+
+match_cache = MatchCache(
+    os.getenv('TUNEVERT_MATCH_CACHE_DB', 'tunevert_matches.db'),
+    ttl=float(os.getenv('TUNEVERT_MATCH_CACHE_TTL_DAYS', '30')) * 24 * 3600,
+    max_entries=int(os.getenv('TUNEVERT_MATCH_CACHE_MAX_ENTRIES', '200000')),
+    memory_entries=int(os.getenv('TUNEVERT_MATCH_CACHE_MEMORY_ENTRIES', '10000'))
+)
 
 @app.route("/")
 def index():
@@ -41,8 +215,8 @@ def index():
     <img src="/static/tunevert.png" alt="Playlist App Image" style="width:200px;height:auto;">
     '''
 
-    spotify_logged_in = 'access_token' in session
-    youtube_logged_in = 'google_credentials' in session
+    spotify_logged_in = is_spotify_logged_in()
+    youtube_logged_in = is_google_logged_in()
 
     if spotify_logged_in:
         spotify_user_name = session.get('spotify_user_name', 'Spotify User')
@@ -84,6 +258,109 @@ def index():
 
     return html
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if PROFILE_TOKEN and request.headers.get('X-Tunevert-Profile') == PROFILE_TOKEN:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=route, method=request.method,
+                                status=response.status_code)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        # Streamed bodies are only profiled up to the point the view returned
+        profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(40)
+        return Response(report.getvalue(), status=response.status_code, mimetype="text/plain")
+    return response
+
+def timed_match(direction):
+    # Records how long one track took to match, split by cache hits and searches
+    def decorator(find):
+        @functools.wraps(find)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            match, confidence = find(*args, **kwargs)
+            source = "cache" if match and confidence is None else "search"
+            MATCH_SECONDS.observe(time.perf_counter() - start, direction=direction, source=source)
+            return match, confidence
+        return wrapper
+    return decorator
+
+def cached_page(view):
+    # Serves repeat views of a listing page from memory for PAGE_CACHE_TTL seconds,
+    # per session, and answers If-None-Match from the browser with a 304.
+    # ?refresh=1 renders the page again. A view can return a generator of HTML
+    # chunks, which is sent as it is produced. ?page_token= requests are JSON.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        session_id = session.get('sid')
+        if session_id is None or 'page_token' in request.args:
+            body = view(*args, **kwargs)
+            return streamed_page_response(body) if isinstance(body, types.GeneratorType) else body
+
+        key = request.path
+        page = None if request.args.get('refresh') else page_cache.get(session_id, key)
+        if page is None:
+            body = view(*args, **kwargs)
+            if isinstance(body, types.GeneratorType):
+                return streamed_page_response(body, session_id, key)
+            if not isinstance(body, str):
+                return body
+            if g.get('skip_page_cache'):
+                return body
+            page = (body, etag_for(body))
+            page_cache.set(session_id, key, page)
+
+        response = Response(page[0], mimetype="text/html")
+        response.set_etag(page[1])
+        response.cache_control.private = True
+        response.cache_control.max_age = PAGE_CACHE_TTL
+        return response.make_conditional(request)
+    return wrapper
+
+def skip_page_cache():
+    # Error pages are sent once and not cached
+    g.skip_page_cache = True
+
+def streamed_page_response(chunks, session_id=None, key=None):
+    # No ETag, the body isn't known yet. Proxies must pass the chunks on as they come.
+    response = Response(stream_page(chunks, session_id, key), mimetype="text/html", headers={"X-Accel-Buffering": "no"})
+    response.cache_control.private = True
+    return response
+
+def stream_page(chunks, session_id=None, key=None):
+    # Passes a streamed page through. With a session the complete page is cached,
+    # unless it got bigger than STREAMED_PAGE_CACHE_BYTES or ended in an error.
+    kept = [] if session_id is not None else None
+    size = 0
+    try:
+        for chunk in chunks:
+            yield chunk
+            if kept is not None:
+                kept.append(chunk)
+                size += len(chunk)
+                if size > STREAMED_PAGE_CACHE_BYTES:
+                    kept = None
+    except Exception as e:
+        yield streamed_page_error(e)
+        return
+    if kept is not None:
+        body = "".join(kept)
+        page_cache.set(session_id, key, (body, etag_for(body)))
+
+def streamed_page_error(e):
+    # The status line is long gone when a later page fails, the error ends the page instead
+    print(f"Error streaming page: {str(e)}")
+    return f"<br><br>Error: Unable to fetch the rest of the playlist. {e}<br><a href=\"/playlists\">Back to Playlists</a>"
+
 #logins and auths
 @app.route("/login-spotify")
 def login_spotify():
@@ -135,15 +412,21 @@ def callback_spotify():
             "client_secret": SPOTIFY_CLIENT_SECRET,
             "redirect_uri": SPOTIFY_REDIRECT_URI
         }
-        response = requests.post(SPOTIFY_TOKEN_URL, data=req_body)
+        response = spotify.post(SPOTIFY_TOKEN_URL, data=req_body)
+        # An error may come as an HTML page, so only a 200 is read as JSON
+        if response.status_code != 200:
+            return jsonify({"error": error_message(response)})
         token_info = response.json()
 
-        session["access_token"] = token_info["access_token"]
-        session["refresh_token"] = token_info["refresh_token"]
-        session["expires_at"] = datetime.now().timestamp() + token_info["expires_in"]
+        session_id = current_session_id()
+        page_cache.invalidate(session_id)
+        token_store.save(session_id, "spotify", {
+            "access_token": token_info["access_token"],
+            "refresh_token": token_info["refresh_token"],
+            "expires_at": time.time() + token_info["expires_in"]
+        })
 
-        headers = {"Authorization": f"Bearer {session['access_token']}"}
-        spotify_profile = get_user_profile(headers)
+        spotify_profile = get_user_profile(spotify_auth_for(session_id))
         if spotify_profile:
             session["spotify_user_name"] = spotify_profile.get("display_name", "Spotify User")
 
@@ -170,7 +453,11 @@ def callback_google():
     flow.fetch_token(authorization_response=request.url)
 
     credentials = flow.credentials
-    session['google_credentials'] = credentials_to_dict(credentials)
+    page_cache.invalidate(current_session_id())
+    token_store.save(current_session_id(), "google", {
+        "credentials": credentials_to_dict(credentials),
+        "expires_at": expiry_timestamp(credentials.expiry)
+    })
 
     youtube = get_youtube_service()
     channel_request = youtube.channels().list(part="snippet", mine=True)
@@ -183,136 +470,257 @@ def callback_google():
 
 # Playlists and tracks
 @app.route("/playlists")
+@cached_page
 def get_playlists():
+    spotify_listing = None
+    redirect_response, spotify_auth = check_session_and_get_auth()
+    if not redirect_response:
+        spotify_profile = get_user_profile(spotify_auth)
+        playlists = []
+        try:
+            for element in spotify.iter_user_playlists(spotify_auth):
+                playlists.append((element['id'], element['name']))
+            spotify_listing = (spotify_profile and spotify_profile['display_name'], playlists, None)
+        except SpotifyError as e:
+            skip_page_cache()
+            spotify_listing = (spotify_profile and spotify_profile['display_name'], playlists, e.message)
+
+    youtube_listing = None
+    google_credentials = session_google_credentials()
+    if google_credentials:
+        youtube = get_service(google_credentials)
+        channel_request = youtube.channels().list(part="snippet", mine=True)
+        channel_response = execute_conditional(channel_request, upstream_cache, session['sid'])
+        playlist_request = youtube.playlists().list(part="snippet", mine=True, maxResults=50)
+        try:
+            playlist_response = youtube_request_with_backoff(playlist_request, cache_scope=session['sid'])
+            youtube_listing = (youtube_channel_title(channel_response), youtube_playlists(playlist_response), None)
+        except HttpError as e:
+            skip_page_cache()
+            youtube_listing = (youtube_channel_title(channel_response), [], str(e))
+
+    return playlists_page(spotify_listing, youtube_listing)
+
+def youtube_channel_title(channel_response):
+    if 'items' in channel_response and channel_response['items']:
+        return channel_response['items'][0]['snippet']['title']
+    return None
+
+def youtube_playlists(playlist_response):
+    return [(item['id'], item['snippet']['title']) for item in playlist_response.get('items', [])]
+
+def playlists_page(spotify_listing, youtube_listing):
+    # A listing is (account name, [(playlist_id, playlist_name)], error message),
+    # None when the user is not logged in to that platform. Shared with asgi.py.
     result = []
 
     result.append('<a href="/">Back to Home</a>')
     result.append('<h1>Your Playlists</h1>')
     result.append('<p style="color: red;"><strong>Not seeing your playlists? Please check that they are added to your public profiles on each platform!</strong></p>')
 
-    redirect_response, spotify_headers = check_session_and_get_headers()
-    if not redirect_response:
-        spotify_profile = get_user_profile(spotify_headers)
-        if spotify_profile:
-            result.append(f"<h2>Spotify login: {spotify_profile['display_name']}</h2>")
-        
-        response = requests.get(SPOTIFY_API_BASE_URL + "me/playlists", headers=spotify_headers)
-        playlists = response.json()
-        
-        for element in playlists["items"]:
-            playlist_name = element['name']
-            playlist_id = element['id']
-            playlist_link = f'<a href="/tracks/{playlist_id}/{playlist_name}">{playlist_name}</a>'
-            result.append(playlist_link)
+    if spotify_listing:
+        display_name, playlists, error = spotify_listing
+        if display_name:
+            result.append(f"<h2>Spotify login: {display_name}</h2>")
+        for playlist_id, playlist_name in playlists:
+            result.append(f'<a href="/tracks/{playlist_id}/{playlist_name}">{playlist_name}</a>')
+        if error:
+            result.append(f"Error fetching Spotify playlists: {error}")
     else:
         result.append("<p>You are not logged into Spotify.</p>")
 
-    # Check Google login
-    if 'google_credentials' in session:
-        google_credentials = Credentials(**session['google_credentials'])
-        youtube = build('youtube', 'v3', credentials=google_credentials)
-        channel_request = youtube.channels().list(part="snippet", mine=True)
-        channel_response = channel_request.execute()
-        if 'items' in channel_response and channel_response['items']:
-            channel = channel_response['items'][0]['snippet']
-            result.append(f"<h2>YouTube login: {channel['title']}</h2>")
-        
-        playlist_request = youtube.playlists().list(part="snippet", mine=True, maxResults=50)
-        try:
-            playlist_response = youtube_request_with_backoff(playlist_request)
-            for item in playlist_response.get('items', []):
-                playlist_name = item['snippet']['title']
-                playlist_id = item['id']
-                playlist_link = f'<a href="/youtube-tracks/{playlist_id}/{playlist_name}">{playlist_name}</a>'
-                result.append(playlist_link)
-        except HttpError as e:
-            result.append(f"Error fetching YouTube playlists: {str(e)}")
+    if youtube_listing:
+        channel, playlists, error = youtube_listing
+        if channel:
+            result.append(f"<h2>YouTube login: {channel}</h2>")
+        for playlist_id, playlist_name in playlists:
+            result.append(f'<a href="/youtube-tracks/{playlist_id}/{playlist_name}">{playlist_name}</a>')
+        if error:
+            result.append(f"Error fetching YouTube playlists: {error}")
     else:
         result.append("<p>You are not logged into Google.</p>")
 
-    if redirect_response and 'google_credentials' not in session:
+    if not spotify_listing and not youtube_listing:
         result.append("<p>You are not logged into Spotify or Google.</p>")
-    
-    s = '<br>'.join(result)
 
-    return s
+    return '<br>'.join(result)
 
 
 @app.route("/tracks/<playlist_id>/<playlist_name>")
+@cached_page
 def get_tracks(playlist_id, playlist_name):
-    redirect_response, headers = check_session_and_get_headers()
+    redirect_response, auth = check_session_and_get_auth()
     if redirect_response:
         return redirect_response
 
-    response = requests.get(f"{SPOTIFY_API_BASE_URL}playlists/{playlist_id}/tracks", headers=headers)
-    if response.status_code != 200:
-        return f"Error: Unable to fetch tracks. Status code: {response.status_code}"
-    tracks = response.json()
+    if 'page_token' in request.args:
+        return spotify_tracks_json(playlist_id, auth, request.args['page_token'])
 
+    # The first page is fetched before anything is sent, so a playlist that can't
+    # be read still gets its own error page. The rest follows as it arrives.
+    pages = spotify.playlist_track_pages(playlist_id, auth)
+    try:
+        first_page = next(pages)
+    except SpotifyError as e:
+        skip_page_cache()
+        return f"Error: Unable to fetch tracks. Status code: {e.status_code}"
+
+    return tracks_page(playlist_id, playlist_name, itertools.chain([first_page], pages))
+
+def tracks_page(playlist_id, playlist_name, pages):
+    # Yields the page in chunks, one per page of playlist tracks
+    yield tracks_header(playlist_name)
+    separator = ""
+    for page in pages:
+        if page['items']:
+            yield separator + spotify_track_rows(element['track'] for element in page['items'])
+            separator = "<br>"
+    yield track_listing_links("spotify", "download-playlist", playlist_id, playlist_name)
+
+def tracks_header(playlist_name):
+    return f"<h2>Tracks in playlist {playlist_name}</h2>"
+
+def spotify_track_rows(tracks):
+    # Shared with asgi.py
     result = []
-    for element in tracks['items']:
-        track = element['track']
+    for track in tracks:
         track_name = track['name']
         artists = ", ".join([artist['name'] for artist in track['artists']])
         result.append(f"{track_name} - {artists}")
+    return "<br>".join(result)
 
-    tracks_string = "<br>".join(result)
-
-    copy_link = f'<br><br><a href="/copy-playlist/spotify/{playlist_id}/{playlist_name}">Copy Playlist</a>'
-    download_link = f'<br><a href="/download-playlist/{playlist_id}/{playlist_name}">Download Playlist</a>'
+def track_listing_links(source_platform, download_route, playlist_id, playlist_name):
+    copy_link = f'<br><br><a href="/copy-playlist/{source_platform}/{playlist_id}/{playlist_name}">Copy Playlist</a>'
+    download_link = f'<br><a href="/{download_route}/{playlist_id}/{playlist_name}">Download Playlist</a>'
+    stream_link = f'<br><a href="/{download_route}/{playlist_id}/{playlist_name}?stream=1">Download Playlist (streaming ZIP)</a>'
     back_link = '<br><a href="/playlists">Back to Playlists</a>'
-    
-    return f"<h2>Tracks in playlist {playlist_name}</h2>{tracks_string}{copy_link}{download_link}{back_link}"
+    return copy_link + download_link + stream_link + back_link
+
+def spotify_tracks_json(playlist_id, auth, page_token):
+    # One page of tracks for clients that render as they go. The cursor is the
+    # offset of the page, pass next_page_token back until it is null.
+    try:
+        offset = int(page_token or 0)
+    except ValueError:
+        return jsonify({"error": "Invalid page_token"}), 400
+    try:
+        page = spotify.playlist_track_page(playlist_id, auth, offset)
+    except SpotifyError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return jsonify({
+        "tracks": [{
+            "id": element['track']['id'],
+            "uri": element['track']['uri'],
+            "name": element['track']['name'],
+            "artists": [artist['name'] for artist in element['track']['artists']],
+            "duration_ms": element['track'].get('duration_ms')
+        } for element in page['items']],
+        "total": page.get('total'),
+        "next_page_token": str(offset + PLAYLIST_TRACKS_PER_PAGE) if page.get('next') else None
+    })
 
 @app.route("/youtube-tracks/<playlist_id>/<playlist_name>")
+@cached_page
 def get_youtube_tracks(playlist_id, playlist_name):
-    if 'google_credentials' not in session:
+    google_credentials = session_google_credentials()
+    if not google_credentials:
         return redirect("/login-google")
 
-    google_credentials = Credentials(**session['google_credentials'])
-    youtube = build('youtube', 'v3', credentials=google_credentials)
+    youtube = get_service(google_credentials)
+    session_id = session['sid']
+    if 'page_token' in request.args:
+        return youtube_tracks_json(youtube, session_id, playlist_id, request.args['page_token'])
 
-    result = [f"<h2>Tracks in YouTube playlist: {playlist_name}</h2>"]
+    # As on the Spotify page, only the first page is fetched before sending starts
+    try:
+        first_page = youtube_playlist_page(youtube, session_id, playlist_id)
+    except HttpError as e:
+        skip_page_cache()
+        return f"Error: Unable to fetch tracks. Status code: {e.resp.status}"
+    pages = youtube_playlist_pages(youtube, session_id, playlist_id, first_page)
+    return youtube_tracks_page(playlist_id, playlist_name, pages)
+
+def youtube_playlist_page(youtube, session_id, playlist_id, page_token=None):
+    # (playlistItems response, {video_id: video}) for one page of a playlist
+    items_request = youtube.playlistItems().list(
+        part="snippet",
+        playlistId=playlist_id,
+        maxResults=50,
+        pageToken=page_token
+    )
+    response = execute_conditional(items_request, upstream_cache, session_id)
+    videos = get_videos(youtube, [item['snippet']['resourceId']['videoId'] for item in response['items']])
+    return response, videos
 
-    next_page_token = None
-    video_ids = []
+def youtube_playlist_pages(youtube, session_id, playlist_id, first_page):
+    page = first_page
     while True:
-        request = youtube.playlistItems().list(
-            part="snippet",
-            playlistId=playlist_id,
-            maxResults=50,
-            pageToken=next_page_token
-        )
-        response = request.execute()
+        yield page
+        next_page_token = page[0].get('nextPageToken')
+        if not next_page_token:
+            return
+        page = youtube_playlist_page(youtube, session_id, playlist_id, next_page_token)
 
-        for item in response['items']:
-            video_title = item['snippet']['title']
-            video_id = item['snippet']['resourceId']['videoId']
-            channel_title = item['snippet']['videoOwnerChannelTitle']
-            track_link = f'<a href="https://www.youtube.com/watch?v={video_id}" target="_blank">{video_title}</a>'
-            result.append(f"{track_link} - {channel_title}")
-            video_ids.append(video_id)
+def youtube_tracks_page(playlist_id, playlist_name, pages):
+    # Yields the page in chunks, one per page of playlist items
+    yield youtube_tracks_header(playlist_name)
+    for response, videos in pages:
+        yield youtube_track_rows(response['items'], videos)
+    yield track_listing_links("youtube", "download-youtube-playlist", playlist_id, playlist_name)
 
-        next_page_token = response.get('nextPageToken')
-        if not next_page_token:
-            break
+def youtube_tracks_header(playlist_name):
+    return f"<h2>Tracks in YouTube playlist: {playlist_name}</h2>"
 
-    tracks_string = "<br>".join(result)
-    
-    copy_link = f'<br><br><a href="/copy-playlist/youtube/{playlist_id}/{playlist_name}">Copy Playlist</a>'
-    download_link = f'<br><a href="/download-youtube-playlist/{playlist_id}/{playlist_name}">Download Playlist</a>'
-    back_link = '<br><a href="/playlists">Back to Playlists</a>'
-    
-    return tracks_string + copy_link + download_link + back_link
+def youtube_track_rows(items, videos):
+    # Shared with asgi.py
+    result = []
+    for track in youtube_track_entries(items, videos):
+        video_id = track['video_id']
+        track_link = f'<a href="https://www.youtube.com/watch?v={video_id}" target="_blank">{track["title"]}</a>'
+        duration = ''
+        if track['duration'] is not None:
+            seconds = track['duration']
+            duration = f" ({seconds // 60}:{seconds % 60:02d})"
+        result.append(f"<br>{track_link} - {track['channel']}{duration}")
+    return "".join(result)
+
+def youtube_track_entries(items, videos):
+    # duration is None for videos the lookup didn't return, e.g. deleted ones
+    entries = []
+    for item in items:
+        video_id = item['snippet']['resourceId']['videoId']
+        duration = None
+        if video_id in videos:
+            duration = parse_duration(videos[video_id]['contentDetails']['duration'])
+        entries.append({
+            "video_id": video_id,
+            "title": item['snippet']['title'],
+            "channel": item['snippet'].get('videoOwnerChannelTitle', ''),
+            "duration": duration
+        })
+    return entries
+
+def youtube_tracks_json(youtube, session_id, playlist_id, page_token):
+    # One page of tracks for clients that render as they go, pass next_page_token
+    # back until it is null
+    try:
+        response, videos = youtube_playlist_page(youtube, session_id, playlist_id, page_token or None)
+    except HttpError as e:
+        return jsonify({"error": youtube_error_reason(e) or str(e)}), e.resp.status
+    return jsonify({
+        "tracks": youtube_track_entries(response['items'], videos),
+        "total": response.get('pageInfo', {}).get('totalResults'),
+        "next_page_token": response.get('nextPageToken')
+    })
 
 @app.route("/copy-playlist/<source_platform>/<playlist_id>/<playlist_name>")
 def copy_playlist(source_platform, playlist_id, playlist_name):
     available_platforms = []
     
-    if "access_token" in session:
+    if is_spotify_logged_in():
         available_platforms.append("spotify")
     
-    if "google_credentials" in session:
+    if is_google_logged_in():
         available_platforms.append("youtube")
     
     if len(available_platforms) < 2:
@@ -329,8 +737,10 @@ def copy_playlist(source_platform, playlist_id, playlist_name):
         <input type="hidden" name="target_platform" value="{target_platform}">
         <input type="hidden" name="playlist_id" value="{playlist_id}">
         <input type="hidden" name="playlist_name" value="{playlist_name}">
-        <input type="submit" value="Confirm Copy">
+        <button type="submit" name="mode" value="copy">Confirm Copy</button>
+        <button type="submit" name="mode" value="sync">Sync Changes</button>
     </form>
+    <p>Sync keeps one linked playlist up to date and only transfers tracks that changed since the last sync.</p>
     <br>
     <a href="/playlists">Back to Playlists</a>
     """
@@ -343,28 +753,118 @@ def perform_copy():
     target_platform = request.form["target_platform"]
     playlist_id = request.form["playlist_id"]
     playlist_name = request.form["playlist_name"]
+    mode = request.form.get("mode", "copy")
+
+    if mode not in ("copy", "sync"):
+        return "Invalid mode"
 
     if source_platform == "spotify" and target_platform == "youtube":
-        return copy_spotify_to_youtube(playlist_id, playlist_name)
+        kind = f"{mode}_spotify_to_youtube"
     elif source_platform == "youtube" and target_platform == "spotify":
-        return copy_youtube_to_spotify(playlist_id, playlist_name)
+        kind = f"{mode}_youtube_to_spotify"
     else:
         return "Invalid platform combination"
 
-def copy_spotify_to_youtube(playlist_id, playlist_name):
-    spotify_headers = {"Authorization": f"Bearer {session['access_token']}"}
-    response = requests.get(f"{SPOTIFY_API_BASE_URL}playlists/{playlist_id}/tracks", headers=spotify_headers)
-    if response.status_code != 200:
-        error_message = response.json().get('error', {}).get('message', 'Unknown error')
-        return f"Error: Unable to fetch Spotify tracks. Status code: {response.status_code}. Message: {error_message}"
+    if not is_spotify_logged_in() or not is_google_logged_in():
+        return "You need to be logged in to both platforms to copy playlists."
+
+    # A reloaded or resubmitted page gets the job that is already running
+    job_id = job_queue.enqueue(kind, {
+        "playlist_id": playlist_id,
+        "playlist_name": playlist_name,
+        "session_id": current_session_id()
+    }, unique=True, owner=current_session_id(), admit=admit_job)
+    # The target playlist list is about to change
+    page_cache.invalidate(current_session_id())
+    action = "Syncing" if mode == "sync" else "Copying"
+    return job_started_response(job_id, f"{action} playlist '{playlist_name}' from {source_platform} to {target_platform}.")
+
+@job_queue.handler("copy_spotify_to_youtube", group="copy")
+def run_copy_spotify_to_youtube(params, job):
+    return copy_spotify_to_youtube(
+        params["playlist_id"], params["playlist_name"],
+        spotify_auth_for(params["session_id"]), job_google_credentials(params), job
+    )
+
+@job_queue.handler("copy_youtube_to_spotify", group="copy")
+def run_copy_youtube_to_spotify(params, job):
+    return copy_youtube_to_spotify(
+        params["playlist_id"], params["playlist_name"],
+        spotify_auth_for(params["session_id"]), job_google_credentials(params), job
+    )
+
+@job_queue.handler("sync_spotify_to_youtube", group="copy")
+def run_sync_spotify_to_youtube(params, job):
+    return sync_spotify_to_youtube(
+        params["playlist_id"], params["playlist_name"],
+        spotify_auth_for(params["session_id"]), job_google_credentials(params), job
+    )
+
+@job_queue.handler("sync_youtube_to_spotify", group="copy")
+def run_sync_youtube_to_spotify(params, job):
+    return sync_youtube_to_spotify(
+        params["playlist_id"], params["playlist_name"],
+        spotify_auth_for(params["session_id"]), job_google_credentials(params), job
+    )
+
+def copy_spotify_to_youtube(playlist_id, playlist_name, spotify_auth, google_credentials, job):
+    pages = spotify.playlist_track_pages(playlist_id, spotify_auth)
+    try:
+        first_page = next(pages)
+    except SpotifyError as e:
+        raise JobError(f"Unable to fetch Spotify tracks. Status code: {e.status_code}. Message: {e.message}")
     
-    spotify_tracks = response.json()['items']
+    job.set_progress(total=first_page['total'], matched=0, added=0, failed=0, low_confidence=0)
+
+    youtube = get_service(google_credentials)
 
-    # Create YouTube playlist
+    # A restarted job carries on with the playlist it created the first time. Tracks
+    # are checkpointed by position, inserts that went through without a checkpoint
+    # are found in the playlist itself.
+    checkpoints = job.checkpoints()
+    new_playlist_id = checkpoints.get("playlist_id")
+    if new_playlist_id and youtube_playlist_exists(youtube, new_playlist_id):
+        existing = unclaimed_playlist_items(youtube, new_playlist_id, checkpointed_items(checkpoints))
+    else:
+        new_playlist_id = create_youtube_playlist(youtube, playlist_name)
+        job.checkpoint("playlist_id", new_playlist_id)
+        checkpoints = {}
+        existing = None
+
+    added_tracks = 0
+    failed_tracks = 0
+    low_confidence = []
+    position = 0
+    # One page at a time: the next page is prefetched while this one is matched and inserted
+    for page in itertools.chain([first_page], pages):
+        keys = [f"track:{index}" for index in range(position, position + len(page['items']))]
+        position += len(page['items'])
+
+        results = [tuple(checkpoints[key]) for key in keys if key in checkpoints]
+        for video_id, item_id in results:
+            job.increment(matched=1 if video_id else 0, added=1 if item_id else 0, failed=0 if item_id else 1)
+
+        pending = [(key, track) for key, track in zip(keys, page['items']) if key not in checkpoints]
+        if pending:
+            for (key, _), (_, video_id, item_id) in zip(pending, add_tracks_to_youtube(
+                    youtube, new_playlist_id, [track for _, track in pending], job, low_confidence, existing)):
+                job.checkpoint(key, [video_id, item_id])
+                results.append((video_id, item_id))
+
+        added = sum(1 for _, item_id in results if item_id)
+        added_tracks += added
+        failed_tracks += len(results) - added
+
+    return {
+        "message": f"Playlist '{playlist_name}' copied from Spotify to YouTube.",
+        "playlist_id": new_playlist_id,
+        "added_tracks": added_tracks,
+        "failed_tracks": failed_tracks,
+        "low_confidence_tracks": low_confidence
+    }
+
+def create_youtube_playlist(youtube, playlist_name):
     try:
-        google_credentials = Credentials(**session['google_credentials'])
-        youtube = build('youtube', 'v3', credentials=google_credentials)
-        
         new_playlist = youtube.playlists().insert(
             part="snippet,status",
             body={
@@ -378,58 +878,239 @@ def copy_spotify_to_youtube(playlist_id, playlist_name):
             }
         ).execute()
     except HttpError as e:
-        return f"Error: Unable to create YouTube playlist. {e.resp.status}: {e.content}"
+        raise JobError(f"Unable to create YouTube playlist. {e.resp.status}: {e.content}")
+    return new_playlist['id']
+
+def add_tracks_to_youtube(youtube, playlist_id, spotify_tracks, job, low_confidence, existing=None):
+    # Returns (track, video_id, playlist_item_id) per track, None where no video
+    # was found or the insert failed. existing maps video IDs to items already in
+    # the playlist, those are used instead of inserting the video again.
+    # Match the whole page first, searches run concurrently and keep playlist order
+    video_ids = match_spotify_tracks(youtube, spotify_tracks, job, low_confidence)
+    job.increment(failed=sum(1 for video_id in video_ids if not video_id))
+
+    item_ids = [None] * len(spotify_tracks)
+    inserts = []
+    for index, video_id in enumerate(video_ids):
+        if video_id and existing and existing.get(video_id):
+            item_ids[index] = existing[video_id].popleft()
+            job.increment(added=1)
+        elif video_id:
+            inserts.append(index)
+
+    # Add tracks to YouTube playlist, the whole page goes out in batched requests
+    inserted = insert_videos(
+        youtube, [(playlist_id, video_ids[index], spotify_tracks[index]['track']['name']) for index in inserts], job
+    )
+    for index, item_id in zip(inserts, inserted):
+        item_ids[index] = item_id
+
+    return list(zip(spotify_tracks, video_ids, item_ids))
+
+def checkpointed_items(checkpoints):
+    # The playlist item IDs in [video_id, item_id] track checkpoints
+    return {value[1] for value in checkpoints.values() if isinstance(value, list)}
+
+def unclaimed_playlist_items(youtube, playlist_id, claimed):
+    # {video_id: deque of item IDs} for playlist items not in claimed
+    items = defaultdict(deque)
+    for item in list_youtube_playlist_items(youtube, playlist_id):
+        if item['id'] not in claimed:
+            items[item['snippet']['resourceId']['videoId']].append(item['id'])
+    return items
+
+def spotify_track_label(track):
+    return f"{track['name']} - {', '.join(artist['name'] for artist in track['artists'])}"
+
+def match_spotify_tracks(youtube, spotify_tracks, job, low_confidence):
+    # Returns the video ID per track, None where nothing matched
+    def find_video(track):
+        start = time.perf_counter()
+        video_id, confidence = find_youtube_video(youtube, track['track'])
+        if video_id:
+            job.increment(matched=1)
+            job.emit("matched", track=spotify_track_label(track['track']), video_id=video_id, confidence=confidence,
+                     seconds=time.perf_counter() - start)
+            if confidence is not None and confidence < MATCH_REVIEW_CONFIDENCE:
+                low_confidence.append(track['track']['name'])
+                job.increment(low_confidence=1)
+        else:
+            job.emit("failed", track=spotify_track_label(track['track']), stage="match")
+        return video_id
+
+    return match_concurrently(spotify_tracks, find_video, MATCH_CONCURRENCY, is_fatal_match_error)
+
+def insert_videos(youtube, entries, job):
+    # entries are (playlist_id, video_id, label), they may span several playlists.
+    # Returns the new playlist item ID per entry, None where the insert failed.
+    try:
+        items, errors = insert_items(
+            youtube, [(playlist_id, video_id) for playlist_id, video_id, _ in entries],
+            retry=lambda playlist_id, video_id: youtube_request_with_backoff(
+                playlist_item_insert(youtube, playlist_id, video_id)
+            )
+        )
+    except HttpError as e:
+        items, errors = [None] * len(entries), [e] * len(entries)
+
+    item_ids = []
+    for (playlist_id, video_id, label), item, error in zip(entries, items, errors):
+        if error is None:
+            item_ids.append(item['id'])
+            job.increment(added=1)
+            job.emit("inserted", track=label, video_id=video_id, item_id=item['id'])
+        else:
+            item_ids.append(None)
+            job.increment(failed=1)
+            job.emit("failed", track=label, video_id=video_id, stage="insert", error=str(error))
+            print(f"Error adding track '{label}': {error}")
+    return item_ids
+
+def sync_spotify_to_youtube(playlist_id, playlist_name, spotify_auth, google_credentials, job):
+    youtube = get_service(google_credentials)
+    channel = youtube_request_with_backoff(youtube.channels().list(part="id", mine=True))
+    owner = channel['items'][0]['id']
 
-    new_playlist_id = new_playlist['id']
+    try:
+        snapshot_id = spotify.get_json(f"playlists/{playlist_id}", spotify_auth, {"fields": "snapshot_id"})['snapshot_id']
+    except SpotifyError as e:
+        raise JobError(f"Unable to fetch Spotify playlist. Status code: {e.status_code}. Message: {e.message}")
+
+    # A target the user deleted is created again, even when the source is unchanged
+    link = sync_store.get("spotify", playlist_id, owner)
+    if link and not youtube_playlist_exists(youtube, link.target_id):
+        sync_store.delete("spotify", playlist_id, owner)
+        link = None
+
+    # Same snapshot as last time, nothing to do
+    if link and link.version == snapshot_id:
+        return sync_result(link, playlist_name, 0, 0, [])
+
+    # The link is only saved once the sync is done, a restarted job finds the
+    # playlist it created and the tracks it inserted in its checkpoints
+    checkpoints = job.checkpoints()
+    if link is None:
+        target_id = checkpoints.get("playlist_id")
+        if not target_id or not youtube_playlist_exists(youtube, target_id):
+            target_id = create_youtube_playlist(youtube, playlist_name)
+            checkpoints = {}
+        link = PlaylistLink("spotify", playlist_id, owner, target_id)
+    job.checkpoint("playlist_id", link.target_id)
 
-    # Add tracks to YouTube playlist
-    added_tracks = 0
-    failed_tracks = 0
-    for track in spotify_tracks:
-        track_name = track['track']['name']
-        artists = ", ".join([artist['name'] for artist in track['track']['artists']])
-        search_query = f"{track_name} {artists}"
-        
-        try:
-            search_response = youtube.search().list(
-                q=search_query,
-                type="video",
-                part="id",
-                maxResults=1
-            ).execute()
-
-            if search_response['items']:
-                video_id = search_response['items'][0]['id']['videoId']
-                youtube.playlistItems().insert(
-                    part="snippet",
-                    body={
-                        "snippet": {
-                            "playlistId": new_playlist_id,
-                            "resourceId": {
-                                "kind": "youtube#video",
-                                "videoId": video_id
-                            }
-                        }
-                    }
-                ).execute()
-                added_tracks += 1
-            else:
-                failed_tracks += 1
-        except HttpError as e:
-            failed_tracks += 1
-            print(f"Error adding track '{track_name}': {e.resp.status}: {e.content}")
+    try:
+        tracks = [item for page in spotify.playlist_track_pages(playlist_id, spotify_auth) for item in page['items']]
+    except SpotifyError as e:
+        raise JobError(f"Unable to fetch Spotify tracks. Status code: {e.status_code}. Message: {e.message}")
+
+    added, removed, kept = diff_items(link.items, [item['track']['uri'] for item in tracks])
+    job.set_progress(total=len(added), matched=0, added=0, failed=0, low_confidence=0, removed=0)
+
+    # Removals first. Items that could not be removed stay linked and are retried next time.
+    removable = [item for item in removed if item[1]]
+    errors = delete_playlist_items(youtube, [item[1] for item in removable]) if removable else []
+    removed_tracks = len(removed)
+    for item, error in zip(removable, errors):
+        if error is not None and not (isinstance(error, HttpError) and error.resp.status == 404):
+            print(f"Error removing playlist item '{item[1]}': {error}")
+            kept.append(item)
+            removed_tracks -= 1
+    job.set_progress(removed=removed_tracks)
 
-    result = f"Playlist '{playlist_name}' copied from Spotify to YouTube.\n"
-    result += f"New YouTube playlist ID: {new_playlist_id}\n"
-    result += f"Successfully added tracks: {added_tracks}\n"
-    result += f"Failed to add tracks: {failed_tracks}"
+    added_tracks = 0
+    low_confidence = []
+    keys = {index: f"track:{index}:{tracks[index]['track']['uri']}" for index in added}
+    results = []
+    for index in added:
+        if keys[index] in checkpoints:
+            video_id, item_id = checkpoints[keys[index]]
+            job.increment(matched=1 if video_id else 0, added=1 if item_id else 0, failed=0 if item_id else 1)
+            results.append((tracks[index], video_id, item_id))
+
+    # Inserts that went through without a checkpoint are found in the playlist itself
+    pending = [index for index in added if keys[index] not in checkpoints]
+    existing = None
+    if checkpoints and pending:
+        claimed = checkpointed_items(checkpoints) | {item_id for _, item_id in link.items}
+        existing = unclaimed_playlist_items(youtube, link.target_id, claimed)
+    for i in range(0, len(pending), 100):
+        batch = pending[i:i + 100]
+        for index, (track, video_id, item_id) in zip(batch, add_tracks_to_youtube(
+                youtube, link.target_id, [tracks[index] for index in batch], job, low_confidence, existing)):
+            job.checkpoint(keys[index], [video_id, item_id])
+            results.append((track, video_id, item_id))
+
+    for track, video_id, item_id in results:
+        # Failed inserts stay unlinked so the next sync tries them again,
+        # tracks without a match are linked to None so they aren't searched again
+        if item_id or not video_id:
+            kept.append((track['track']['uri'], item_id))
+        if item_id:
+            added_tracks += 1
+
+    link.version = snapshot_id
+    link.items = kept
+    sync_store.save(link)
+    return sync_result(link, playlist_name, added_tracks, removed_tracks, low_confidence)
+
+def youtube_playlist_exists(youtube, playlist_id):
+    response = youtube_request_with_backoff(youtube.playlists().list(part="id", id=playlist_id))
+    return bool(response.get('items'))
+
+def sync_result(link, playlist_name, added_tracks, removed_tracks, low_confidence):
+    if not added_tracks and not removed_tracks:
+        message = f"Playlist '{playlist_name}' is already up to date."
+    else:
+        message = f"Playlist '{playlist_name}' synced."
+    return {
+        "message": message,
+        "playlist_id": link.target_id,
+        "added_tracks": added_tracks,
+        "removed_tracks": removed_tracks,
+        "low_confidence_tracks": low_confidence
+    }
 
-    return result
+def copy_youtube_to_spotify(playlist_id, playlist_name, spotify_auth, google_credentials, job):
+    youtube = get_service(google_credentials)
+    youtube_tracks = list_youtube_playlist_items(youtube, playlist_id)
+
+    job.set_progress(total=len(youtube_tracks), matched=0, added=0, failed=0, low_confidence=0)
+
+    # A restarted job reuses its playlist and the matches it checkpointed, and
+    # leaves out tracks the playlist already has
+    checkpoints = job.checkpoints()
+    new_playlist_id = checkpoints.get("playlist_id")
+    existing = spotify_playlist_uris(spotify_auth, new_playlist_id) if new_playlist_id else None
+    if existing is None:
+        new_playlist_id = create_spotify_playlist(spotify_auth, get_spotify_user_id(spotify_auth), playlist_name)
+        job.checkpoint("playlist_id", new_playlist_id)
+        checkpoints = {}
+
+    keys = [f"track:{index}" for index in range(len(youtube_tracks))]
+    matches = [checkpoints.get(key) for key in keys]
+    for key, track_uri in zip(keys, matches):
+        if key in checkpoints:
+            job.increment(matched=1 if track_uri else 0, failed=0 if track_uri else 1)
+
+    low_confidence = []
+    pending = [index for index, key in enumerate(keys) if key not in checkpoints]
+    found = match_youtube_tracks(youtube, spotify_auth, [youtube_tracks[index] for index in pending], job,
+                                 low_confidence)
+    for index, track_uri in zip(pending, found):
+        job.checkpoint(keys[index], track_uri)
+        matches[index] = track_uri
+
+    track_uris = [track_uri for track_uri in matches if track_uri]
+    add_uris_to_spotify_playlist(spotify_auth, new_playlist_id, uris_not_in(track_uris, existing, job), job)
 
-def copy_youtube_to_spotify(playlist_id, playlist_name):
-    google_credentials = Credentials(**session['google_credentials'])
-    youtube = build('youtube', 'v3', credentials=google_credentials)
+    return {
+        "message": f"Playlist '{playlist_name}' copied from YouTube to Spotify.",
+        "playlist_id": new_playlist_id,
+        "added_tracks": len(track_uris),
+        "failed_tracks": len(youtube_tracks) - len(track_uris),
+        "low_confidence_tracks": low_confidence
+    }
 
+def list_youtube_playlist_items(youtube, playlist_id):
     youtube_tracks = []
     next_page_token = None
     while True:
@@ -444,18 +1125,40 @@ def copy_youtube_to_spotify(playlist_id, playlist_name):
         next_page_token = playlist_items.get('nextPageToken')
         if not next_page_token:
             break
+    return youtube_tracks
 
-    # Create Spotify playlist
-    spotify_headers = {"Authorization": f"Bearer {session['access_token']}"}
-    user_profile = get_user_profile(spotify_headers)
+def spotify_playlist_uris(spotify_auth, playlist_id):
+    # None when the playlist is gone
+    try:
+        return [item['track']['uri'] for item in spotify.iter_playlist_tracks(playlist_id, spotify_auth)]
+    except SpotifyError as e:
+        if e.status_code == 404:
+            return None
+        raise JobError(f"Unable to fetch Spotify tracks. Status code: {e.status_code}. Message: {e.message}")
+
+def uris_not_in(track_uris, existing, job):
+    # Leaves out URIs the playlist already has, once per occurrence. Those were
+    # added before the job was restarted and count as added.
+    remaining = Counter(existing or [])
+    new_uris = []
+    for track_uri in track_uris:
+        if remaining[track_uri]:
+            remaining[track_uri] -= 1
+            job.increment(added=1)
+        else:
+            new_uris.append(track_uri)
+    return new_uris
+
+def get_spotify_user_id(spotify_auth):
+    user_profile = get_user_profile(spotify_auth)
     if not user_profile:
-        return "Error: Unable to fetch Spotify user profile. Please try logging in again."
-    
-    user_id = user_profile['id']
+        raise JobError("Unable to fetch Spotify user profile. Please try logging in again.")
+    return user_profile['id']
 
-    create_playlist_response = requests.post(
-        f"{SPOTIFY_API_BASE_URL}users/{user_id}/playlists",
-        headers=spotify_headers,
+def create_spotify_playlist(spotify_auth, user_id, playlist_name):
+    create_playlist_response = spotify.post(
+        f"users/{user_id}/playlists",
+        auth=spotify_auth,
         json={
             "name": f"{playlist_name} (from YouTube)",
             "description": "Playlist copied from YouTube",
@@ -463,213 +1166,830 @@ def copy_youtube_to_spotify(playlist_id, playlist_name):
         }
     )
     if create_playlist_response.status_code != 201:
-        error_message = create_playlist_response.json().get('error', {}).get('message', 'Unknown error')
-        return f"Error: Unable to create Spotify playlist. Status code: {create_playlist_response.status_code}. Message: {error_message}"
-
-    new_playlist = create_playlist_response.json()
-    new_playlist_id = new_playlist['id']
-
-    # Add tracks to Spotify playlist
-    track_uris = []
-    for track in youtube_tracks:
-        video_title = track['snippet']['title']
-        search_query = quote(video_title)
-        search_response = requests.get(
-            f"{SPOTIFY_API_BASE_URL}search?q={search_query}&type=track&limit=1",
-            headers=spotify_headers
+        raise JobError(f"Unable to create Spotify playlist. Status code: {create_playlist_response.status_code}. Message: {error_message(create_playlist_response)}")
+
+    return create_playlist_response.json()['id']
+
+def match_youtube_tracks(youtube, spotify_auth, youtube_tracks, job, low_confidence):
+    # Durations help tell apart versions of a song, 50 videos per lookup
+    videos = get_videos(youtube, [track['snippet']['resourceId']['videoId'] for track in youtube_tracks])
+
+    def find_track(track):
+        start = time.perf_counter()
+        video_id = track['snippet']['resourceId']['videoId']
+        duration = None
+        if video_id in videos:
+            duration = parse_duration(videos[video_id]['contentDetails']['duration'])
+        track_uri, confidence = find_spotify_track(
+            spotify_auth, video_id, track['snippet']['title'],
+            track['snippet'].get('videoOwnerChannelTitle'), duration
         )
-        if search_response.status_code == 200 and search_response.json()['tracks']['items']:
-            track_uri = search_response.json()['tracks']['items'][0]['uri']
-            track_uris.append(track_uri)
-
+        if track_uri:
+            job.increment(matched=1)
+            job.emit("matched", track=track['snippet']['title'], track_uri=track_uri, confidence=confidence,
+                     seconds=time.perf_counter() - start)
+            if confidence is not None and confidence < MATCH_REVIEW_CONFIDENCE:
+                low_confidence.append(track['snippet']['title'])
+                job.increment(low_confidence=1)
+        else:
+            job.increment(failed=1)
+            job.emit("failed", track=track['snippet']['title'], video_id=video_id, stage="match")
+        return track_uri
+
+    return match_concurrently(youtube_tracks, find_track, MATCH_CONCURRENCY, is_fatal_match_error)
+
+def add_uris_to_spotify_playlist(spotify_auth, playlist_id, track_uris, job):
+    # Spotify takes up to 100 URIs per request
     for i in range(0, len(track_uris), 100):
         batch = track_uris[i:i+100]
-        add_tracks_response = requests.post(
-            f"{SPOTIFY_API_BASE_URL}playlists/{new_playlist_id}/tracks",
-            headers=spotify_headers,
+        add_tracks_response = spotify.post(
+            f"playlists/{playlist_id}/tracks",
+            auth=spotify_auth,
             json={"uris": batch}
         )
         if add_tracks_response.status_code != 201:
-            error_message = add_tracks_response.json().get('error', {}).get('message', 'Unknown error')
-            return f"Error: Unable to add tracks to Spotify playlist. Status code: {add_tracks_response.status_code}. Message: {error_message}"
+            raise JobError(f"Unable to add tracks to Spotify playlist. Status code: {add_tracks_response.status_code}. Message: {error_message(add_tracks_response)}")
+        job.increment(added=len(batch))
+        for track_uri in batch:
+            job.emit("inserted", track_uri=track_uri)
+
+def sync_youtube_to_spotify(playlist_id, playlist_name, spotify_auth, google_credentials, job):
+    youtube = get_service(google_credentials)
+    owner = get_spotify_user_id(spotify_auth)
+
+    # The version is a hash of the video IDs in order. The playlist's own etag can
+    # stay the same when items are swapped, the listing costs 1 unit per 50 items
+    # and matching, the expensive part, still only runs for what the diff adds.
+    try:
+        youtube_tracks = list_youtube_playlist_items(youtube, playlist_id)
+    except HttpError as e:
+        if e.resp.status == 404:
+            raise JobError("YouTube playlist not found.")
+        raise
+    video_ids = [track['snippet']['resourceId']['videoId'] for track in youtube_tracks]
+    version = items_version(video_ids)
+
+    link = sync_store.get("youtube", playlist_id, owner)
+    if link and link.version == version:
+        return sync_result(link, playlist_name, 0, 0, [])
+
+    # As in sync_spotify_to_youtube, a restarted job reuses its playlist and matches
+    checkpoints = job.checkpoints()
+    if link is None:
+        target_id = checkpoints.get("playlist_id")
+        if not target_id or spotify_playlist_uris(spotify_auth, target_id) is None:
+            target_id = create_spotify_playlist(spotify_auth, owner, playlist_name)
+            checkpoints = {}
+        link = PlaylistLink("youtube", playlist_id, owner, target_id)
+    job.checkpoint("playlist_id", link.target_id)
+
+    added, removed, kept = diff_items(link.items, video_ids)
+    job.set_progress(total=len(added), matched=0, added=0, failed=0, low_confidence=0, removed=0)
+
+    # Spotify removes every occurrence of a URI, so URIs still linked elsewhere are left alone
+    still_linked = {track_uri for _, track_uri in kept}
+    removable = list(dict.fromkeys(
+        track_uri for _, track_uri in removed if track_uri and track_uri not in still_linked
+    ))
+    for i in range(0, len(removable), 100):
+        remove_response = spotify.request(
+            "DELETE", f"playlists/{link.target_id}/tracks",
+            auth=spotify_auth,
+            json={"tracks": [{"uri": track_uri} for track_uri in removable[i:i + 100]]}
+        )
+        if remove_response.status_code == 404:
+            # The target playlist is gone, start over with a new one next time
+            sync_store.delete("youtube", playlist_id, owner)
+            raise JobError("The synced Spotify playlist no longer exists. Run the sync again to create a new one.")
+        if remove_response.status_code != 200:
+            raise JobError(f"Unable to remove tracks from Spotify playlist. Status code: {remove_response.status_code}. Message: {error_message(remove_response)}")
+    job.set_progress(removed=len(removed))
+
+    low_confidence = []
+    new_tracks = [youtube_tracks[index] for index in added]
+    keys = [f"track:{index}:{youtube_tracks[index]['snippet']['resourceId']['videoId']}" for index in added]
+    matches = [checkpoints.get(key) for key in keys]
+    for key, track_uri in zip(keys, matches):
+        if key in checkpoints:
+            job.increment(matched=1 if track_uri else 0, failed=0 if track_uri else 1)
+    pending = [index for index, key in enumerate(keys) if key not in checkpoints]
+    found = match_youtube_tracks(youtube, spotify_auth, [new_tracks[index] for index in pending], job, low_confidence)
+    for index, track_uri in zip(pending, found):
+        job.checkpoint(keys[index], track_uri)
+        matches[index] = track_uri
+
+    # Beyond the tracks still linked, the playlist holds what a restarted job added the first time
+    existing = None
+    if checkpoints:
+        existing = Counter(spotify_playlist_uris(spotify_auth, link.target_id) or []) - Counter(
+            track_uri for _, track_uri in kept if track_uri
+        )
+    add_uris_to_spotify_playlist(
+        spotify_auth, link.target_id, uris_not_in([track_uri for track_uri in matches if track_uri], existing, job), job
+    )
+    for track, track_uri in zip(new_tracks, matches):
+        kept.append((track['snippet']['resourceId']['videoId'], track_uri))
+
+    link.version = version
+    link.items = kept
+    sync_store.save(link)
+    return sync_result(link, playlist_name, sum(1 for track_uri in matches if track_uri), len(removed), low_confidence)
+
+
+# Bulk conversion of many playlists in one job
+@app.route("/api/session")
+def api_session():
+    return jsonify({
+        "session_id": session.get('sid'),
+        "spotify": is_spotify_logged_in(),
+        "google": is_google_logged_in()
+    })
+
+@app.route("/api/convert", methods=["POST"])
+def api_convert():
+    data = request.get_json(silent=True) or {}
+    source_platform = data.get("source_platform")
+    playlist_ids = data.get("playlist_ids")
+
+    if source_platform not in ("spotify", "youtube"):
+        return jsonify({"error": "source_platform must be 'spotify' or 'youtube'"}), 400
+    if data.get("all"):
+        playlist_ids = None
+    elif not isinstance(playlist_ids, list) or not playlist_ids or not all(isinstance(i, str) for i in playlist_ids):
+        return jsonify({"error": "Pass a list of playlist_ids or \"all\": true"}), 400
+    if not is_spotify_logged_in() or not is_google_logged_in():
+        return jsonify({"error": "You need to be logged in to both platforms to copy playlists."}), 401
+
+    page_cache.invalidate(current_session_id())
+    job_id = enqueue_bulk_copy(source_platform, playlist_ids, current_session_id())
+    return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+def enqueue_bulk_copy(source_platform, playlist_ids, session_id):
+    # playlist_ids None converts all of the user's playlists
+    target_platform = "youtube" if source_platform == "spotify" else "spotify"
+    return job_queue.enqueue(f"bulk_copy_{source_platform}_to_{target_platform}", {
+        "playlist_ids": playlist_ids,
+        "session_id": session_id
+    }, owner=session_id, admit=admit_job)
+
+@job_queue.handler("bulk_copy_spotify_to_youtube", group="copy")
+def run_bulk_copy_spotify_to_youtube(params, job):
+    return bulk_copy_spotify_to_youtube(
+        params["playlist_ids"], spotify_auth_for(params["session_id"]), job_google_credentials(params), job
+    )
 
-    return f"Playlist '{playlist_name}' copied from YouTube to Spotify. New Spotify playlist ID: {new_playlist_id}"
+@job_queue.handler("bulk_copy_youtube_to_spotify", group="copy")
+def run_bulk_copy_youtube_to_spotify(params, job):
+    return bulk_copy_youtube_to_spotify(
+        params["playlist_ids"], spotify_auth_for(params["session_id"]), job_google_credentials(params), job
+    )
 
+def bulk_copy_spotify_to_youtube(playlist_ids, spotify_auth, google_credentials, job):
+    try:
+        if playlist_ids is None:
+            playlists = [(element['id'], element['name']) for element in spotify.iter_user_playlists(spotify_auth)]
+        else:
+            playlists = [
+                (playlist_id, spotify.get_json(f"playlists/{playlist_id}", spotify_auth, {"fields": "name"})['name'])
+                for playlist_id in playlist_ids
+            ]
+        playlist_tracks = {
+            playlist_id: list(spotify.iter_playlist_tracks(playlist_id, spotify_auth)) for playlist_id, _ in playlists
+        }
+    except SpotifyError as e:
+        raise JobError(f"Unable to fetch Spotify playlists. Status code: {e.status_code}. Message: {e.message}")
+
+    # Every song is matched once, however many playlists it is in
+    unique_tracks = {}
+    for tracks in playlist_tracks.values():
+        for track in tracks:
+            unique_tracks.setdefault(track['track']['uri'], track)
+
+    job.set_progress(playlists=len(playlists), total=len(unique_tracks), matched=0, failed=0, added=0,
+                     low_confidence=0)
+    youtube = get_service(google_credentials)
+    low_confidence = []
+    video_ids = dict(zip(unique_tracks, match_spotify_tracks(youtube, list(unique_tracks.values()), job, low_confidence)))
+    job.increment(failed=sum(1 for video_id in video_ids.values() if not video_id))
+
+    # A restarted job reuses the playlists it created, they are checkpointed per
+    # source playlist and their tracks by position like in copy_spotify_to_youtube
+    checkpoints = job.checkpoints()
+    entries = []
+    created = []
+    existing = {}
+    for playlist_id, playlist_name in playlists:
+        new_playlist_id = checkpoints.get(f"playlist:{playlist_id}")
+        if new_playlist_id and youtube_playlist_exists(youtube, new_playlist_id):
+            existing[new_playlist_id] = unclaimed_playlist_items(
+                youtube, new_playlist_id, checkpointed_items(checkpoints)
+            )
+        else:
+            new_playlist_id = create_youtube_playlist(youtube, playlist_name)
+            job.checkpoint(f"playlist:{playlist_id}", new_playlist_id)
+        created.append((playlist_id, playlist_name, new_playlist_id, len(playlist_tracks[playlist_id])))
+        for position, track in enumerate(playlist_tracks[playlist_id]):
+            video_id = video_ids[track['track']['uri']]
+            if video_id:
+                entries.append((f"track:{new_playlist_id}:{position}", new_playlist_id, video_id, track['track']['name']))
+
+    added = Counter()
+    pending = []
+    for key, new_playlist_id, video_id, label in entries:
+        if key in checkpoints:
+            item_id = checkpoints[key][1]
+            job.increment(added=1 if item_id else 0, failed=0 if item_id else 1)
+        elif existing.get(new_playlist_id, {}).get(video_id):
+            item_id = existing[new_playlist_id][video_id].popleft()
+            job.checkpoint(key, [video_id, item_id])
+            job.increment(added=1)
+        else:
+            pending.append((key, new_playlist_id, video_id, label))
+            continue
+        if item_id:
+            added[new_playlist_id] += 1
+
+    # Inserts for all playlists share the same batches
+    for i in range(0, len(pending), 100):
+        batch = pending[i:i + 100]
+        item_ids = insert_videos(youtube, [entry[1:] for entry in batch], job)
+        for (key, new_playlist_id, video_id, _), item_id in zip(batch, item_ids):
+            job.checkpoint(key, [video_id, item_id])
+            if item_id:
+                added[new_playlist_id] += 1
+
+    return bulk_result("Spotify", "YouTube", created, added, len(unique_tracks), low_confidence)
+
+def bulk_copy_youtube_to_spotify(playlist_ids, spotify_auth, google_credentials, job):
+    youtube = get_service(google_credentials)
+    playlists = []
+    if playlist_ids is None:
+        next_page_token = None
+        while True:
+            response = youtube_request_with_backoff(youtube.playlists().list(
+                part="snippet", mine=True, maxResults=50, pageToken=next_page_token
+            ))
+            playlists.extend((item['id'], item['snippet']['title']) for item in response.get('items', []))
+            next_page_token = response.get('nextPageToken')
+            if not next_page_token:
+                break
+    else:
+        titles = {}
+        for i in range(0, len(playlist_ids), 50):
+            response = youtube_request_with_backoff(youtube.playlists().list(
+                part="snippet", id=",".join(playlist_ids[i:i + 50]), maxResults=50
+            ))
+            titles.update((item['id'], item['snippet']['title']) for item in response.get('items', []))
+        missing = [playlist_id for playlist_id in playlist_ids if playlist_id not in titles]
+        if missing:
+            raise JobError(f"YouTube playlists not found: {', '.join(missing)}")
+        playlists = [(playlist_id, titles[playlist_id]) for playlist_id in playlist_ids]
+
+    playlist_tracks = {playlist_id: list_youtube_playlist_items(youtube, playlist_id) for playlist_id, _ in playlists}
+
+    # Every video is matched once, however many playlists it is in
+    unique_tracks = {}
+    for tracks in playlist_tracks.values():
+        for track in tracks:
+            unique_tracks.setdefault(track['snippet']['resourceId']['videoId'], track)
+
+    job.set_progress(playlists=len(playlists), total=len(unique_tracks), matched=0, failed=0, added=0,
+                     low_confidence=0)
+    low_confidence = []
+    track_uris = dict(zip(unique_tracks, match_youtube_tracks(
+        youtube, spotify_auth, list(unique_tracks.values()), job, low_confidence
+    )))
+
+    # A restarted job reuses the playlists it created and leaves out the tracks
+    # they already have, playlists it finished are skipped
+    checkpoints = job.checkpoints()
+    user_id = get_spotify_user_id(spotify_auth)
+    created = []
+    added = {}
+    for playlist_id, playlist_name in playlists:
+        uris = [track_uris[track['snippet']['resourceId']['videoId']] for track in playlist_tracks[playlist_id]]
+        uris = [track_uri for track_uri in uris if track_uri]
+        new_playlist_id = checkpoints.get(f"playlist:{playlist_id}")
+        if new_playlist_id and checkpoints.get(f"added:{new_playlist_id}"):
+            job.increment(added=len(uris))
+        else:
+            existing = spotify_playlist_uris(spotify_auth, new_playlist_id) if new_playlist_id else None
+            if existing is None:
+                new_playlist_id = create_spotify_playlist(spotify_auth, user_id, playlist_name)
+                job.checkpoint(f"playlist:{playlist_id}", new_playlist_id)
+            add_uris_to_spotify_playlist(spotify_auth, new_playlist_id, uris_not_in(uris, existing, job), job)
+            job.checkpoint(f"added:{new_playlist_id}", True)
+        created.append((playlist_id, playlist_name, new_playlist_id, len(playlist_tracks[playlist_id])))
+        added[new_playlist_id] = len(uris)
+
+    return bulk_result("YouTube", "Spotify", created, added, len(unique_tracks), low_confidence)
+
+def bulk_result(source_name, target_name, created, added, unique_tracks, low_confidence):
+    playlists = []
+    for playlist_id, playlist_name, new_playlist_id, total in created:
+        playlists.append({
+            "source_playlist_id": playlist_id,
+            "name": playlist_name,
+            "playlist_id": new_playlist_id,
+            "added_tracks": added.get(new_playlist_id, 0),
+            "failed_tracks": total - added.get(new_playlist_id, 0)
+        })
+    return {
+        "message": f"{len(playlists)} playlists copied from {source_name} to {target_name}.",
+        "playlists": playlists,
+        "unique_tracks": unique_tracks,
+        "low_confidence_tracks": low_confidence
+    }
 
 # Download playlists to device
 @app.route("/download-playlist/<playlist_id>/<playlist_name>")
 def download_playlist(playlist_id, playlist_name):
-    redirect_response, headers = check_session_and_get_headers()
+    redirect_response, _ = check_session_and_get_auth()
     if redirect_response:
         return redirect_response
 
-    youtube = get_youtube_service()
+    if not is_google_logged_in():
+        return redirect("/login-google")
 
-    response = requests.get(f"{SPOTIFY_API_BASE_URL}playlists/{playlist_id}/tracks", headers=headers)
-    if response.status_code != 200:
-        return f"Error: Unable to fetch tracks. Status code: {response.status_code}"
-    tracks = response.json()
+    profile = request.args.get("profile", AUDIO_PROFILE)
+    if profile not in AUDIO_PROFILES:
+        return f"Unknown audio profile '{profile}'. Choose one of: {', '.join(AUDIO_PROFILES)}"
 
-    downloads_folder = os.path.expanduser("~/Downloads")
-    playlist_folder = os.path.join(downloads_folder, playlist_name)
-    os.makedirs(playlist_folder, exist_ok=True)
-    zip_file_path = os.path.join(downloads_folder, f"{playlist_name}.zip")
-    
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': os.path.join(playlist_folder, '%(title)s.%(ext)s'),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
+    params = {
+        "playlist_id": playlist_id,
+        "playlist_name": playlist_name,
+        "session_id": current_session_id(),
+        "profile": profile
     }
-    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    if request.args.get("stream"):
+        return streaming_zip_response(submit_spotify_downloads, params)
 
-    tracks_downloaded = 0
+    job_id = job_queue.enqueue("download_playlist", params, unique=True, owner=params["session_id"], admit=admit_job)
+    return job_started_response(job_id, f"Downloading playlist '{playlist_name}'.")
 
-    for element in tracks['items']:
-        track = element['track']
-        track_name = track['name']
-        artists = ", ".join([artist['name'] for artist in track['artists']])
-        search_query = f"{track_name} {artists}"
-        
-        try:
-            search_response = youtube.search().list(
-                q=search_query,
-                type="video",
-                part="id",
-                maxResults=1
-            ).execute()
-
-            if search_response['items']:
-                video_id = search_response['items'][0]['id']['videoId']
-                video_url = f"https://www.youtube.com/watch?v={video_id}"
-                
-                ydl.download([video_url])
-                tracks_downloaded += 1
-            else:
-                print(f"No video found for {track_name} by {artists}")
-        except Exception as e:
-            print(f"Error downloading track '{track_name}': {str(e)}")
+@job_queue.handler("download_playlist", group="download")
+def run_download_playlist(params, job):
+    playlist_name = params["playlist_name"]
+    playlist_folder, zip_file_path = prepare_download_paths(job.id, playlist_name)
+    storage.add(job.id, params["session_id"], storage.job_folder(job.id))
 
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(playlist_folder):
-            for file in files:
-                zipf.write(os.path.join(root, file),
-                           os.path.relpath(os.path.join(root, file),
-                           playlist_folder))
+    try:
+        with DownloadEngine(playlist_folder, DOWNLOAD_WORKERS, TRANSCODE_WORKERS, download_event_handler(job),
+                            store=audio_store, profile=params.get("profile", AUDIO_PROFILE),
+                            watch_url=YOUTUBE_WATCH_URL) as engine:
+            resumed = submit_spotify_downloads(engine, params, job)
+            results = engine.wait()
 
-    return redirect(f"/playlist-downloaded?playlist_name={playlist_name}&tracks_downloaded={tracks_downloaded}&zip_filename={playlist_name}.zip")
+        zip_folder(playlist_folder, zip_file_path)
+    finally:
+        storage.finish(job.id)
+
+    return download_result(job.id, playlist_name, resumed + count_downloaded(results))
+
+def submit_spotify_downloads(engine, params, job):
+    youtube = get_service(job_google_credentials(params))
+
+    pages = spotify.playlist_track_pages(params['playlist_id'], spotify_auth_for(params["session_id"]))
+    try:
+        first_page = next(pages)
+    except SpotifyError as e:
+        raise JobError(f"Unable to fetch tracks. Status code: {e.status_code}")
+    job.set_progress(total=first_page['total'], downloaded=0, failed=0)
+    reserve_download_space(job, params, first_page['total'])
+
+    def find_video(element):
+        start = time.perf_counter()
+        video_id, confidence = find_youtube_video(youtube, element['track'])
+        if video_id:
+            job.emit("matched", track=spotify_track_label(element['track']), video_id=video_id,
+                     confidence=confidence, seconds=time.perf_counter() - start)
+        return video_id
+
+    # Returns how many tracks were already written before a restart
+    written = written_files(job)
+    resumed = 0
+    for page in itertools.chain([first_page], pages):
+        video_ids = match_concurrently(page['items'], find_video, MATCH_CONCURRENCY, is_fatal_match_error)
+        for element, video_id in zip(page['items'], video_ids):
+            track = element['track']
+            artists = ", ".join([artist['name'] for artist in track['artists']])
+            if video_id in written:
+                resumed += 1
+                job.increment(downloaded=1)
+            elif video_id:
+                engine.submit(video_id, label=spotify_track_label(track))
+            else:
+                job.increment(failed=1)
+                job.emit("failed", track=spotify_track_label(track), stage="match")
+                print(f"No video found for {track['name']} by {artists}")
+    return resumed
 
 @app.route("/download-youtube-playlist/<playlist_id>/<playlist_name>")
 def download_youtube_playlist(playlist_id, playlist_name):
-    if 'google_credentials' not in session:
+    if not is_google_logged_in():
         return redirect("/login-google")
 
-    google_credentials = Credentials(**session['google_credentials'])
-    youtube = build('youtube', 'v3', credentials=google_credentials)
-    
-    downloads_folder = os.path.expanduser("~/Downloads")
-    playlist_folder = os.path.join(downloads_folder, playlist_name)
-    os.makedirs(playlist_folder, exist_ok=True)
-    zip_file_path = os.path.join(downloads_folder, f"{playlist_name}.zip")
-
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': os.path.join(playlist_folder, '%(title)s.%(ext)s'),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
+    profile = request.args.get("profile", AUDIO_PROFILE)
+    if profile not in AUDIO_PROFILES:
+        return f"Unknown audio profile '{profile}'. Choose one of: {', '.join(AUDIO_PROFILES)}"
+
+    params = {
+        "playlist_id": playlist_id,
+        "playlist_name": playlist_name,
+        "session_id": current_session_id(),
+        "profile": profile
     }
-    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    if request.args.get("stream"):
+        return streaming_zip_response(submit_youtube_downloads, params)
+
+    job_id = job_queue.enqueue("download_youtube_playlist", params, unique=True, owner=params["session_id"],
+                               admit=admit_job)
+    return job_started_response(job_id, f"Downloading playlist '{playlist_name}'.")
+
+@job_queue.handler("download_youtube_playlist", group="download")
+def run_download_youtube_playlist(params, job):
+    playlist_name = params["playlist_name"]
+    playlist_folder, zip_file_path = prepare_download_paths(job.id, playlist_name)
+    storage.add(job.id, params["session_id"], storage.job_folder(job.id))
+
+    try:
+        with DownloadEngine(playlist_folder, DOWNLOAD_WORKERS, TRANSCODE_WORKERS, download_event_handler(job),
+                            store=audio_store, profile=params.get("profile", AUDIO_PROFILE),
+                            watch_url=YOUTUBE_WATCH_URL) as engine:
+            resumed = submit_youtube_downloads(engine, params, job)
+            results = engine.wait()
+
+        zip_folder(playlist_folder, zip_file_path)
+    finally:
+        storage.finish(job.id)
+
+    return download_result(job.id, playlist_name, resumed + count_downloaded(results))
+
+def submit_youtube_downloads(engine, params, job):
+    youtube = get_service(job_google_credentials(params))
+    job.set_progress(downloaded=0, failed=0)
+    written = written_files(job)
+    resumed = 0
 
-    tracks_downloaded = 0
     next_page_token = None
     while True:
         request = youtube.playlistItems().list(
             part="snippet",
-            playlistId=playlist_id,
+            playlistId=params["playlist_id"],
             maxResults=50,
             pageToken=next_page_token
         )
         response = request.execute()
+        job.set_progress(total=response.get('pageInfo', {}).get('totalResults'))
+        if next_page_token is None:
+            reserve_download_space(job, params, response.get('pageInfo', {}).get('totalResults') or 0)
 
+        # Downloads start while the next page is being fetched
         for item in response['items']:
             video_id = item['snippet']['resourceId']['videoId']
-            video_title = item['snippet']['title']
-            video_url = f"https://www.youtube.com/watch?v={video_id}"
-            
-            try:
-                ydl.download([video_url])
-                tracks_downloaded += 1
-            except Exception as e:
-                print(f"Error downloading video '{video_title}': {str(e)}")
+            if video_id in written:
+                resumed += 1
+                job.increment(downloaded=1)
+            else:
+                engine.submit(video_id, title=item['snippet']['title'])
 
         next_page_token = response.get('nextPageToken')
         if not next_page_token:
             break
+    return resumed
+
+def streaming_zip_response(submit, params):
+    # Sends the ZIP while tracks are still downloading, nothing but the tracks touches disk.
+    # The folder sits next to the audio store so stored tracks are hardlinked, not copied.
+    admit_streaming_download(params["session_id"])
+    try:
+        playlist_folder = tempfile.mkdtemp(prefix="tunevert-", dir=os.path.dirname(audio_store.root))
+        job = NullJobContext()
+        engine = DownloadEngine(playlist_folder, DOWNLOAD_WORKERS, TRANSCODE_WORKERS, download_event_handler(job),
+                                store=audio_store, profile=params["profile"], watch_url=YOUTUBE_WATCH_URL)
+    except Exception:
+        streaming_downloads.release()
+        raise
+
+    def submit_all():
+        try:
+            submit(engine, params, job)
+        except Exception as e:
+            print(f"Error queueing downloads for '{params['playlist_name']}': {str(e)}")
+        finally:
+            engine.seal()
+
+    threading.Thread(target=submit_all, daemon=True).start()
 
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+    def finished_tracks():
+        for result in engine.iter_results():
+            if result['status'] == 'downloaded':
+                yield result['path']
+
+    def generate():
+        start = time.perf_counter()
+        try:
+            yield from stream_zip(finished_tracks(), remove=True)
+        finally:
+            # Includes the wait for downloads, the archive is written as tracks arrive
+            ZIP_SECONDS.observe(time.perf_counter() - start, mode="stream")
+            engine.close(cancel=True)
+            shutil.rmtree(playlist_folder, ignore_errors=True)
+
+    filename = quote(f"{download_name(params['playlist_name'])}.zip")
+    response = Response(generate(), mimetype="application/zip", headers={
+        "Content-Disposition": f"attachment; filename*=UTF-8''{filename}"
+    })
+    # Runs even when the client leaves before the body starts
+    response.call_on_close(streaming_downloads.release)
+    return response
+
+def download_name(playlist_name):
+    # The playlist name comes from the URL, so "." or ".." must not become a folder
+    name = sanitize_filename(playlist_name)
+    return name if name.strip(" .") else "playlist"
+
+def prepare_download_paths(job_id, playlist_name):
+    # In a folder per job, two downloads of the same playlist name don't meet
+    name = download_name(playlist_name)
+    playlist_folder = os.path.join(storage.job_folder(job_id), name)
+    os.makedirs(playlist_folder, exist_ok=True)
+    zip_file_path = os.path.join(storage.job_folder(job_id), f"{name}.zip")
+    return playlist_folder, zip_file_path
+
+def reserve_download_space(job, params, tracks):
+    # Fails the job before its first download rather than halfway through the
+    # playlist. Streaming downloads keep nothing on disk and only had the admission check.
+    if job.id is None:
+        return
+    bitrate = AUDIO_PROFILES[params.get("profile", AUDIO_PROFILE)].get("bitrate", "160k")
+    track_bytes = int(bitrate.rstrip("k")) * 1000 // 8 * ESTIMATED_TRACK_SECONDS
+    try:
+        storage.reserve(job.id, 2 * tracks * track_bytes)
+    except StorageFull as e:
+        raise JobError(str(e))
+
+def download_event_handler(job):
+    # Per-track time runs from the start of the download to the finished file
+    started = {}
+
+    def on_event(event):
+        video_id = event['video_id']
+        if event['event'] == 'started':
+            started[video_id] = time.perf_counter()
+            job.emit("started", track=event['label'], video_id=video_id)
+        elif event['event'] == 'progress':
+            progress = {
+                "downloaded_bytes": event['downloaded_bytes'],
+                "total_bytes": event['total_bytes'],
+                "speed": event['speed'],
+                "eta": event['eta']
+            }
+            job.track_progress(video_id, dict(progress, label=event['label']))
+            job.emit("downloading", track=event['label'], video_id=video_id, **progress)
+        elif event['event'] in ('finished', 'skipped'):
+            job.track_progress(video_id)
+            job.increment(downloaded=1)
+            job.checkpoint(f"file:{video_id}", event['path'])
+            start = started.pop(video_id, None)
+            job.emit("downloaded", track=event['label'], video_id=video_id, file=os.path.basename(event['path']),
+                     cached=event.get('cached', False), skipped=event['event'] == 'skipped',
+                     seconds=time.perf_counter() - start if start is not None else None)
+        elif event['event'] == 'failed':
+            job.track_progress(video_id)
+            job.increment(failed=1)
+            started.pop(video_id, None)
+            job.emit("failed", track=event['label'], video_id=video_id, stage="download", error=event['error'])
+            print(f"Error downloading '{event['label']}': {event['error']}")
+    return on_event
+
+def written_files(job):
+    # Video IDs a restarted job already wrote to the playlist folder
+    return {
+        key.split(":", 1)[1] for key, path in job.checkpoints().items()
+        if key.startswith("file:") and os.path.exists(path)
+    }
+
+def count_downloaded(results):
+    return sum(1 for result in results if result['status'] in ('downloaded', 'skipped'))
+
+@ZIP_SECONDS.time(mode="file")
+def zip_folder(playlist_folder, zip_file_path):
+    # Audio is already compressed, deflating it again only burns CPU
+    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_STORED) as zipf:
         for root, dirs, files in os.walk(playlist_folder):
             for file in files:
                 zipf.write(os.path.join(root, file),
                            os.path.relpath(os.path.join(root, file),
                            playlist_folder))
 
-    return redirect(f"/playlist-downloaded?playlist_name={playlist_name}&tracks_downloaded={tracks_downloaded}&zip_filename={playlist_name}.zip")
+def download_result(job_id, playlist_name, tracks_downloaded):
+    zip_filename = f"{download_name(playlist_name)}.zip"
+    query = urllib.parse.urlencode({
+        "playlist_name": playlist_name,
+        "tracks_downloaded": tracks_downloaded,
+        "job_id": job_id,
+        "zip_filename": zip_filename
+    })
+    return {
+        "message": f"Playlist '{playlist_name}' downloaded.",
+        "tracks_downloaded": tracks_downloaded,
+        "zip_filename": zip_filename,
+        "download_url": download_url(job_id, zip_filename),
+        "download_page": f"/playlist-downloaded?{query}"
+    }
 
-@app.route('/downloads/<filename>')
-def download_file(filename):
-    downloads_folder = os.path.expanduser("~/Downloads")
-    return send_from_directory(downloads_folder, filename)
+def download_url(job_id, filename):
+    return f"/downloads/{quote(job_id)}/{quote(filename)}"
+
+# Background jobs
+# Fills in the job page from /progress/<job_id>, newest track first
+PROGRESS_SCRIPT = """
+<script>
+(function () {
+    var source = new EventSource("/progress/JOB_ID");
+    var status = document.getElementById("job-status");
+    var tracks = document.getElementById("job-tracks");
+
+    function show(type, data) {
+        var item = document.createElement("li");
+        var text = type + ": " + (data.track || data.track_uri || data.video_id || "");
+        if (typeof data.seconds === "number") text += " (" + data.seconds.toFixed(1) + "s)";
+        if (data.error) text += " - " + data.error;
+        item.textContent = text;
+        tracks.insertBefore(item, tracks.firstChild);
+        while (tracks.children.length > 100) tracks.removeChild(tracks.lastChild);
+    }
+
+    ["started", "matched", "inserted", "downloaded", "failed"].forEach(function (type) {
+        source.addEventListener(type, function (e) { show(type, JSON.parse(e.data)); });
+    });
+    source.addEventListener("progress", function (e) {
+        var data = JSON.parse(e.data);
+        var counts = Object.keys(data).filter(function (key) { return typeof data[key] === "number"; })
+            .map(function (key) { return key.replace("_", " ") + ": " + data[key]; });
+        status.textContent = data.status + (counts.length ? " - " + counts.join(", ") : "");
+    });
+    source.addEventListener("end", function (e) {
+        var data = JSON.parse(e.data);
+        status.textContent = data.status === "finished" ? ((data.result && data.result.message) || "Finished.")
+            : "Failed: " + data.error;
+        source.close();
+    });
+})();
+</script>
+"""
+
+def admit_job(kind, owner):
+    # Called by job_queue.enqueue before it adds a new copy or download job, a
+    # reloaded page that gets its running job back is never refused
+    if job_queue.groups.get(kind) == "download":
+        storage.check_free()
+    if MAX_ACTIVE_JOBS_PER_USER and job_queue.store.count_active(owner) >= MAX_ACTIVE_JOBS_PER_USER:
+        raise RateLimited(
+            f"You already have {MAX_ACTIVE_JOBS_PER_USER} copies or downloads queued or running. "
+            "Please wait for one to finish.",
+            ADMISSION_RETRY_AFTER, "active_jobs"
+        )
+    retry_after = job_start_limiter.try_acquire(owner)
+    if retry_after:
+        raise RateLimited("You are starting copies and downloads too quickly.", retry_after, "rate")
+
+def admit_streaming_download(owner):
+    # Holds a streaming slot on success, released when the response is closed
+    storage.check_free()
+    if not streaming_downloads.try_acquire():
+        raise RateLimited("Too many streaming downloads are running right now.", ADMISSION_RETRY_AFTER, "streams")
+    retry_after = job_start_limiter.try_acquire(owner)
+    if retry_after:
+        streaming_downloads.release()
+        raise RateLimited("You are starting copies and downloads too quickly.", retry_after, "rate")
+
+def wants_json():
+    # /api/ routes answer in JSON whatever the client accepts, errors included
+    return request.accept_mimetypes.best == "application/json" or request.path.startswith("/api/")
+
+def job_started_response(job_id, message):
+    if wants_json():
+        return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}", "progress_url": f"/progress/{job_id}"}), 202
+
+    return (f"<h2>{message}</h2>"
+            f"<p>Job ID: {job_id}</p>"
+            f"<p id='job-status'>Waiting for the job to start...</p>"
+            f"<ul id='job-tracks'></ul>"
+            f"<p><a href='/jobs/{job_id}'>Check progress</a> | "
+            f"<a href='/jobs/{job_id}/result'>View result</a></p>"
+            f"<a href='/playlists'>Back to Playlists</a>"
+            f"{PROGRESS_SCRIPT.replace('JOB_ID', job_id)}"), 202
+
+def owned_job(job_id, session_id):
+    # Another session's job is treated as not found, job IDs alone give nothing away
+    job = job_queue.get(job_id)
+    if job is None or job.owner is None or job.owner != session_id:
+        return None
+    return job
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = owned_job(job_id, current_session_id())
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/progress/<job_id>")
+def job_progress(job_id):
+    # Server-sent events for one job: per-track events as they happen, the progress
+    # counters when they move, and "end" with the result. A browser that reconnects
+    # sends Last-Event-ID and only gets the events it missed, which is also how a
+    # stream cut short after SSE_MAX_DURATION carries on.
+    if owned_job(job_id, current_session_id()) is None:
+        return jsonify({"error": "Job not found"}), 404
+    stream = progress_stream(job_id, request.headers.get("Last-Event-ID", 0, type=int), SSE_MAX_DURATION)
+
+    def generate():
+        events, closed = progress_events.read(job_id, stream.after)
+        while True:
+            messages, done = stream.step(events, closed)
+            if messages:
+                yield "".join(messages)
+            if done:
+                return
+            events, closed = progress_events.wait(job_id, stream.after, stream.poll_interval)
+
+    return Response(generate(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+# Proxies must not buffer or cache the stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def progress_stream(job_id, after=0, max_duration=None):
+    # Shared with asgi.py, which holds no thread per stream and needs no max_duration
+    return ProgressStream(progress_events, job_id, job_queue.get, after, keepalive=SSE_KEEPALIVE,
+                          max_duration=max_duration)
+
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    job = owned_job(job_id, current_session_id())
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job.status == JOB_FAILED:
+        return jsonify({"status": job.status, "error": job.error}), 500
+    if job.status != JOB_FINISHED:
+        return jsonify({"status": job.status, "progress": job.progress}), 202
+    if "download_page" in job.result and request.accept_mimetypes.best != "application/json":
+        return redirect(job.result["download_page"])
+    return jsonify(job.result)
+
+@app.route('/downloads/<job_id>/<filename>')
+def download_file(job_id, filename):
+    # Range requests get a 206 so an interrupted download resumes, whole files go
+    # out through the server's wsgi.file_wrapper, sendfile under gunicorn.
+    # Another session's files are as not found as missing ones.
+    if storage.owner(job_id) != current_session_id():
+        abort(404)
+    folder = safe_join(storage.root, job_id)
+    path = safe_join(folder, filename) if folder else None
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    storage.touch(job_id)
+    if DOWNLOADS_ACCEL_REDIRECT:
+        return Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream", headers={
+            "X-Accel-Redirect": DOWNLOADS_ACCEL_REDIRECT.rstrip("/") + f"/{quote(job_id)}/{quote(filename)}"
+        })
+    return send_from_directory(folder, filename)
 
 @app.route("/playlist-downloaded")
 def playlist_downloaded():
     playlist_name = request.args.get('playlist_name')
     tracks_downloaded = request.args.get('tracks_downloaded', type=int)
-    zip_filename = request.args.get('zip_filename')
+    job_id = request.args.get('job_id', '')
+    zip_filename = request.args.get('zip_filename', '')
 
     return (f"<h2>PLAYLIST READY FOR DOWNLOAD</h2>"
             f"<p>Playlist Name: {playlist_name}</p>"
             f"<p>Number of Tracks Downloaded: {tracks_downloaded}</p>"
-            f"<p><a href='/downloads/{zip_filename}' download>Click here to download the ZIP file</a></p>")
+            f"<p><a href='{download_url(job_id, zip_filename)}' download>Click here to download the ZIP file</a></p>")
 
 @app.route("/refresh-token")
 def refresh_token():
-    if "refresh_token" not in session:
+    # Tokens are refreshed server-side before they expire, this only remains for old links
+    if token_store.load(session.get('sid'), "spotify") is None:
         return redirect("/login-spotify")
-    if datetime.now().timestamp() > session["expires_at"]:
-        req_body = {
-            "grant_type": "refresh_token",
-            "refresh_token": session["refresh_token"],
-            "client_id": SPOTIFY_CLIENT_ID,
-            "client_secret": SPOTIFY_CLIENT_SECRET
-        }
-    
-        response = requests.post(SPOTIFY_TOKEN_URL, data=req_body)
-        new_token_info = response.json()
-        session["access_token"] = new_token_info["access_token"]
-        session["expires_at"] = datetime.now().timestamp() + new_token_info["expires_in"]
-
-        return redirect("/playlists")
+    return redirect("/playlists")
 
 #Helper functions
 @app.route("/logout-all")
 def logout_all():
-    session.pop('access_token', None)
-    session.pop('refresh_token', None)
-    session.pop('expires_at', None)
-    session.pop('google_credentials', None)
+    page_cache.invalidate(session.get('sid'))
+    token_store.remove(session.get('sid'), "spotify")
+    token_store.remove(session.get('sid'), "google")
+    session.pop('sid', None)
     return redirect("/")
 
-def get_user_profile(headers):
-    response = requests.get(SPOTIFY_API_BASE_URL + "me", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    return None
+def get_user_profile(auth):
+    try:
+        return spotify.get_json("me", auth)
+    except SpotifyError:
+        return None
 
 def credentials_to_dict(credentials):
     return {
@@ -681,38 +2001,275 @@ def credentials_to_dict(credentials):
         'scopes': credentials.scopes
     }
 
-def check_session_and_get_headers():
-    if "access_token" not in session:
-        return redirect("/login"), None
-    
-    if datetime.now().timestamp() > session["expires_at"]:
-        return redirect("/refresh-token"), None
-    
-    headers = {
-        "Authorization": f"Bearer {session['access_token']}"
+def expiry_timestamp(expiry):
+    # google-auth keeps expiry as a naive UTC datetime
+    if expiry is None:
+        return None
+    return expiry.replace(tzinfo=timezone.utc).timestamp()
+
+def refresh_spotify_tokens(tokens):
+    response = spotify.post(SPOTIFY_TOKEN_URL, data={
+        "grant_type": "refresh_token",
+        "refresh_token": tokens["refresh_token"],
+        "client_id": SPOTIFY_CLIENT_ID,
+        "client_secret": SPOTIFY_CLIENT_SECRET
+    })
+    if response.status_code == 400:
+        # invalid_grant, the refresh token was revoked or has expired
+        raise TokenRevoked(error_message(response))
+    if response.status_code != 200:
+        raise SpotifyError(response.status_code, error_message(response))
+    new_token_info = response.json()
+    return {
+        "access_token": new_token_info["access_token"],
+        "refresh_token": new_token_info.get("refresh_token", tokens["refresh_token"]),
+        "expires_at": time.time() + new_token_info["expires_in"]
+    }
+
+def refresh_google_tokens(tokens):
+    credentials = Credentials(**tokens["credentials"])
+    try:
+        credentials.refresh(GoogleAuthRequest())
+    except RefreshError as e:
+        # The token endpoint's response, when there was one, follows the message
+        details = e.args[1] if len(e.args) > 1 and isinstance(e.args[1], dict) else {}
+        if details.get("error") == "invalid_grant":
+            raise TokenRevoked(str(e))
+        raise
+    return {
+        "credentials": credentials_to_dict(credentials),
+        "expires_at": expiry_timestamp(credentials.expiry)
     }
+
+token_store = TokenStore(
+    make_token_backend(TOKEN_BACKEND, TOKEN_DB_PATH),
+    {"spotify": refresh_spotify_tokens, "google": refresh_google_tokens},
+    refresh_margin=TOKEN_REFRESH_MARGIN
+)
+
+def current_session_id():
+    # The cookie only carries this ID, the tokens themselves stay on the server
+    if 'sid' not in session:
+        session['sid'] = uuid.uuid4().hex
+    return session['sid']
+
+def is_spotify_logged_in():
+    return token_store.has(session.get('sid'), "spotify")
+
+def is_google_logged_in():
+    return token_store.has(session.get('sid'), "google")
+
+def spotify_auth_for(session_id, conditional=False):
+    def get_token():
+        tokens = token_store.load(session_id, "spotify")
+        if tokens is None:
+            raise SpotifyError(401, "Not logged in to Spotify")
+        return tokens["access_token"]
+    return BearerAuth(get_token, cache_scope=session_id if conditional else None)
+
+def google_credentials_for(session_id):
+    tokens = token_store.load(session_id, "google")
+    if tokens is None:
+        return None
+    credentials = dict(tokens["credentials"])
+    if tokens.get("expires_at"):
+        credentials["expiry"] = datetime.fromtimestamp(tokens["expires_at"], timezone.utc).replace(tzinfo=None)
+    return credentials
+
+def session_google_credentials():
+    return google_credentials_for(session.get('sid'))
+
+def job_google_credentials(params):
+    credentials = google_credentials_for(params["session_id"])
+    if credentials is None:
+        raise JobError("Not logged in to Google. Please log in again.")
+    return credentials
+
+def check_session_and_get_auth():
+    session_id = session.get('sid')
+    if token_store.load(session_id, "spotify") is None:
+        return redirect("/login-spotify"), None
     
-    return None, headers
+    return None, spotify_auth_for(session_id, conditional=True)
 
 def get_youtube_service():
-    if 'google_credentials' not in session:
+    google_credentials = session_google_credentials()
+    if not google_credentials:
         return redirect("/login-google")
 
-    google_credentials = Credentials(**session['google_credentials'])
-    return build('youtube', 'v3', credentials=google_credentials)
-
-def youtube_request_with_backoff(request, max_retries=5):
+    return get_service(google_credentials)
+
+def is_fatal_match_error(error):
+    # A used up quota or a lost login fails every other search too, so it ends the
+    # job (or pauses it, for the quota) instead of counting as "no match"
+    if isinstance(error, (QuotaExceeded, RefreshError)):
+        return True
+    if isinstance(error, SpotifyError):
+        return error.status_code in (401, 403)
+    return isinstance(error, HttpError) and error.resp.status in (401, 403)
+
+@timed_match("spotify_to_youtube")
+def find_youtube_video(youtube, track):
+    # Returns (video_id, confidence), confidence is None for cached matches
+    track_name = track['name']
+    artists = ", ".join([artist['name'] for artist in track['artists']])
+    query_key = normalize_key(track_name, artists)
+
+    video_id = match_cache.get(SPOTIFY_TRACK, track.get('id')) or match_cache.get(SPOTIFY_QUERY, query_key)
+    if video_id:
+        return video_id, None
+
+    youtube_search_limiter.acquire()
+    search_response = youtube.search().list(
+        q=f"{clean_title(track_name)} {artists}",
+        type="video",
+        part="snippet",
+        maxResults=MATCH_CANDIDATES,
+        fields="items(id/videoId,snippet(title,channelTitle))"
+    ).execute()
+    if not search_response['items']:
+        return None, 0.0
+
+    # A search costs 100 quota units, the duration lookup for all candidates only 1
+    videos = get_videos(youtube, [item['id']['videoId'] for item in search_response['items']])
+    candidates = []
+    for item in search_response['items']:
+        candidate_id = item['id']['videoId']
+        duration = None
+        if candidate_id in videos:
+            duration = parse_duration(videos[candidate_id]['contentDetails']['duration'])
+        candidates.append(youtube_video_key(
+            candidate_id, item['snippet']['title'], item['snippet']['channelTitle'], duration
+        ))
+
+    video_id, confidence = best_match(spotify_track_key(track), candidates, MATCH_MIN_CONFIDENCE)
+    if not video_id:
+        print(f"No confident match for {track_name} by {artists} (best score {confidence:.2f})")
+        return None, confidence
+
+    match_cache.set(SPOTIFY_TRACK, track.get('id'), video_id)
+    match_cache.set(SPOTIFY_QUERY, query_key, video_id)
+    if track.get('id'):
+        match_cache.set(YOUTUBE_VIDEO, video_id, track.get('uri'))
+    return video_id, confidence
+
+@timed_match("youtube_to_spotify")
+def find_spotify_track(auth, video_id, video_title, channel=None, duration=None):
+    # Returns (track_uri, confidence), confidence is None for cached matches
+    title_key = normalize_key(video_title)
+
+    track_uri = match_cache.get(YOUTUBE_VIDEO, video_id) or match_cache.get(YOUTUBE_TITLE, title_key)
+    if track_uri:
+        return track_uri, None
+
+    spotify_search_limiter.acquire()
+    search_query = quote(clean_title(video_title) or video_title)
+    search_response = spotify.get(f"search?q={search_query}&type=track&limit={MATCH_CANDIDATES}", auth)
+    if search_response.status_code in (401, 403):
+        raise SpotifyError(search_response.status_code, error_message(search_response))
+    if search_response.status_code != 200 or not search_response.json()['tracks']['items']:
+        return None, 0.0
+
+    tracks = search_response.json()['tracks']['items']
+    source = youtube_video_key(video_id, video_title, channel, duration)
+    track_uri, confidence = best_match(source, [spotify_track_key(track) for track in tracks], MATCH_MIN_CONFIDENCE)
+    if not track_uri:
+        print(f"No confident match for {video_title} (best score {confidence:.2f})")
+        return None, confidence
+
+    track = next(track for track in tracks if track['uri'] == track_uri)
+    match_cache.set(YOUTUBE_VIDEO, video_id, track_uri)
+    match_cache.set(YOUTUBE_TITLE, title_key, track_uri)
+    match_cache.set(SPOTIFY_TRACK, track.get('id'), video_id)
+    return track_uri, confidence
+
+@app.route("/stats")
+def stats():
+    return jsonify({
+        "match_cache": match_cache.stats(),
+        "page_cache": page_cache.stats(),
+        "upstream_cache": upstream_cache.stats(),
+        "audio_store": audio_store.stats(),
+        "progress_events": progress_events.stats(),
+        "admission": {"streaming_downloads": streaming_downloads.in_use, "job_limits": JOB_LIMITS},
+        "storage": storage.stats(),
+        "youtube_quota": quota_ledger.snapshot(),
+        "spotify": spotify.stats.snapshot()
+    })
+
+def youtube_request_with_backoff(request, max_retries=5, cache_scope=None):
     for attempt in range(max_retries):
         try:
+            if cache_scope is not None:
+                return execute_conditional(request, upstream_cache, cache_scope)
             return request.execute()
         except HttpError as e:
-            if e.resp.status in [403, 500, 503] and attempt < max_retries - 1:
-                delay = 2 ** attempt
-                print(f"YouTube API request failed. Retrying in {delay} seconds...")
+            if is_youtube_retryable(e) and attempt < max_retries - 1:
+                delay = backoff_delay(attempt, base=1.0)
+                print(f"YouTube API request failed. Retrying in {delay:.1f} seconds...")
+                UPSTREAM_RETRIES.inc(service="youtube", endpoint=request.methodId or "other")
+                BACKOFF_SECONDS.inc(delay, service="youtube")
                 time.sleep(delay)
             else:
                 raise
     
+@app.errorhandler(QuotaExceeded)
+def quota_exceeded(e):
+    retry_after = max(1, int(e.resume_at - time.time()))
+    return f"<h2>YouTube quota used up for today</h2><p>{e}</p><a href='/playlists'>Back to Playlists</a>", 503, {
+        "Retry-After": str(retry_after)
+    }
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    ADMISSION_REFUSALS.inc(reason=e.reason)
+    retry_after = max(1, math.ceil(e.retry_after))
+    headers = {"Retry-After": str(retry_after)}
+    if wants_json():
+        return jsonify({"error": str(e), "retry_after": retry_after}), 429, headers
+    return (f"<h2>Too many requests</h2><p>{e} Try again in {retry_after} seconds.</p>"
+            f"<a href='/playlists'>Back to Playlists</a>"), 429, headers
+
+@app.errorhandler(StorageFull)
+def storage_full(e):
+    ADMISSION_REFUSALS.inc(reason="disk")
+    headers = {"Retry-After": str(storage.sweep_interval)}
+    if wants_json():
+        return jsonify({"error": str(e), "retry_after": storage.sweep_interval}), 507, headers
+    return (f"<h2>Downloads are paused</h2><p>{e} Try again later.</p>"
+            f"<a href='/playlists'>Back to Playlists</a>"), 507, headers
+
+def cache_counts():
+    counts = {}
+    caches = (("match", match_cache), ("page", page_cache), ("upstream", upstream_cache), ("audio", audio_store))
+    for name, cache in caches:
+        stats = cache.stats()
+        counts[(name, "hit")] = stats["hits"]
+        counts[(name, "miss")] = stats["misses"]
+    return counts
+
+def youtube_quota_units():
+    snapshot = quota_ledger.snapshot()
+    return {("budget",): snapshot["daily_budget"], ("used",): snapshot["used"], ("remaining",): snapshot["remaining"]}
+
+CallbackMetric("tunevert_cache_requests_total", "Cache lookups by result", cache_counts, ["cache", "result"],
+               kind="counter")
+CallbackMetric("tunevert_youtube_quota_units", "Today's YouTube API quota", youtube_quota_units, ["state"])
+
+def storage_bytes():
+    stats = storage.stats()
+    return {("artifacts",): stats["bytes"], ("reserved",): stats["reserved_bytes"], ("free",): stats["free_bytes"]}
+
+CallbackMetric("tunevert_download_storage_bytes", "Disk used by download artifacts and left free", storage_bytes,
+               ["state"])
+
+@app.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+job_queue.start()
+storage.start()
+
 if __name__ == "__main__":
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '0'
     app.run(host = "0.0.0.0", debug = True)
@@ -0,0 +1,155 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SPOTIFY_TRACK = "spotify_track"
+SPOTIFY_QUERY = "spotify_query"
+YOUTUBE_VIDEO = "youtube_video"
+YOUTUBE_TITLE = "youtube_title"
+
+
+def normalize_key(*parts):
+    text = " ".join(part for part in parts if part)
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class MemoryTier:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, match):
+        # Drops every entry whose key match(key) accepts
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                del self._entries[key]
+
+
+class MatchCache:
+    def __init__(self, path, ttl=30 * 24 * 3600, max_entries=200000, memory_entries=10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = MemoryTier(memory_entries) if memory_entries > 0 else None
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS matches (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        self._conn().execute("CREATE INDEX IF NOT EXISTS matches_accessed ON matches (accessed_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit, memory=False):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+                if memory:
+                    self.memory_hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, namespace, key):
+        if not key:
+            return None
+        if self.memory is not None:
+            value = self.memory.get((namespace, key))
+            if value is not None:
+                self._count(True, memory=True)
+                return value
+
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value, expires_at FROM matches WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None or row[1] < now:
+            if row is not None:
+                conn.execute("DELETE FROM matches WHERE namespace = ? AND key = ?", (namespace, key))
+            self._count(False)
+            return None
+
+        conn.execute(
+            "UPDATE matches SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key)
+        )
+        if self.memory is not None:
+            self.memory.set((namespace, key), row[0], row[1])
+        self._count(True)
+        return row[0]
+
+    def set(self, namespace, key, value):
+        if not key or not value:
+            return
+        now = time.time()
+        expires_at = now + self.ttl
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?)", (namespace, key, value, expires_at, now)
+        )
+        if self.memory is not None:
+            self.memory.set((namespace, key), value, expires_at)
+
+        with self._stats_lock:
+            self._writes += 1
+            evict = self._writes % 1000 == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM matches WHERE expires_at < ?", (time.time(),))
+        count = conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM matches WHERE rowid IN (SELECT rowid FROM matches ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,163 @@
+import contextvars
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+
+def match_concurrently(items, resolve, max_workers=8, is_fatal=None):
+    # Results come back in the same order as items, None where resolve failed.
+    # Errors is_fatal(error) accepts, like a used up quota, are raised instead:
+    # every other track would fail the same way.
+    def run(item):
+        try:
+            return resolve(item)
+        except Exception as e:
+            if is_fatal is not None and is_fatal(e):
+                raise
+            print(f"Error matching track: {str(e)}")
+            return None
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [run(item) for item in items]
+
+    # Workers run in the caller's context, so they still know which job they belong to
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, run, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+# Fuzzy scoring. Titles and artists are normalized once into a MatchKey, scoring
+# a candidate is then only set arithmetic, cheap enough for whole playlists.
+
+NOISE_WORDS = (
+    r"official|lyrics?|lyric video|audio|video|visuali[sz]er|hd|hq|4k|mv|m/v|"
+    r"explicit|clean|remaster(?:ed)?|\d{4} remaster(?:ed)?|music video"
+)
+NOISE_GROUP = re.compile(r"[\(\[\{][^\)\]\}]*\b(?:" + NOISE_WORDS + r")\b[^\)\]\}]*[\)\]\}]", re.IGNORECASE)
+NOISE_SUFFIX = re.compile(
+    r"\s+-\s+(?:[^-]*\bremaster(?:ed)?\b.*|(?:(?:" + NOISE_WORDS + r")\b\s*)+)$", re.IGNORECASE
+)
+FEATURING = re.compile(
+    r"[\(\[]\s*(?:feat|ft|featuring|with)\b\.?[^\)\]]*[\)\]]|\b(?:feat|ft|featuring)\b\.?\s[^\(\[\-]*",
+    re.IGNORECASE
+)
+CHANNEL_SUFFIX = re.compile(r"\s*(?:-\s*topic|vevo|official(?: channel)?|music)\s*$", re.IGNORECASE)
+NON_WORD = re.compile(r"[^\w]+")
+
+# A candidate differing from the source in one of these is a different recording
+VERSION_WORDS = frozenset({
+    "live", "remix", "cover", "karaoke", "instrumental", "acoustic", "nightcore",
+    "slowed", "reverb", "sped", "8d", "demo", "reprise", "unplugged"
+})
+
+
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return NON_WORD.sub(" ", text.casefold().replace("&", " and ")).split()
+
+
+def _drop_noise_group(match):
+    # "(8D Audio)" or "(Live Video)" still say which recording it is
+    if VERSION_WORDS.intersection(tokenize(match.group(0))):
+        return match.group(0)
+    return " "
+
+
+def clean_title(title):
+    title = NOISE_GROUP.sub(_drop_noise_group, title or "")
+    title = FEATURING.sub(" ", title)
+    return NOISE_SUFFIX.sub("", " ".join(title.split()))
+
+
+def clean_channel(channel):
+    return CHANNEL_SUFFIX.sub("", channel or "").strip()
+
+
+class MatchKey:
+    __slots__ = ("value", "title", "tokens", "artists", "duration", "versions")
+
+    def __init__(self, value, title, artists=(), duration=None):
+        self.value = value
+        self.title = frozenset(tokenize(clean_title(title)))
+        # Each artist as its tokens plus the name run together, so "ArianaGrandeVevo"
+        # still lines up with "Ariana Grande"
+        self.artists = tuple(
+            (frozenset(tokens), "".join(tokens))
+            for tokens in (tokenize(artist) for artist in artists) if tokens
+        )
+        tokens = set(self.title)
+        for artist_tokens, compact in self.artists:
+            tokens |= artist_tokens
+            tokens.add(compact)
+        self.tokens = frozenset(tokens)
+        self.duration = duration
+        self.versions = self.tokens & VERSION_WORDS
+
+
+def spotify_track_key(track):
+    return MatchKey(
+        track.get('uri'),
+        track.get('name'),
+        [artist['name'] for artist in track.get('artists', [])],
+        track['duration_ms'] / 1000 if track.get('duration_ms') else None
+    )
+
+
+def youtube_video_key(video_id, title, channel=None, duration=None):
+    return MatchKey(video_id, title, [clean_channel(channel)] if channel else (), duration)
+
+
+def _containment(part, whole):
+    return len(part & whole) / len(part) if part else 0.0
+
+
+def _dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 0.0
+
+
+def _artist_overlap(artists, tokens):
+    if not artists:
+        return 0.0
+    found = sum(1 for artist_tokens, compact in artists if compact in tokens or artist_tokens <= tokens)
+    return found / len(artists)
+
+
+def _duration_similarity(a, b):
+    # Full marks within 3 seconds, nothing left past 30. Unknown stays neutral.
+    if not a or not b:
+        return 0.5
+    difference = abs(a - b)
+    if difference <= 3:
+        return 1.0
+    return max(0.0, 1.0 - (difference - 3) / 27)
+
+
+def score(source, candidate):
+    # Either side's title may carry the artist too ("Artist - Song"), so containment runs both ways
+    title = max(_containment(source.title, candidate.tokens), _containment(candidate.title, source.tokens))
+    overall = _dice(source.tokens, candidate.tokens)
+    artist = max(_artist_overlap(source.artists, candidate.tokens),
+                 _artist_overlap(candidate.artists, source.tokens))
+    duration = _duration_similarity(source.duration, candidate.duration)
+    versions = len(source.versions ^ candidate.versions)
+    total = 0.35 * title + 0.15 * overall + 0.25 * artist + 0.25 * duration - 0.3 * versions
+    return min(1.0, max(0.0, total))
+
+
+def best_match(source, candidates, min_confidence=0.0):
+    # Returns (value, confidence). Ties keep the search engine's order.
+    best = None
+    best_score = 0.0
+    for candidate in candidates:
+        candidate_score = score(source, candidate)
+        if best is None or candidate_score > best_score:
+            best, best_score = candidate, candidate_score
+    if best is None or best_score < min_confidence:
+        return None, best_score
+    return best.value, best_score
@@ -0,0 +1,154 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Metrics in the Prometheus text format, without pulling in a client library
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in values.items()]
+
+
+class CallbackMetric:
+    # Read when scraped, for values other modules already keep. collect() returns
+    # {label values tuple: value}.
+    def __init__(self, name, help, collect, labelnames=(), kind="gauge", registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        registry.register(self)
+
+    def samples(self):
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {str(e)}")
+            return []
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in values.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+# Shared by the client modules and main.py
+UPSTREAM_SECONDS = Histogram(
+    "tunevert_upstream_request_seconds", "Upstream API call latency including retries",
+    ["service", "endpoint"]
+)
+UPSTREAM_RETRIES = Counter("tunevert_upstream_retries_total", "Upstream API retries", ["service", "endpoint"])
+UPSTREAM_FAILURES = Counter(
+    "tunevert_upstream_failures_total", "Upstream API calls that ended in an error", ["service", "endpoint"]
+)
+BACKOFF_SECONDS = Counter("tunevert_backoff_sleep_seconds_total", "Time spent sleeping before retries", ["service"])
+MATCH_SECONDS = Histogram("tunevert_match_seconds", "Time to match one track, searches included", ["direction", "source"])
+DOWNLOAD_SECONDS = Histogram("tunevert_download_seconds", "yt-dlp download time per track")
+TRANSCODE_SECONDS = Histogram("tunevert_transcode_seconds", "Time to produce the output file per track", ["profile"])
+TRANSCODE_CPU_SECONDS = Histogram(
+    "tunevert_transcode_cpu_seconds", "ffmpeg CPU time (user + system) per track", ["profile"]
+)
+ZIP_SECONDS = Histogram("tunevert_zip_seconds", "Time to write a playlist archive", ["mode"])
+REQUEST_SECONDS = Histogram("tunevert_request_seconds", "Request duration per route", ["route", "method", "status"])
+JOB_SECONDS = Histogram("tunevert_job_seconds", "Job run time", ["kind", "status"])
+ADMISSION_REFUSALS = Counter("tunevert_admission_refusals_total", "Copies and downloads refused by admission control", ["reason"])
@@ -0,0 +1,214 @@
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+from zoneinfo import ZoneInfo
+
+from jobs import JobPaused, current_job
+
+# Units per call from the YouTube Data API quota table, everything else costs 1
+QUOTA_COSTS = {
+    "search.list": 100,
+    "playlists.insert": 50,
+    "playlists.update": 50,
+    "playlists.delete": 50,
+    "playlistItems.insert": 50,
+    "playlistItems.update": 50,
+    "playlistItems.delete": 50,
+    "videos.insert": 1600,
+}
+DEFAULT_COST = 1
+HTTP_VERBS = {"GET": "list", "POST": "insert", "PUT": "update", "DELETE": "delete"}
+BATCH_PART = re.compile(r"^(GET|POST|PUT|DELETE) (\S+) HTTP/1\.1", re.MULTILINE)
+# A batch part's Content-ID, then the rest of its headers. Responses carry the
+# request's ID prefixed with "response-".
+BATCH_PART_ID = r"^Content-ID: <(?:response-)?[^>]*\+\s*([^>]*?)>(?:\r?\n[^\r\n]+)*\r?\n\r?\n"
+BATCH_REQUEST = re.compile(BATCH_PART_ID + r"(GET|POST|PUT|DELETE) (\S+) HTTP/1\.1", re.MULTILINE)
+BATCH_RESPONSE = re.compile(BATCH_PART_ID + r"HTTP/1\.1 (\d{3})", re.MULTILINE)
+
+# The daily quota resets at midnight Pacific Time
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+
+class QuotaExceeded(JobPaused):
+    # A JobPaused, so a job that runs into it waits in the queue for the reset
+    def __init__(self, resume_at):
+        super().__init__(
+            resume_at, f"YouTube API quota exhausted until {datetime.fromtimestamp(resume_at):%Y-%m-%d %H:%M}"
+        )
+        self.resume_at = resume_at
+
+
+def api_method(http_method, uri):
+    # "GET .../youtube/v3/search" -> "search.list"
+    path = urlparse(uri).path
+    if "/youtube/v3/" not in path:
+        return None
+    resource = path.split("/youtube/v3/", 1)[1].split("/")[0]
+    return f"{resource}.{HTTP_VERBS.get(http_method, 'list')}"
+
+
+def is_batch(uri):
+    # Google's endpoint is /batch/youtube/v3, a mock server's may be plain /batch
+    path = urlparse(uri).path
+    return "/batch/" in path or path.endswith("/batch")
+
+
+def call_methods(http_method, uri, body=None):
+    # A batch request is billed per call inside it
+    if is_batch(uri) and body:
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", "replace")
+        return [method for method in (api_method(verb, path) for verb, path in BATCH_PART.findall(body)) if method]
+    method = api_method(http_method, uri)
+    return [method] if method else []
+
+
+def failed_batch_methods(body, content, statuses):
+    # The API methods of the calls in a batch whose response status is in statuses.
+    # Parts are matched by Content-ID, YouTube may answer them in any order.
+    calls = {
+        call_id: api_method(verb, path) for call_id, verb, path in BATCH_REQUEST.findall(_as_text(body))
+    }
+    return [
+        calls[call_id] for call_id, status in BATCH_RESPONSE.findall(_as_text(content))
+        if int(status) in statuses and calls.get(call_id)
+    ]
+
+
+def _as_text(data):
+    return data.decode("utf-8", "replace") if isinstance(data, bytes) else data or ""
+
+
+def cost(method):
+    return QUOTA_COSTS.get(method, DEFAULT_COST)
+
+
+def quota_day(now=None):
+    return datetime.fromtimestamp(now or time.time(), QUOTA_TIMEZONE).date().isoformat()
+
+
+def next_reset(now=None):
+    today = datetime.fromtimestamp(now or time.time(), QUOTA_TIMEZONE).date()
+    midnight = datetime.combine(today + timedelta(days=1), datetime.min.time(), QUOTA_TIMEZONE)
+    return midnight.timestamp()
+
+
+class QuotaLedger:
+    # Records the units spent per day, user and API method. Kept in SQLite so every
+    # worker process draws from the same daily budget.
+    #
+    # Jobs may spend the budget down to `reserve`, which is left for interactive
+    # page views. Either gets QuotaExceeded at its limit, which pauses a job until the
+    # quota resets instead of failing it. user_budget caps what a single user can
+    # spend in a day, 0 for no cap.
+
+    def __init__(self, path, daily_budget=10000, reserve=0, user_budget=0):
+        self.path = path
+        self.daily_budget = daily_budget
+        self.reserve = reserve
+        self.user_budget = user_budget
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                day TEXT NOT NULL,
+                user TEXT NOT NULL,
+                method TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                units INTEGER NOT NULL,
+                PRIMARY KEY (day, user, method)
+            )
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS exhausted (day TEXT PRIMARY KEY)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _used(self, conn, day, user=None):
+        if user is None:
+            row = conn.execute("SELECT COALESCE(SUM(units), 0) FROM usage WHERE day = ?", (day,)).fetchone()
+        else:
+            row = conn.execute(
+                "SELECT COALESCE(SUM(units), 0) FROM usage WHERE day = ? AND user = ?", (day, user)
+            ).fetchone()
+        return row[0]
+
+    def _try_spend(self, methods, user, interactive):
+        units = sum(cost(method) for method in methods)
+        day = quota_day()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM exhausted WHERE day = ?", (day,)).fetchone():
+                conn.execute("ROLLBACK")
+                return False
+            limit = self.daily_budget if interactive else self.daily_budget - self.reserve
+            if self._used(conn, day) + units > limit:
+                conn.execute("ROLLBACK")
+                return False
+            if self.user_budget and not interactive and self._used(conn, day, user) + units > self.user_budget:
+                conn.execute("ROLLBACK")
+                return False
+            for method in methods:
+                conn.execute(
+                    "INSERT INTO usage VALUES (?, ?, ?, 1, ?) "
+                    "ON CONFLICT (day, user, method) DO UPDATE SET calls = calls + 1, units = units + excluded.units",
+                    (day, user, method, cost(method))
+                )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def spend(self, methods, user):
+        # Called before every API call
+        if not methods:
+            return
+        if not self._try_spend(methods, user, interactive=current_job.get() is None):
+            raise QuotaExceeded(next_reset())
+
+    def refund(self, methods, user):
+        # Takes back what spend() billed for calls that are made again
+        day = quota_day()
+        conn = self._conn()
+        for method in methods:
+            conn.execute(
+                "UPDATE usage SET calls = calls - 1, units = units - ? WHERE day = ? AND user = ? AND method = ?",
+                (cost(method), day, user, method)
+            )
+
+    def mark_exhausted(self):
+        # YouTube said quotaExceeded, whatever our own count says
+        self._conn().execute("INSERT OR IGNORE INTO exhausted VALUES (?)", (quota_day(),))
+
+    def snapshot(self):
+        day = quota_day()
+        conn = self._conn()
+        used = self._used(conn, day)
+        exhausted = conn.execute("SELECT 1 FROM exhausted WHERE day = ?", (day,)).fetchone() is not None
+        methods = {
+            method: {"calls": calls, "units": units}
+            for method, calls, units in conn.execute(
+                "SELECT method, SUM(calls), SUM(units) FROM usage WHERE day = ? GROUP BY method", (day,)
+            )
+        }
+        users = dict(conn.execute("SELECT user, SUM(units) FROM usage WHERE day = ? GROUP BY user", (day,)))
+        return {
+            "day": day,
+            "daily_budget": self.daily_budget,
+            "used": used,
+            "remaining": 0 if exhausted else max(0, self.daily_budget - used),
+            "exhausted": exhausted,
+            "resets_at": next_reset(),
+            "methods": methods,
+            "users": users
+        }
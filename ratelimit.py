@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    # A request refused by admission control, retry_after is in seconds
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens=1):
+        # Takes the tokens now and returns how long the caller has to wait before using them
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+        if self.rate <= 0:
+            return
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait_time(self, tokens=1):
+        # How long until the tokens are there, without taking them
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (tokens - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    # A token bucket per key, e.g. a user, under one global bucket. try_acquire()
+    # takes a token from both or from neither, and never waits.
+    def __init__(self, rate, capacity=None, global_rate=0, global_capacity=None, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.global_bucket = TokenBucket(global_rate, global_capacity)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # The least recently used key goes, it has had time to refill anyway
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        self._buckets.move_to_end(key)
+        return bucket
+
+    def try_acquire(self, key, tokens=1):
+        # 0.0 when the tokens were taken, otherwise seconds until they would be
+        with self._lock:
+            bucket = self._bucket(key)
+            delay = max(bucket.wait_time(tokens), self.global_bucket.wait_time(tokens))
+            if delay > 0:
+                return delay
+            if bucket.rate > 0:
+                bucket.reserve(tokens)
+            if self.global_bucket.rate > 0:
+                self.global_bucket.reserve(tokens)
+            return 0.0
+
+
+class ConcurrencyLimit:
+    # At most `limit` holders at once, 0 for no limit. try_acquire() doesn't wait.
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.limit and self.in_use >= self.limit:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
@@ -0,0 +1,45 @@
+import hashlib
+import threading
+import time
+
+from match_cache import MemoryTier
+
+
+class ResponseCache:
+    # Short-lived per-user cache. Entries are keyed by a scope (the session ID)
+    # and invalidating a scope drops its entries, nothing is kept per scope
+    # outside the LRU.
+    def __init__(self, ttl, max_entries=2000):
+        self.ttl = ttl
+        self.memory = MemoryTier(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, scope, key):
+        value = self.memory.get((scope, key))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, scope, key, value, ttl=None):
+        self.memory.set((scope, key), value, time.time() + (ttl or self.ttl))
+
+    def invalidate(self, scope):
+        self.memory.discard(lambda entry: entry[0] == scope)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+def etag_for(body):
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
@@ -0,0 +1,370 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.exceptions import NewConnectionError
+
+from metrics import BACKOFF_SECONDS, UPSTREAM_FAILURES, UPSTREAM_RETRIES, UPSTREAM_SECONDS
+
+SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1/"
+
+# Only the parts of a playlist track the app actually reads
+PLAYLIST_TRACK_FIELDS = "next,total,items(track(id,uri,name,duration_ms,artists(name)))"
+PLAYLIST_TRACKS_PER_PAGE = 100
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+ENDPOINT_WORDS = {"v1", "api", "me", "playlists", "tracks", "users", "search", "token", "browse"}
+
+
+class SpotifyError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(f"Spotify API error. Status code: {status_code}. Message: {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+def error_message(response):
+    try:
+        error = response.json().get('error', {})
+    except ValueError:
+        return 'Unknown error'
+    if isinstance(error, dict):
+        return error.get('message', 'Unknown error')
+    return response.json().get('error_description', error)
+
+
+class BearerAuth(AuthBase):
+    # Looks the token up on every request, so long-running jobs pick up refreshed tokens.
+    # With a cache scope, GETs made with this auth become conditional requests.
+    def __init__(self, get_token, cache_scope=None):
+        self.get_token = get_token
+        self.cache_scope = cache_scope
+
+    def __call__(self, request):
+        request.headers["Authorization"] = f"Bearer {self.get_token()}"
+        return request
+
+
+def endpoint_name(method, url):
+    # "GET playlists/{id}/tracks", IDs are folded so stats stay per endpoint
+    segments = [segment if segment in ENDPOINT_WORDS else "{id}"
+                for segment in urlparse(url).path.strip("/").split("/") if segment]
+    if segments and segments[0] == "v1":
+        segments = segments[1:]
+    return f"{method} {'/'.join(segments)}"
+
+
+class EndpointStats:
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, retries, failed):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {
+                "calls": 0, "retries": 0, "failures": 0, "total_seconds": 0.0, "max_seconds": 0.0
+            })
+            stats["calls"] += 1
+            stats["retries"] += retries
+            stats["failures"] += 1 if failed else 0
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: dict(stats, avg_seconds=stats["total_seconds"] / stats["calls"])
+                for endpoint, stats in self._stats.items()
+            }
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_retryable(method, response):
+    # Only a 429 is known not to have been applied, so writes retry on nothing else
+    return response.status_code == 429 or (method == "GET" and response.status_code in RETRY_STATUSES)
+
+
+def is_retryable_error(method, error):
+    # A GET is retried after any connection error or timeout. A write may have
+    # been applied when the connection broke or timed out after it was sent, only
+    # failing to connect at all is known to have sent nothing.
+    if method == "GET" or isinstance(error, (requests.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def retry_after_delay(response, retries, base, cap):
+    # A long Retry-After is cut to cap, the worker waiting on it has other work
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return min(cap, float(retry_after)) + random.uniform(0, base)
+        except ValueError:
+            pass
+    return backoff_delay(retries, base, cap)
+
+
+def record_call(stats, endpoint, elapsed, retries, response):
+    failed = response is None or response.status_code >= 400
+    stats.record(endpoint, elapsed, retries, failed)
+    UPSTREAM_SECONDS.observe(elapsed, service="spotify", endpoint=endpoint)
+    if retries:
+        UPSTREAM_RETRIES.inc(retries, service="spotify", endpoint=endpoint)
+    if failed:
+        UPSTREAM_FAILURES.inc(service="spotify", endpoint=endpoint)
+
+
+class SpotifyClient:
+    # One pooled keep-alive session for every Spotify call, with retries on
+    # 429 (honouring Retry-After) and transient 5xx responses
+
+    def __init__(self, base_url=SPOTIFY_API_BASE_URL, pool_size=32, max_retries=5, backoff_base=0.5,
+                 max_backoff=30.0, timeout=30, etag_cache=None):
+        self.base_url = base_url
+        self.etag_cache = etag_cache
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.stats = EndpointStats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path):
+        return path if path.startswith("http") else self.base_url + path
+
+    def request(self, method, path, **kwargs):
+        url = self.url(path)
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = endpoint_name(method, url)
+        start = time.perf_counter()
+        retries = 0
+        response = None
+        try:
+            while True:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    # A ReadTimeout is no ConnectionError, only a ConnectTimeout is both
+                    if not is_retryable_error(method, e) or retries >= self.max_retries:
+                        raise
+                    delay = backoff_delay(retries, self.backoff_base, self.max_backoff)
+                else:
+                    if not is_retryable(method, response) or retries >= self.max_retries:
+                        return response
+                    delay = retry_after_delay(response, retries, self.backoff_base, self.max_backoff)
+                retries += 1
+                print(f"Spotify request {endpoint} failed. Retrying in {delay:.1f} seconds...")
+                BACKOFF_SECONDS.inc(delay, service="spotify")
+                time.sleep(delay)
+        finally:
+            record_call(self.stats, endpoint, time.perf_counter() - start, retries, response)
+
+    def get(self, path, auth, params=None):
+        return self.request("GET", path, auth=auth, params=params)
+
+    def post(self, path, auth=None, **kwargs):
+        return self.request("POST", path, auth=auth, **kwargs)
+
+    def get_json(self, path, auth, params=None):
+        scope = getattr(auth, "cache_scope", None)
+        if self.etag_cache is None or scope is None:
+            response = self.get(path, auth, params)
+            if response.status_code != 200:
+                raise SpotifyError(response.status_code, error_message(response))
+            return response.json()
+
+        # Revalidate with the ETag from last time, a 304 reuses the body we already have
+        key = (self.url(path), tuple(sorted((params or {}).items())))
+        cached = self.etag_cache.get(scope, key)
+        headers = {"If-None-Match": cached[0]} if cached else None
+        response = self.request("GET", path, auth=auth, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        if response.status_code != 200:
+            raise SpotifyError(response.status_code, error_message(response))
+        data = response.json()
+        if response.headers.get("ETag"):
+            self.etag_cache.set(scope, key, (response.headers["ETag"], data))
+        return data
+
+    def iter_pages(self, path, auth, params=None, prefetch=True):
+        # Follows "next" links and yields one page at a time. With prefetch the
+        # next page is already in flight while the caller handles the current one.
+        params = dict(params or {})
+
+        def fetch(page_url, first):
+            page_params = params if first else _missing_params(page_url, params)
+            return self.get_json(page_url, auth, page_params)
+
+        if not prefetch:
+            page = fetch(path, True)
+            while True:
+                yield page
+                if not page.get('next'):
+                    return
+                page = fetch(page['next'], False)
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(fetch, path, True)
+            while pending is not None:
+                page = pending.result()
+                pending = pool.submit(fetch, page['next'], False) if page.get('next') else None
+                yield page
+
+    def iter_items(self, path, auth, params=None, prefetch=True):
+        for page in self.iter_pages(path, auth, params, prefetch):
+            yield from page.get('items', [])
+
+    def iter_playlist_tracks(self, playlist_id, auth, prefetch=True):
+        for page in self.playlist_track_pages(playlist_id, auth, prefetch):
+            yield from page['items']
+
+    def playlist_track_pages(self, playlist_id, auth, prefetch=True):
+        # Skips entries whose track has been removed from Spotify
+        params = {"limit": PLAYLIST_TRACKS_PER_PAGE, "fields": PLAYLIST_TRACK_FIELDS}
+        for page in self.iter_pages(f"playlists/{playlist_id}/tracks", auth, params, prefetch):
+            page['items'] = [item for item in page.get('items', []) if item.get('track')]
+            yield page
+
+    def playlist_track_page(self, playlist_id, auth, offset=0):
+        # The page of playlist_track_pages() starting at offset, for callers keeping their own cursor
+        params = {"limit": PLAYLIST_TRACKS_PER_PAGE, "offset": offset, "fields": PLAYLIST_TRACK_FIELDS}
+        page = self.get_json(f"playlists/{playlist_id}/tracks", auth, params)
+        page['items'] = [item for item in page.get('items', []) if item.get('track')]
+        return page
+
+    def iter_user_playlists(self, auth, prefetch=True):
+        return self.iter_items("me/playlists", auth, {"limit": 50}, prefetch)
+
+
+class AsyncSpotifyClient:
+    # The same calls, retries and conditional GETs as SpotifyClient on an httpx
+    # connection pool, for the ASGI entry point. Shares the ETag cache and the
+    # endpoint stats with the sync client so both modes read the same numbers.
+
+    def __init__(self, base_url=SPOTIFY_API_BASE_URL, max_connections=100, max_retries=5, backoff_base=0.5,
+                 max_backoff=30.0, timeout=30, etag_cache=None, stats=None):
+        self.base_url = base_url
+        self.etag_cache = etag_cache
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.stats = stats or EndpointStats()
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    def url(self, path):
+        return path if path.startswith("http") else self.base_url + path
+
+    async def request(self, method, path, auth=None, headers=None, **kwargs):
+        url = self.url(path)
+        endpoint = endpoint_name(method, url)
+        headers = dict(headers or {})
+        if auth is not None:
+            # The token store may have to refresh, which is blocking I/O
+            headers["Authorization"] = f"Bearer {await asyncio.to_thread(auth.get_token)}"
+        start = time.perf_counter()
+        retries = 0
+        response = None
+        try:
+            while True:
+                try:
+                    response = await self.client.request(method, url, headers=headers, **kwargs)
+                except httpx.TransportError as e:
+                    if not is_retryable_error(method, e) or retries >= self.max_retries:
+                        raise
+                    delay = backoff_delay(retries, self.backoff_base, self.max_backoff)
+                else:
+                    if not is_retryable(method, response) or retries >= self.max_retries:
+                        return response
+                    delay = retry_after_delay(response, retries, self.backoff_base, self.max_backoff)
+                retries += 1
+                print(f"Spotify request {endpoint} failed. Retrying in {delay:.1f} seconds...")
+                BACKOFF_SECONDS.inc(delay, service="spotify")
+                await asyncio.sleep(delay)
+        finally:
+            record_call(self.stats, endpoint, time.perf_counter() - start, retries, response)
+
+    async def get_json(self, path, auth, params=None):
+        scope = getattr(auth, "cache_scope", None)
+        if self.etag_cache is None or scope is None:
+            response = await self.request("GET", path, auth=auth, params=params)
+            if response.status_code != 200:
+                raise SpotifyError(response.status_code, error_message(response))
+            return response.json()
+
+        key = (self.url(path), tuple(sorted((params or {}).items())))
+        cached = self.etag_cache.get(scope, key)
+        headers = {"If-None-Match": cached[0]} if cached else None
+        response = await self.request("GET", path, auth=auth, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        if response.status_code != 200:
+            raise SpotifyError(response.status_code, error_message(response))
+        data = response.json()
+        if response.headers.get("ETag"):
+            self.etag_cache.set(scope, key, (response.headers["ETag"], data))
+        return data
+
+    async def iter_pages(self, path, auth, params=None):
+        # The next page is requested before the current one is handed out
+        params = dict(params or {})
+        pending = asyncio.ensure_future(self.get_json(path, auth, params))
+        try:
+            while pending is not None:
+                page = await pending
+                pending = None
+                if page.get('next'):
+                    pending = asyncio.ensure_future(
+                        self.get_json(page['next'], auth, _missing_params(page['next'], params))
+                    )
+                yield page
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def iter_items(self, path, auth, params=None):
+        async for page in self.iter_pages(path, auth, params):
+            for item in page.get('items', []):
+                yield item
+
+    async def iter_playlist_tracks(self, playlist_id, auth):
+        async for page in self.playlist_track_pages(playlist_id, auth):
+            for item in page['items']:
+                yield item
+
+    async def playlist_track_pages(self, playlist_id, auth):
+        params = {"limit": PLAYLIST_TRACKS_PER_PAGE, "fields": PLAYLIST_TRACK_FIELDS}
+        async for page in self.iter_pages(f"playlists/{playlist_id}/tracks", auth, params):
+            page['items'] = [item for item in page.get('items', []) if item.get('track')]
+            yield page
+
+    def iter_user_playlists(self, auth):
+        return self.iter_items("me/playlists", auth, {"limit": 50})
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def _missing_params(url, params):
+    # Spotify keeps most query parameters in "next" links, re-add any it dropped
+    present = parse_qs(urlparse(url).query)
+    missing = {key: value for key, value in params.items() if key not in present}
+    return missing or None
@@ -0,0 +1,211 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+class StorageFull(Exception):
+    pass
+
+
+def artifact_size(path):
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(folder, name))
+            for folder, _, names in os.walk(path) for name in names
+            if os.path.isfile(os.path.join(folder, name))
+        )
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class StorageManager:
+    # The playlist folders and ZIPs download jobs write under root, each job in a
+    # folder of its own. Each is recorded with the job that wrote it and the session
+    # it ran for, and serving a file counts as an access. A sweeper
+    # thread removes artifacts nobody accessed for `ttl` seconds, then the least
+    # recently accessed ones while the total is over max_bytes. Anything in root
+    # that wasn't recorded here is never touched, it may be the user's own files.
+    #
+    # A job reserves the space it expects to need before it downloads anything,
+    # and is refused when that would leave less than min_free_bytes on the disk.
+
+    def __init__(self, root, max_bytes=0, ttl=0, min_free_bytes=0, is_active=None, sweep_interval=300):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.min_free_bytes = min_free_bytes
+        # is_active(job_id) keeps the artifacts of unfinished jobs from being swept
+        self.is_active = is_active
+        self.sweep_interval = sweep_interval
+        self._reserved = {}
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._reserve_lock = threading.Lock()
+        self._local = threading.local()
+        self._started_pid = None
+        os.makedirs(self.root, exist_ok=True)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS artifacts (
+                name TEXT PRIMARY KEY,
+                job_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                owner TEXT
+            )
+        """)
+        if "owner" not in [row[1] for row in self._conn().execute("PRAGMA table_info(artifacts)")]:
+            self._conn().execute("ALTER TABLE artifacts ADD COLUMN owner TEXT")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS artifacts_accessed ON artifacts (accessed_at)")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS artifacts_job ON artifacts (job_id)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, ".tunevert-downloads.db"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _inside(self, path):
+        # Only paths strictly below root are ours to record or remove
+        root = os.path.realpath(self.root)
+        path = os.path.realpath(path)
+        return path != root and os.path.commonpath([root, path]) == root
+
+    def job_folder(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def add(self, job_id, owner, *paths):
+        # Records paths in the job's folder as written by the job for owner, sizes
+        # follow in finish()
+        now = time.time()
+        folder = self.job_folder(job_id)
+        for path in paths:
+            if not self._inside(path) or os.path.commonpath([folder, os.path.abspath(path)]) != folder:
+                raise ValueError(f"'{path}' is not inside {folder}")
+            self._conn().execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, 0, ?, ?, ?)",
+                (os.path.relpath(path, self.root), job_id, now, now, owner)
+            )
+
+    def owner(self, job_id):
+        # The session the job's artifacts belong to, None when there are none
+        row = self._conn().execute("SELECT owner FROM artifacts WHERE job_id = ? LIMIT 1", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def finish(self, job_id):
+        # The job is done writing, whether it succeeded or not
+        conn = self._conn()
+        for (name,) in conn.execute("SELECT name FROM artifacts WHERE job_id = ?", (job_id,)).fetchall():
+            conn.execute(
+                "UPDATE artifacts SET size = ?, accessed_at = ? WHERE name = ?",
+                (artifact_size(os.path.join(self.root, name)), time.time(), name)
+            )
+        with self._lock:
+            self._reserved.pop(job_id, None)
+        if self.max_bytes:
+            self.sweep()
+
+    def touch(self, job_id):
+        self._conn().execute("UPDATE artifacts SET accessed_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def free_bytes(self):
+        # What the disk has left once running jobs have written what they reserved
+        with self._lock:
+            reserved = sum(self._reserved.values())
+        return shutil.disk_usage(self.root).free - reserved
+
+    def check_free(self, needed=0):
+        # Raises StorageFull when `needed` more bytes would leave less than
+        # min_free_bytes, after sweeping what can go
+        if self.free_bytes() - needed >= self.min_free_bytes:
+            return
+        self.sweep()
+        free = self.free_bytes()
+        if free - needed < self.min_free_bytes:
+            available = max(0, free - self.min_free_bytes) / 1024 ** 3
+            if needed:
+                raise StorageFull(
+                    f"Not enough disk space: this needs about {needed / 1024 ** 3:.1f} GB "
+                    f"and {available:.1f} GB are available."
+                )
+            raise StorageFull("Not enough disk space for new downloads right now.")
+
+    def reserve(self, job_id, needed):
+        # One check at a time, so two jobs can't both count on the same free space
+        with self._reserve_lock:
+            self.check_free(needed)
+            with self._lock:
+                self._reserved[job_id] = needed
+
+    def _in_use(self, job_id):
+        with self._lock:
+            if job_id in self._reserved:
+                return True
+        return self.is_active is not None and self.is_active(job_id)
+
+    def sweep(self):
+        # Returns the bytes freed
+        with self._sweep_lock:
+            conn = self._conn()
+            rows = conn.execute("SELECT name, job_id, size, accessed_at FROM artifacts ORDER BY accessed_at").fetchall()
+            total = sum(row[2] for row in rows)
+            freed = 0
+            now = time.time()
+            for name, job_id, size, accessed_at in rows:
+                expired = self.ttl and now - accessed_at > self.ttl
+                if not expired and not (self.max_bytes and total > self.max_bytes):
+                    break
+                if self._in_use(job_id):
+                    continue
+                if self._remove(name):
+                    total -= size
+                    freed += size
+            return freed
+
+    def _remove(self, name):
+        path = os.path.join(self.root, name)
+        if not self._inside(path):
+            print(f"Not removing '{name}', it is outside {self.root}")
+            self._conn().execute("DELETE FROM artifacts WHERE name = ?", (name,))
+            return False
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Error removing '{name}': {str(e)}")
+            return False
+        self._conn().execute("DELETE FROM artifacts WHERE name = ?", (name,))
+        return True
+
+    def start(self):
+        # The sweeper thread, started again after a fork like JobQueue.start()
+        with self._lock:
+            if self._started_pid == os.getpid() or not (self.ttl or self.max_bytes):
+                return
+            self._started_pid = os.getpid()
+        threading.Thread(target=self._sweep_forever, name="storage-sweeper", daemon=True).start()
+
+    def _sweep_forever(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error sweeping downloads: {str(e)}")
+            time.sleep(self.sweep_interval)
+
+    def stats(self):
+        entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts").fetchone()
+        with self._lock:
+            reserved = sum(self._reserved.values())
+        return {
+            "artifacts": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "reserved_bytes": reserved,
+            "free_bytes": shutil.disk_usage(self.root).free
+        }
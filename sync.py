@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+
+
+class PlaylistLink:
+    # Remembers where a source playlist was synced to. items pairs every source
+    # track with what was put into the target for it: a YouTube playlist item ID
+    # or a Spotify track URI, None when no match was found.
+    def __init__(self, source_platform, source_id, owner, target_id, version=None, items=None, updated_at=None):
+        self.source_platform = source_platform
+        self.source_id = source_id
+        self.owner = owner
+        self.target_id = target_id
+        self.version = version
+        self.items = items or []
+        self.updated_at = updated_at or time.time()
+
+
+class SyncStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS links (
+                source_platform TEXT NOT NULL,
+                source_id TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                target_id TEXT NOT NULL,
+                version TEXT,
+                items TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (source_platform, source_id, owner)
+            )
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, source_platform, source_id, owner):
+        row = self._conn().execute(
+            "SELECT target_id, version, items, updated_at FROM links "
+            "WHERE source_platform = ? AND source_id = ? AND owner = ?",
+            (source_platform, source_id, owner)
+        ).fetchone()
+        if not row:
+            return None
+        return PlaylistLink(source_platform, source_id, owner, row[0], row[1],
+                            [tuple(item) for item in json.loads(row[2])], row[3])
+
+    def save(self, link):
+        link.updated_at = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (link.source_platform, link.source_id, link.owner, link.target_id, link.version,
+             json.dumps(link.items), link.updated_at)
+        )
+
+    def delete(self, source_platform, source_id, owner):
+        self._conn().execute(
+            "DELETE FROM links WHERE source_platform = ? AND source_id = ? AND owner = ?",
+            (source_platform, source_id, owner)
+        )
+
+
+def diff_items(items, source_keys):
+    # Compares the linked items against the source as it is now. Duplicates are
+    # matched one to one. Returns (added, removed, kept): added holds indexes into
+    # source_keys, removed and kept hold linked items.
+    linked = defaultdict(deque)
+    for item in items:
+        linked[item[0]].append(item)
+
+    added = []
+    kept = []
+    for index, key in enumerate(source_keys):
+        if linked[key]:
+            kept.append(linked[key].popleft())
+        else:
+            added.append(index)
+
+    removed = [item for remaining in linked.values() for item in remaining]
+    return added, removed, kept
+
+
+def items_version(keys):
+    # Changes with the order as well, a swap leaves the diff empty but is still an edit
+    return hashlib.sha1(" ".join(keys).encode("utf-8")).hexdigest()
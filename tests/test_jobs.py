@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+from jobs import (
+    JOB_FINISHED, JOB_PAUSED, JOB_RUNNING, InMemoryJobStore, Job, JobPaused, JobQueue, SQLiteJobStore, pick_fair
+)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryJobStore()
+    return SQLiteJobStore(str(tmp_path / "jobs.db"))
+
+
+def add_job(store, kind="copy_a", owner="alice", created_at=None):
+    job = Job(f"job-{time.monotonic_ns()}", kind, {}, owner=owner, created_at=created_at)
+    store.add(job)
+    return job
+
+
+def test_pick_fair_waits_for_group_limit():
+    candidates = [("1", "copy_a", "alice"), ("2", "download", "bob")]
+    groups = {"copy_a": "copy"}
+    assert pick_fair(candidates, [("copy_b", "carol")], {"copy_b": "copy", **groups}, {"copy": 1}) == "2"
+    assert pick_fair(candidates[:1], [("copy_b", "carol")], {"copy_b": "copy", **groups}, {"copy": 1}) is None
+    assert pick_fair(candidates, [], groups, {"copy": 1}) == "1"
+
+
+def test_pick_fair_prefers_owner_with_fewest_running():
+    candidates = [("1", "copy", "alice"), ("2", "copy", "alice"), ("3", "copy", "bob")]
+    assert pick_fair(candidates, [("copy", "alice")], {}, {}) == "3"
+    assert pick_fair(candidates, [], {}, {}) == "1"
+
+
+def test_paused_job_frees_its_group_slot(store):
+    paused = add_job(store)
+    assert store.claim(timeout=0, groups={}, limits={"copy_a": 1}).id == paused.id
+    store.update(paused.id, status=JOB_PAUSED, not_before=time.time() + 60)
+
+    waiting = add_job(store)
+    claimed = store.claim(timeout=0, groups={}, limits={"copy_a": 1})
+    assert claimed.id == waiting.id
+    assert store.get(paused.id).status == JOB_PAUSED
+    assert store.claim(timeout=0, groups={}, limits={}) is None
+
+
+def test_paused_job_is_claimed_once_due(store):
+    job = add_job(store)
+    store.claim(timeout=0)
+    store.update(job.id, status=JOB_PAUSED, not_before=time.time() + 0.2)
+    assert store.claim(timeout=0) is None
+    time.sleep(0.3)
+    claimed = store.claim(timeout=0)
+    assert claimed.id == job.id
+    assert claimed.status == JOB_RUNNING
+
+
+def test_resumed_paused_job_keeps_its_place(store):
+    # A job paused for the quota goes before jobs queued after it
+    older = add_job(store, created_at=time.time() - 10)
+    store.claim(timeout=0)
+    store.update(older.id, status=JOB_PAUSED, not_before=time.time() - 1)
+    add_job(store)
+    assert store.claim(timeout=0).id == older.id
+
+
+def test_expired_lease_resumes_from_checkpoints(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    dead = SQLiteJobStore(path, lease=0.2)
+    job = add_job(dead)
+    dead.claim(timeout=0)
+    dead.save_checkpoint(job.id, "track:0", ["video", "item"])
+
+    # Another process sharing the database
+    other = SQLiteJobStore(path, lease=0.2)
+    assert other.claim(timeout=0) is None
+    time.sleep(0.3)
+    claimed = other.claim(timeout=0)
+    assert claimed.id == job.id
+    assert other.load_checkpoints(job.id) == {"track:0": ["video", "item"]}
+
+
+def test_touched_job_is_not_claimed_again(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    alive = SQLiteJobStore(path, lease=0.3)
+    job = add_job(alive)
+    alive.claim(timeout=0)
+    time.sleep(0.2)
+    alive.touch([job.id])
+    time.sleep(0.2)
+    assert SQLiteJobStore(path, lease=0.3).claim(timeout=0) is None
+
+
+def test_queue_requeues_paused_job_and_frees_worker():
+    queue = JobQueue(InMemoryJobStore(), workers=1, limits={"copy": 1})
+    runs = []
+    done = threading.Event()
+
+    @queue.handler("slow", group="copy")
+    def slow(params, job):
+        runs.append(("slow", job.checkpoints()))
+        if not job.checkpoints():
+            job.checkpoint("step", 1)
+            raise JobPaused(time.time() + 0.5, "quota")
+        done.set()
+        return "resumed"
+
+    @queue.handler("fast", group="copy")
+    def fast(params, job):
+        runs.append(("fast", None))
+        return "ok"
+
+    slow_id = queue.enqueue("slow", {})
+    deadline = time.monotonic() + 5
+    while queue.get(slow_id).status != JOB_PAUSED and time.monotonic() < deadline:
+        time.sleep(0.01)
+    paused = queue.get(slow_id)
+    assert paused.progress["paused_reason"] == "quota"
+
+    fast_id = queue.enqueue("fast", {})
+    assert done.wait(5)
+    while queue.get(slow_id).status != JOB_FINISHED and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert queue.get(fast_id).status == JOB_FINISHED
+    assert runs == [("slow", {}), ("fast", None), ("slow", {"step": 1})]
+    assert "paused_until" not in queue.get(slow_id).progress
@@ -0,0 +1,52 @@
+import pytest
+
+from matcher import best_match, clean_title, match_concurrently, spotify_track_key, youtube_video_key
+
+
+def track(name, artist, seconds):
+    return spotify_track_key({
+        "uri": "spotify:track:1", "name": name, "artists": [{"name": artist}], "duration_ms": seconds * 1000
+    })
+
+
+def test_clean_title_drops_noise_but_keeps_versions():
+    assert clean_title("Song (Official Music Video)") == "Song"
+    assert clean_title("Song (feat. Someone) [Lyrics]") == "Song"
+    assert clean_title("Song (Live Video)") == "Song (Live Video)"
+    assert clean_title("Song - 2011 Remastered") == "Song"
+
+
+def test_best_match_picks_the_recording():
+    source = track("Halo", "Beyonce", 261)
+    candidates = [
+        youtube_video_key("cover", "Halo (Acoustic Cover)", "Someone", 250),
+        youtube_video_key("live", "Beyonce - Halo (Live)", "BeyonceVEVO", 300),
+        youtube_video_key("official", "Beyoncé - Halo (Official Video)", "BeyonceVEVO", 262),
+    ]
+    value, confidence = best_match(source, candidates)
+    assert value == "official"
+    assert confidence > 0.8
+
+
+def test_best_match_below_threshold():
+    value, confidence = best_match(track("Halo", "Beyonce", 261),
+                                   [youtube_video_key("x", "Unrelated", "Other", 30)], min_confidence=0.4)
+    assert value is None
+    assert confidence < 0.4
+
+
+def test_match_concurrently_keeps_order_and_swallows_errors():
+    def resolve(item):
+        if item == 2:
+            raise ValueError("no match")
+        return item * 10
+
+    assert match_concurrently([1, 2, 3], resolve, max_workers=3) == [10, None, 30]
+
+
+def test_match_concurrently_raises_fatal_errors():
+    def resolve(item):
+        raise PermissionError("quota")
+
+    with pytest.raises(PermissionError):
+        match_concurrently([1, 2, 3], resolve, max_workers=3, is_fatal=lambda e: isinstance(e, PermissionError))
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+
+import quota
+from jobs import JobPaused, current_job
+from quota import QUOTA_TIMEZONE, QuotaExceeded, QuotaLedger, call_methods, failed_batch_methods, next_reset
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return QuotaLedger(str(tmp_path / "quota.db"), daily_budget=200, reserve=50)
+
+
+def test_methods_are_billed_by_cost(ledger):
+    ledger.spend(["search.list", "playlists.list"], "alice")
+    snapshot = ledger.snapshot()
+    assert snapshot["used"] == 101
+    assert snapshot["methods"]["search.list"] == {"calls": 1, "units": 100}
+    assert snapshot["users"] == {"alice": 101}
+
+
+def test_requests_may_use_the_reserve_jobs_may_not(ledger):
+    ledger.spend(["search.list"], "alice")
+    token = current_job.set(object())
+    try:
+        with pytest.raises(QuotaExceeded) as raised:
+            ledger.spend(["search.list"], "alice")
+    finally:
+        current_job.reset(token)
+    # Pauses the job rather than failing it
+    assert isinstance(raised.value, JobPaused)
+    assert raised.value.until == raised.value.resume_at
+    ledger.spend(["search.list"], "alice")
+    assert ledger.snapshot()["used"] == 200
+
+
+def test_budget_comes_back_the_next_day(ledger, monkeypatch):
+    ledger.spend(["search.list", "search.list"], "alice")
+    ledger.mark_exhausted()
+    with pytest.raises(QuotaExceeded):
+        ledger.spend(["playlists.list"], "alice")
+    monkeypatch.setattr(quota, "quota_day", lambda now=None: "2099-01-01")
+    ledger.spend(["search.list"], "alice")
+    assert ledger.snapshot()["used"] == 100
+
+
+def test_refund_takes_back_retried_calls(ledger):
+    ledger.spend(["playlistItems.insert", "playlistItems.insert"], "alice")
+    ledger.refund(["playlistItems.insert"], "alice")
+    assert ledger.snapshot()["methods"]["playlistItems.insert"] == {"calls": 1, "units": 50}
+
+
+def test_next_reset_is_pacific_midnight():
+    noon = datetime(2026, 3, 7, 12, 0, tzinfo=QUOTA_TIMEZONE).timestamp()
+    assert next_reset(noon) == datetime(2026, 3, 8, 0, 0, tzinfo=QUOTA_TIMEZONE).timestamp()
+
+
+def test_batch_calls_are_billed_and_matched_by_content_id():
+    body = (
+        "--batch\r\nContent-Type: application/http\r\nContent-ID: <abc+1>\r\n\r\n"
+        "POST /youtube/v3/playlistItems?part=snippet HTTP/1.1\r\n\r\n{}\r\n"
+        "--batch\r\nContent-Type: application/http\r\nContent-ID: <abc+2>\r\n\r\n"
+        "GET /youtube/v3/videos?id=x HTTP/1.1\r\n\r\n\r\n--batch--"
+    )
+    assert call_methods("POST", "https://www.googleapis.com/batch/youtube/v3", body) == [
+        "playlistItems.insert", "videos.list"
+    ]
+    # Answered out of order
+    content = (
+        "--resp\r\nContent-Type: application/http\r\nContent-ID: <response-abc+2>\r\n\r\n"
+        "HTTP/1.1 503 Service Unavailable\r\n\r\n{}\r\n"
+        "--resp\r\nContent-Type: application/http\r\nContent-ID: <response-abc+1>\r\n\r\n"
+        "HTTP/1.1 409 Conflict\r\n\r\n{}\r\n--resp--"
+    )
+    assert failed_batch_methods(body, content, {409}) == ["playlistItems.insert"]
+    assert sorted(failed_batch_methods(body, content, {409, 503})) == ["playlistItems.insert", "videos.list"]
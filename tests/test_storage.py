@@ -0,0 +1,58 @@
+import os
+import time
+
+import pytest
+
+from storage import StorageManager
+
+
+def write_job(storage, job_id, owner, size=10):
+    folder = storage.job_folder(job_id)
+    os.makedirs(folder)
+    with open(os.path.join(folder, "playlist.zip"), "wb") as f:
+        f.write(b"x" * size)
+    storage.add(job_id, owner, folder)
+    storage.finish(job_id)
+    return folder
+
+
+def test_artifacts_belong_to_their_session(tmp_path):
+    storage = StorageManager(str(tmp_path))
+    write_job(storage, "job1", "alice")
+    write_job(storage, "job2", "bob")
+    assert storage.owner("job1") == "alice"
+    assert storage.owner("job2") == "bob"
+    assert storage.owner("job3") is None
+
+
+def test_paths_outside_the_job_folder_are_refused(tmp_path):
+    storage = StorageManager(str(tmp_path))
+    with pytest.raises(ValueError):
+        storage.add("job1", "alice", str(tmp_path / "job2"))
+    with pytest.raises(ValueError):
+        storage.add("job1", "alice", str(tmp_path))
+
+
+def test_sweep_removes_expired_and_spares_active(tmp_path):
+    active = {"job2"}
+    storage = StorageManager(str(tmp_path), ttl=0.1, is_active=lambda job_id: job_id in active)
+    expired = write_job(storage, "job1", "alice")
+    running = write_job(storage, "job2", "alice")
+    time.sleep(0.2)
+    storage.sweep()
+    assert not os.path.exists(expired)
+    assert os.path.exists(running)
+    assert storage.owner("job1") is None
+
+
+def test_sweep_drops_least_recently_fetched_over_quota(tmp_path):
+    storage = StorageManager(str(tmp_path), max_bytes=25)
+    old = write_job(storage, "job1", "alice")
+    time.sleep(0.01)
+    fetched = write_job(storage, "job2", "alice")
+    time.sleep(0.01)
+    storage.touch("job1")
+    write_job(storage, "job3", "alice")
+    assert os.path.exists(old)
+    assert not os.path.exists(fetched)
+    assert storage.stats()["bytes"] == 20
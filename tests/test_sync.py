@@ -0,0 +1,38 @@
+from sync import PlaylistLink, SyncStore, diff_items, items_version
+
+
+def test_swap_keeps_every_item():
+    items = [("a", "item-a"), ("b", "item-b"), ("c", "item-c")]
+    added, removed, kept = diff_items(items, ["b", "a", "c"])
+    assert added == []
+    assert removed == []
+    assert sorted(kept) == sorted(items)
+
+
+def test_swap_is_a_new_version():
+    assert items_version(["a", "b", "c"]) != items_version(["b", "a", "c"])
+    assert items_version(["a", "b", "c"]) == items_version(["a", "b", "c"])
+
+
+def test_same_count_replacement_adds_and_removes():
+    added, removed, kept = diff_items([("a", "item-a"), ("b", "item-b")], ["a", "c"])
+    assert added == [1]
+    assert removed == [("b", "item-b")]
+    assert kept == [("a", "item-a")]
+
+
+def test_duplicates_match_one_to_one():
+    added, removed, kept = diff_items([("a", "item-1")], ["a", "a"])
+    assert added == [1]
+    assert removed == []
+    assert kept == [("a", "item-1")]
+
+
+def test_store_round_trip(tmp_path):
+    store = SyncStore(str(tmp_path / "sync.db"))
+    store.save(PlaylistLink("youtube", "PL1", "alice", "sp1", "v1", [("a", "uri-a"), ("b", None)]))
+    link = store.get("youtube", "PL1", "alice")
+    assert (link.target_id, link.version, link.items) == ("sp1", "v1", [("a", "uri-a"), ("b", None)])
+    assert store.get("youtube", "PL1", "bob") is None
+    store.delete("youtube", "PL1", "alice")
+    assert store.get("youtube", "PL1", "alice") is None
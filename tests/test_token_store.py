@@ -0,0 +1,69 @@
+import threading
+import time
+
+from token_store import MemoryTokenBackend, TokenRevoked, TokenStore
+
+
+def expired():
+    return {"access_token": "old", "expires_at": time.time() - 1}
+
+
+def test_concurrent_loads_refresh_once():
+    calls = []
+
+    def refresh(data):
+        calls.append(data)
+        time.sleep(0.1)
+        return {"access_token": "new", "expires_at": time.time() + 3600}
+
+    store = TokenStore(MemoryTokenBackend(), {"spotify": refresh})
+    store.save("s", "spotify", expired())
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.load("s", "spotify"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [data["access_token"] for data in results] == ["new"] * 8
+
+
+def test_revoked_tokens_are_deleted():
+    def refresh(data):
+        raise TokenRevoked("invalid_grant")
+
+    store = TokenStore(MemoryTokenBackend(), {"spotify": refresh})
+    store.save("s", "spotify", expired())
+    assert store.load("s", "spotify") is None
+    assert not store.has("s", "spotify")
+
+
+def test_transient_failure_keeps_tokens():
+    attempts = []
+
+    def refresh(data):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("token endpoint down")
+        return {"access_token": "new", "expires_at": time.time() + 3600}
+
+    store = TokenStore(MemoryTokenBackend(), {"spotify": refresh})
+    store.save("s", "spotify", expired())
+    assert store.load("s", "spotify") is None
+    assert store.has("s", "spotify")
+    assert store.load("s", "spotify")["access_token"] == "new"
+
+
+def test_token_within_margin_is_used_when_refresh_fails():
+    def refresh(data):
+        raise ConnectionError("token endpoint down")
+
+    store = TokenStore(MemoryTokenBackend(), {"spotify": refresh}, refresh_margin=300)
+    store.save("s", "spotify", {"access_token": "current", "expires_at": time.time() + 60})
+    assert store.load("s", "spotify")["access_token"] == "current"
+
+
+def test_locks_stay_bounded():
+    store = TokenStore(MemoryTokenBackend(), {}, lock_stripes=4)
+    locks = {id(store._lock(f"session-{i}", "spotify")) for i in range(100)}
+    assert len(locks) <= 4
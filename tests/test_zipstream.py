@@ -0,0 +1,28 @@
+import io
+import os
+import zipfile
+
+from zipstream import stream_zip
+
+
+def test_streamed_archive_reads_back(tmp_path):
+    paths = []
+    for name, data in [("a.mp3", b"first" * 100000), ("b.m4a", b"second")]:
+        path = tmp_path / name
+        path.write_bytes(data)
+        paths.append(str(path))
+
+    chunks = list(stream_zip(paths))
+    assert len(chunks) > 1
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ["a.mp3", "b.m4a"]
+        assert archive.read("b.m4a") == b"second"
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+
+
+def test_remove_deletes_each_file_once_zipped(tmp_path):
+    path = tmp_path / "a.mp3"
+    path.write_bytes(b"data")
+    b"".join(stream_zip([str(path)], remove=True))
+    assert not os.path.exists(path)
@@ -0,0 +1,136 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class TokenRevoked(Exception):
+    # Raised by a refresher when the provider turned the refresh token down for
+    # good, e.g. invalid_grant after the user revoked access
+    pass
+
+
+class MemoryTokenBackend:
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id, provider):
+        with self._lock:
+            return self._tokens.get((session_id, provider))
+
+    def set(self, session_id, provider, data):
+        with self._lock:
+            self._tokens[(session_id, provider)] = data
+
+    def delete(self, session_id, provider):
+        with self._lock:
+            self._tokens.pop((session_id, provider), None)
+
+
+class SQLiteTokenBackend:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                session_id TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (session_id, provider)
+            )
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id, provider):
+        row = self._conn().execute(
+            "SELECT data FROM tokens WHERE session_id = ? AND provider = ?", (session_id, provider)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, session_id, provider, data):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+            (session_id, provider, json.dumps(data), time.time())
+        )
+
+    def delete(self, session_id, provider):
+        self._conn().execute(
+            "DELETE FROM tokens WHERE session_id = ? AND provider = ?", (session_id, provider)
+        )
+
+
+class TokenStore:
+    # Tokens live server-side, keyed by session ID. Every record carries an
+    # "expires_at" timestamp and is refreshed by the provider's refresher once it
+    # gets within refresh_margin seconds of expiring. A refresher raises
+    # TokenRevoked when the tokens are no good any more, anything else it raises,
+    # like a timeout or a 5xx, leaves them for the next call to try again.
+
+    def __init__(self, backend, refreshers, refresh_margin=300, lock_stripes=64):
+        self.backend = backend
+        self.refreshers = refreshers
+        self.refresh_margin = refresh_margin
+        # A fixed set of locks shared out by hash, so sessions that come and go don't
+        # leave a lock each behind. Two sessions on one stripe just refresh in turn.
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def _lock(self, session_id, provider):
+        return self._locks[hash((session_id, provider)) % len(self._locks)]
+
+    def _needs_refresh(self, data):
+        expires_at = data.get("expires_at")
+        return expires_at is not None and expires_at - self.refresh_margin <= time.time()
+
+    def save(self, session_id, provider, data):
+        self.backend.set(session_id, provider, data)
+
+    def has(self, session_id, provider):
+        return session_id is not None and self.backend.get(session_id, provider) is not None
+
+    def load(self, session_id, provider):
+        if session_id is None:
+            return None
+        data = self.backend.get(session_id, provider)
+        if data is None or not self._needs_refresh(data):
+            return data
+
+        # Single flight: whoever gets the lock refreshes, everyone else reuses the result
+        with self._lock(session_id, provider):
+            data = self.backend.get(session_id, provider)
+            if data is None or not self._needs_refresh(data):
+                return data
+            try:
+                data = self.refreshers[provider](data)
+            except TokenRevoked as e:
+                print(f"{provider} token revoked: {str(e)}")
+                self.backend.delete(session_id, provider)
+                return None
+            except Exception as e:
+                print(f"Error refreshing {provider} token: {str(e)}")
+                if data["expires_at"] <= time.time():
+                    return None
+                # Still valid for a little while, try again on the next call
+                return data
+            self.backend.set(session_id, provider, data)
+            return data
+
+    def remove(self, session_id, provider):
+        if session_id is not None:
+            self.backend.delete(session_id, provider)
+
+
+def make_token_backend(backend, path=None):
+    if backend == "memory":
+        return MemoryTokenBackend()
+    if backend == "sqlite":
+        return SQLiteTokenBackend(path or "tunevert_tokens.db")
+    raise ValueError(f"Unknown token backend '{backend}'")
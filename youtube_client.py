@@ -0,0 +1,392 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import httplib2
+import httpx
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+
+from metrics import BACKOFF_SECONDS, UPSTREAM_FAILURES, UPSTREAM_RETRIES, UPSTREAM_SECONDS
+from quota import call_methods, failed_batch_methods, is_batch
+from googleapiclient.http import build_http
+from spotify_client import backoff_delay
+
+VIDEOS_PER_LOOKUP = 50
+INSERTS_PER_BATCH = 50
+# Inserts YouTube failed this way are sent again on their own, see insert_items()
+INSERT_RETRY_STATUSES = {409, 500, 503}
+MAX_CACHED_SERVICES = 256
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+_services = OrderedDict()
+_services_lock = threading.Lock()
+_discovery_document = None
+_discovery_lock = threading.Lock()
+_quota_ledger = None
+_api_root = None
+
+
+def use_api_root(root_url):
+    # Sends every YouTube call, batches included, to root_url instead of Google,
+    # e.g. a local mock server. Services built before the switch are dropped.
+    global _api_root, _discovery_document
+    with _discovery_lock:
+        _api_root = root_url.rstrip("/") + "/"
+        _discovery_document = None
+    with _services_lock:
+        _services.clear()
+
+
+def use_quota_ledger(ledger):
+    # Every YouTube API call made through get_service() is billed to this ledger
+    global _quota_ledger
+    _quota_ledger = ledger
+
+
+class ThreadLocalHttp:
+    # httplib2 connections are not thread-safe. This hands every thread its own
+    # authorized connection so one service object can be shared between threads.
+    def __init__(self, credentials, user=None):
+        self.credentials = credentials
+        self.user = user
+        self._local = threading.local()
+
+    def _http(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = AuthorizedHttp(self.credentials, http=build_http())
+            self._local.http = http
+        return http
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        methods = call_methods(method, uri, body)
+        if _quota_ledger is None:
+            return self._timed_request(methods, uri, method, body, headers, **kwargs)
+
+        while True:
+            _quota_ledger.spend(methods, self.user)
+            response, content = self._timed_request(methods, uri, method, body, headers, **kwargs)
+            if response.status == 403 and b"quotaExceeded" in _as_bytes(content):
+                # Our count was off, e.g. another app shares the key. Spending again
+                # raises QuotaExceeded, which pauses a job until the reset.
+                _quota_ledger.mark_exhausted()
+                continue
+            if is_batch(uri):
+                # Billed when they are sent again, not twice
+                retried = [
+                    method for method in failed_batch_methods(body, content, INSERT_RETRY_STATUSES)
+                    if method == "playlistItems.insert"
+                ]
+                if retried:
+                    _quota_ledger.refund(retried, self.user)
+            return response, content
+
+    def _timed_request(self, methods, uri, method, body, headers, **kwargs):
+        endpoint = methods[0] if len(methods) == 1 else f"batch/{methods[0]}" if methods else "other"
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self._http().request(uri, method, body, headers, **kwargs)
+            return response
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, service="youtube", endpoint=endpoint)
+            if response is None or response[0].status >= 400:
+                UPSTREAM_FAILURES.inc(service="youtube", endpoint=endpoint)
+
+    def close(self):
+        http = getattr(self._local, "http", None)
+        if http is not None:
+            http.close()
+
+
+def _as_bytes(content):
+    return content if isinstance(content, bytes) else str(content or "").encode()
+
+
+def discovery_document():
+    # Parsed once per process from the copy bundled with google-api-python-client,
+    # so building a service needs neither the network nor another JSON parse
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            document = json.loads(get_static_doc('youtube', 'v3'))
+            if _api_root:
+                # Batch requests are sent to rootUrl, client_options.api_endpoint misses them
+                document['rootUrl'] = document['baseUrl'] = _api_root
+            # Resources patch their method descriptions in place the first time they
+            # are used. Doing that once here keeps the shared document read-only later.
+            service = build_from_document(document, http=build_http())
+            for name in document.get('resources', {}):
+                getattr(service, name)()
+            _discovery_document = document
+    return _discovery_document
+
+
+def _credentials_key(google_credentials):
+    return (google_credentials.get('client_id'),
+            google_credentials.get('refresh_token') or google_credentials.get('token'))
+
+
+def user_label(google_credentials):
+    # Stable per account without putting tokens into the quota ledger
+    key = "/".join(part or "" for part in _credentials_key(google_credentials))
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def get_service(google_credentials):
+    # One service per credential, reused across routes and jobs
+    key = _credentials_key(google_credentials)
+    with _services_lock:
+        cached = _services.get(key)
+        if cached is not None:
+            _services.move_to_end(key)
+    if cached is not None:
+        service, http = cached
+        _sync_token(http.credentials, google_credentials)
+        return service
+
+    credentials = Credentials(**google_credentials)
+    http = ThreadLocalHttp(credentials, user_label(google_credentials))
+    service = build_from_document(discovery_document(), http=http)
+
+    with _services_lock:
+        _services[key] = (service, http)
+        while len(_services) > MAX_CACHED_SERVICES:
+            _services.popitem(last=False)
+    return service
+
+
+def _sync_token(credentials, google_credentials):
+    # The token store refreshes tokens ahead of time, hand the new one to the
+    # cached service instead of letting it refresh on its own
+    token = google_credentials.get('token')
+    if token and token != credentials.token:
+        credentials.token = token
+        credentials.expiry = google_credentials.get('expiry')
+
+
+def execute_conditional(request, etag_cache, scope):
+    # Sends If-None-Match with the etag of the last response for the same request.
+    # The API answers 304 when nothing changed, and the cached body is reused.
+    cached = etag_cache.get(scope, request.uri)
+    if cached:
+        request.headers['If-None-Match'] = cached['etag']
+    try:
+        response = request.execute()
+    except HttpError as e:
+        if cached and e.resp.status == 304:
+            return cached
+        raise
+    if response.get('etag'):
+        etag_cache.set(scope, request.uri, response)
+    return response
+
+
+def youtube_error_reason(error):
+    details = error.error_details if isinstance(error.error_details, list) else []
+    for detail in details:
+        if isinstance(detail, dict) and detail.get('reason'):
+            return detail['reason']
+    return None
+
+
+def is_retryable(error):
+    # A 403 is only worth retrying when it is a rate limit, not quota or permissions
+    return error.resp.status in [500, 503] or (
+        error.resp.status == 403 and youtube_error_reason(error) in RATE_LIMIT_REASONS
+    )
+
+
+class AsyncYouTubeClient:
+    # Sends requests built by a get_service() service over an httpx connection
+    # pool instead of httplib2, for the ASGI entry point. Billing, metrics, ETags
+    # and retries work as in the sync path. Batch requests are not supported.
+
+    def __init__(self, max_connections=100, max_retries=5, timeout=30):
+        self.max_retries = max_retries
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def execute(self, request, etag_cache=None, scope=None):
+        cached = etag_cache.get(scope, request.uri) if etag_cache is not None else None
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+        for attempt in range(self.max_retries):
+            try:
+                response = await self._send(request, headers)
+                break
+            except HttpError as e:
+                if cached and e.resp.status == 304:
+                    return cached
+                if not is_retryable(e) or attempt >= self.max_retries - 1:
+                    raise
+                delay = backoff_delay(attempt, base=1.0)
+                print(f"YouTube API request failed. Retrying in {delay:.1f} seconds...")
+                UPSTREAM_RETRIES.inc(service="youtube", endpoint=request.methodId or "other")
+                BACKOFF_SECONDS.inc(delay, service="youtube")
+                await asyncio.sleep(delay)
+        if etag_cache is not None and response.get('etag'):
+            etag_cache.set(scope, request.uri, response)
+        return response
+
+    async def _send(self, request, headers):
+        http = request.http
+        methods = call_methods(request.method, request.uri, request.body)
+        while True:
+            if _quota_ledger is not None:
+                # SQLite, and it blocks while a job waits for the quota reset
+                await asyncio.to_thread(_quota_ledger.spend, methods, http.user)
+            if not http.credentials.valid:
+                await asyncio.to_thread(http.credentials.refresh, GoogleAuthRequest())
+            request_headers = dict(request.headers, **headers)
+            request_headers['Authorization'] = f"Bearer {http.credentials.token}"
+
+            endpoint = methods[0] if methods else "other"
+            start = time.perf_counter()
+            response = None
+            try:
+                response = await self.client.request(
+                    request.method, request.uri, content=request.body, headers=request_headers
+                )
+            finally:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, service="youtube", endpoint=endpoint)
+                if response is None or response.status_code >= 400:
+                    UPSTREAM_FAILURES.inc(service="youtube", endpoint=endpoint)
+
+            if _quota_ledger is not None and response.status_code == 403 and b"quotaExceeded" in response.content:
+                _quota_ledger.mark_exhausted()
+                continue
+            resp = httplib2.Response(dict(response.headers, status=str(response.status_code)))
+            return request.postproc(resp, response.content)
+
+    async def get_videos(self, youtube, video_ids, part="contentDetails"):
+        # get_videos() with the lookups sent at the same time
+        unique_ids = list(dict.fromkeys(video_ids))
+        responses = await asyncio.gather(*(
+            self.execute(youtube.videos().list(
+                part=part,
+                id=",".join(unique_ids[i:i + VIDEOS_PER_LOOKUP]),
+                maxResults=VIDEOS_PER_LOOKUP
+            ))
+            for i in range(0, len(unique_ids), VIDEOS_PER_LOOKUP)
+        ))
+        return {item['id']: item for response in responses for item in response.get('items', [])}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def parse_duration(duration):
+    # ISO 8601 durations as used by contentDetails.duration, e.g. PT1H2M3S
+    match = re.fullmatch(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?", duration or "")
+    if not match:
+        return 0
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def get_videos(youtube, video_ids, part="contentDetails"):
+    # Up to 50 IDs per videos.list call, returns {video_id: video resource}
+    videos = {}
+    unique_ids = list(dict.fromkeys(video_ids))
+    for i in range(0, len(unique_ids), VIDEOS_PER_LOOKUP):
+        response = youtube.videos().list(
+            part=part,
+            id=",".join(unique_ids[i:i + VIDEOS_PER_LOOKUP]),
+            maxResults=VIDEOS_PER_LOOKUP
+        ).execute()
+        for item in response.get('items', []):
+            videos[item['id']] = item
+    return videos
+
+
+def insert_playlist_items(youtube, playlist_id, video_ids, batch_size=INSERTS_PER_BATCH, retry=None):
+    return insert_items(youtube, [(playlist_id, video_id) for video_id in video_ids], batch_size, retry)
+
+
+def insert_items(youtube, entries, batch_size=INSERTS_PER_BATCH, retry=None):
+    # Sends the inserts as batch requests, one HTTP round trip per batch. entries are
+    # (playlist_id, video_id) pairs. YouTube may run the calls of a batch in any
+    # order, so a batch holds at most one insert per playlist and every playlist
+    # gets its videos in the order of entries. Only inserts into different
+    # playlists share a round trip.
+    #
+    # retry(playlist_id, video_id) sends an insert that failed with one of
+    # INSERT_RETRY_STATUSES again, before the playlist's next video goes out.
+    # Returns (items, errors) with one entry per pair: the created playlist
+    # item, or the error where the insert did not go through.
+    items = [None] * len(entries)
+    errors = [None] * len(entries)
+    queues = OrderedDict()
+    for i, (playlist_id, _) in enumerate(entries):
+        queues.setdefault(playlist_id, deque()).append(i)
+
+    def callback(request_id, response, exception):
+        items[int(request_id)] = response
+        errors[int(request_id)] = exception
+
+    while queues:
+        indexes = []
+        for playlist_id in list(queues)[:batch_size]:
+            indexes.append(queues[playlist_id].popleft())
+            if not queues[playlist_id]:
+                del queues[playlist_id]
+            else:
+                # The next batch starts with the playlists left out of this one
+                queues.move_to_end(playlist_id)
+        batch = youtube.new_batch_http_request(callback=callback)
+        for i in indexes:
+            playlist_id, video_id = entries[i]
+            batch.add(playlist_item_insert(youtube, playlist_id, video_id), request_id=str(i))
+        batch.execute()
+
+        for i in indexes:
+            error = errors[i]
+            if retry is not None and isinstance(error, HttpError) and error.resp.status in INSERT_RETRY_STATUSES:
+                try:
+                    items[i], errors[i] = retry(*entries[i]), None
+                except HttpError as e:
+                    errors[i] = e
+
+    return items, errors
+
+
+def delete_playlist_items(youtube, item_ids, batch_size=INSERTS_PER_BATCH):
+    # Same batching as inserts, returns one error per playlist item ID
+    errors = [None] * len(item_ids)
+
+    def callback(request_id, response, exception):
+        errors[int(request_id)] = exception
+
+    for start in range(0, len(item_ids), batch_size):
+        batch = youtube.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + batch_size, len(item_ids))):
+            batch.add(youtube.playlistItems().delete(id=item_ids[i]), request_id=str(i))
+        batch.execute()
+
+    return errors
+
+
+def playlist_item_insert(youtube, playlist_id, video_id):
+    return youtube.playlistItems().insert(
+        part="snippet",
+        body={
+            "snippet": {
+                "playlistId": playlist_id,
+                "resourceId": {
+                    "kind": "youtube#video",
+                    "videoId": video_id
+                }
+            }
+        }
+    )
@@ -0,0 +1,56 @@
+import io
+import os
+import zipfile
+
+CHUNK_SIZE = 256 * 1024
+
+
+class _StreamBuffer(io.RawIOBase):
+    # Write-only and unseekable, so zipfile falls back to data descriptors
+    # instead of going back to patch local headers
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(paths, remove=False):
+    # Yields the archive as each file arrives. Audio is already compressed,
+    # so entries are stored rather than deflated.
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zipf:
+        for path in paths:
+            zinfo = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as source, zipf.open(zinfo, "w") as target:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            if remove:
+                os.remove(path)
+            data = buffer.drain()
+            if data:
+                yield data
+    data = buffer.drain()
+    if data:
+        yield data